@@ -11,6 +11,8 @@ import PIL.ImageFont
 import locale
 import datetime
 
+from . import locales
+
 
 FONT_DNS = [os.path.join(os.path.dirname(os.path.realpath(__file__)),
                          'resources', 'fonts')]
@@ -61,6 +63,19 @@ def rangeCheck(pre, nmin, nmax):
         return s
     return check
 
+
+class ReplaceFile(argparse.Action):
+    '''Store the file opened by type=argparse.FileType(...), closing the
+    file opened for an earlier use of the option (e.g. one replaced by the
+    options of a --variant)'''
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        old = getattr(namespace, self.dest, None)
+        if old is not None and old is not values and hasattr(old, 'close'):
+            old.close()
+        setattr(namespace, self.dest, values)
+
+
 _allfonts = None
 
 
@@ -136,10 +151,20 @@ def maybeMore(subType, n=2, sep='~'):
     return check
 
 
-def localeCheckSet(loc):
+def mmarg(arg, **args):
+    '''Allow the argument arg to have landscape~portrait values'''
+    if not arg.type:
+        arg.type = str
+    arg.type = maybeMore(arg.type, **args)
+    arg.mm = True
+    return arg
+
+
+def localeCheck(loc):
+    '''Return the locales.LocaleTable for loc'''
     if '.' not in loc:
         try:
-            return locale.setlocale(locale.LC_ALL, (loc, 'UTF-8'))
+            return locales.getTable(loc)
         except locale.Error:
             pass
 
@@ -0,0 +1,213 @@
+#! /usr/bin/env python3
+# -*- encoding: utf-8 -*-
+#
+# Build many calendars described in a job file
+#
+'''
+A job file (JSON, TOML or YAML) describes a whole build, e.g.,
+
+  {
+    "options": {"format": "tmde~tdme", "event-file": ["danish.txt"]},
+    "jobs": [
+      {"name": "mom", "date": "2025-01-01", "until": "2025-12-31",
+       "picture": "mom.jpg", "output": "mom/%F.png"},
+      {"name": "dad", "date": "2025-01-01", "until": "2025-12-31",
+       "picture": "dad.jpg", "output": "dad/%F.png",
+       "options": {"margin-inner": {"landscape": 4, "portrait": 5}},
+       "variants": [{"locale": "de_DE", "output": "dad/de/%F.png"}]}
+    ]
+  }
+
+Options are the long options of dpc-single without --. The options of a
+job are the common options + the job options. Use true for options
+without a value, a list for options used several times, and
+{"landscape": ..., "portrait": ...} for landscape~portrait values.
+
+All jobs are checked before any job is run. Completed jobs are recorded in
+a state file next to the job file, and are skipped if the build is
+started again (e.g. after a failure). Within a job, the completed pages
+are recorded in a journal (see --journal of dpc-single) next to the job
+file.
+'''
+
+import argparse
+import json
+import os
+import shlex
+
+from . import log
+from . import single
+
+# keys of a job that are not options
+JOB_KEYS = ('name', 'options', 'variants')
+
+
+def readJobFile(fn):
+    '''Return the contents of the job file fn as a dict'''
+    ext = os.path.splitext(fn)[1].lower()
+    if ext == '.toml':
+        try:
+            import tomllib
+        except ImportError:
+            import tomli as tomllib
+        with open(fn, 'rb') as fd:
+            return tomllib.load(fd)
+    with open(fn, encoding='utf-8') as fd:
+        if ext in ('.yaml', '.yml'):
+            import yaml
+            return yaml.safe_load(fd)
+        return json.load(fd)
+
+
+def toArgv(options):
+    '''Convert a dict of options to a list of command line arguments'''
+    argv = []
+    for key, value in options.items():
+        opt = key if key.startswith('-') else '--' + key
+        values = value if isinstance(value, list) else [value]
+        for value in values:
+            if value is True:
+                argv.append(opt)
+            elif value is False or value is None:
+                continue
+            elif isinstance(value, dict):
+                argv += [opt, '%s~%s' % (value['landscape'],
+                                         value['portrait'])]
+            else:
+                argv += [opt, str(value)]
+    return argv
+
+
+class Job:
+    '''A single invocation of dpc-single'''
+
+    def __init__(self, name, argv):
+        self.name = name
+        self.argv = argv
+
+    def __repr__(self):
+        return 'Job(%r)' % self.name
+
+
+def plan(jobfile):
+    '''Compile the job file into a list of Jobs'''
+    common = jobfile.get('options', {})
+    res, names = [], set()
+    for i, job in enumerate(jobfile.get('jobs', [])):
+        name = str(job.get('name', i+1))
+        if name in names:
+            raise ValueError('Job name %r used twice' % name)
+        names.add(name)
+
+        options = dict(common)
+        options.update(job.get('options', {}))
+        options.update((k, v) for k, v in job.items() if k not in JOB_KEYS)
+        argv = toArgv(options)
+        for variant in jobfile.get('variants', []) + job.get('variants', []):
+            if isinstance(variant, dict):
+                variant = ' '.join(map(shlex.quote, toArgv(variant)))
+            argv.append('--variant=' + variant)
+        res.append(Job(name, argv))
+    return res
+
+
+def check(job):
+    '''Check all options of job (and its variants) using the same checks
+    as dpc-single, i.e., the event files and the start of the pictures are
+    read as well.
+    Returns an error message or None'''
+    fds = []
+    try:
+        variants, dates = single.parseArgs(job.argv)
+        for vargs in variants:
+            fds.append(vargs.imagefd)
+            fds += vargs.events or []
+        single.checkArgs(variants, dates)
+        shared = {}
+        for vargs in variants:
+            single.prepare(vargs, shared)
+    except SystemExit:
+        return 'invalid options (see above)'
+    finally:
+        # close the files opened by argparse, they are opened again later
+        for fd in fds:
+            fd.close()
+    return None
+
+
+def statePath(fn):
+    return fn + '.done'
+
+
+def readState(fn):
+    '''Names of the completed jobs'''
+    try:
+        with open(statePath(fn), encoding='utf-8') as fd:
+            return set(line.rstrip('\n') for line in fd)
+    except FileNotFoundError:
+        return set()
+
+
+def markDone(fn, job):
+    with open(statePath(fn), 'a', encoding='utf-8') as fd:
+        fd.write(job.name + '\n')
+        fd.flush()
+        os.fsync(fd.fileno())
+
+
+def main(argv=None):
+    desc = 'Build many calendars described in a job file.'
+    parser = argparse.ArgumentParser(description=desc, epilog=__doc__,
+                                     formatter_class=argparse.
+                                     RawDescriptionHelpFormatter)
+    parser.add_argument('-v', '--verbose', dest='verbose', default=False,
+                        help='Be more verbose',
+                        action='store_true')
+    parser.add_argument('-n', '--dry-run', dest='dryRun',
+                        action='store_true',
+                        help='only check the job file and show the jobs')
+    parser.add_argument('--restart', dest='restart', action='store_true',
+                        help='also run jobs completed by an earlier build')
+    parser.add_argument('jobfile', help='JSON, TOML or YAML job file',
+                        metavar='JOBFILE')
+    args = parser.parse_args(argv)
+    log.VERBOSE = 2 if args.verbose else 1
+
+    try:
+        jobs = plan(readJobFile(args.jobfile))
+    except (OSError, ValueError, KeyError, ImportError) as e:
+        log.error('batch', 'Cannot read %s: %s' % (args.jobfile, e))
+
+    errors = 0
+    for job in jobs:
+        log.debug('batch', 'Checking', job, shlex.join(job.argv))
+        error = check(job)
+        if error:
+            log.log(0, 'batch', 'Job %s: %s' % (job.name, error))
+            errors += 1
+    if errors:
+        log.error('batch', '%d of %d jobs are invalid' % (errors, len(jobs)))
+
+    done = set() if args.restart else readState(args.jobfile)
+    if args.restart and not args.dryRun:
+        for fn in (statePath(args.jobfile), args.jobfile + '.journal'):
+            if os.path.exists(fn):
+                os.unlink(fn)
+    todo = list(job for job in jobs if job.name not in done)
+    log.info('batch', '%d jobs, %d already done' % (len(jobs),
+                                                    len(jobs) - len(todo)))
+
+    for i, job in enumerate(todo):
+        if args.dryRun:
+            print('%s: dpc-single %s' % (job.name, shlex.join(job.argv)))
+            continue
+        log.info('batch', 'Job %d/%d: %s' % (i+1, len(todo), job.name))
+        argv = job.argv + (['-v'] if args.verbose else [])
+        if '--journal' not in argv:
+            argv += ['--journal', args.jobfile + '.journal']
+        single.main(argv)
+        markDone(args.jobfile, job)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,31 +1,171 @@
 #
 # -*- encoding: utf-8 -*-
 #
+# Box types. Other packages can add box types using the entry point group
+# dpc.boxes, e.g., in setup.py
+#
+#   entry_points={'dpc.boxes': ['w = dpcweather:weather']}
+#
+# where dpcweather.weather is either a BoxType or a function like the ones
+# below. Such box types are only loaded when used in --format.
+#
 
 import datetime
-import locale
+import re
+import threading
+import time
+
+import PIL.ImageColor
 
+from .events import toStore
+from . import argp
+from . import layout
+from . import locales
 from . import log
 from . import pics
+from . import textlayout
+
+ENTRY_POINT_GROUP = 'dpc.boxes'
+
+
+class BoxType:
+    '''A type of box, e.g., d (datebox).
+
+    draw(args, f, canvas, box) draws the date specific content of the box.
+    static(args, f, canvas, box), if given, draws the content only
+    depending on the options and staticKey(args), e.g., titles. The
+    renderer may reuse the static content between pages.
+    options(pgrp) adds the command line options of the box type to the
+    argument group pgrp (with the given title and help)'''
+
+    def __init__(self, name, draw, options=None, title=None, help=None,
+                 static=None, staticKey=None):
+        self.name = name
+        self.draw = draw
+        self.options = options
+        self.title = title or name
+        self.help = help
+        self.static = static
+        self.staticKey = staticKey
+
+    def __repr__(self):
+        return 'BoxType(%r)' % self.name
+
 
 BOX_TYPES = {}
+TIMINGS = {}  # name -> [count, seconds]
+_timingsLock = threading.Lock()
+_plugins = None
+_names = None
 
 
-def boxType(name):
+def boxType(name, **kw):
     def wrap(f):
-        BOX_TYPES[name] = f
+        global _names
+        BOX_TYPES[name] = BoxType(name, f, **kw)
+        _names = None
         return f
     return wrap
 
 
-def getFuncForBoxType(name):
+def getPlugins():
+    '''Return dict of name -> (not loaded) entry point of all box type
+    plugins'''
+    global _plugins
+    if _plugins is None:
+        _plugins = {}
+        try:
+            from importlib.metadata import entry_points
+        except ImportError:
+            return _plugins
+        eps = entry_points()
+        if hasattr(eps, 'select'):
+            eps = eps.select(group=ENTRY_POINT_GROUP)
+        else:
+            eps = eps.get(ENTRY_POINT_GROUP, ())
+        for ep in eps:
+            _plugins.setdefault(ep.name, ep)
+    return _plugins
+
+
+def getBoxType(name):
+    if name not in BOX_TYPES and name in getPlugins():
+        log.debug('boxes', 'Loading plugin', name)
+        obj = getPlugins()[name].load()
+        if isinstance(obj, BoxType):
+            BOX_TYPES[name] = obj
+        elif name not in BOX_TYPES:
+            boxType(name)(obj)
     if name in BOX_TYPES:
         return BOX_TYPES[name]
     raise ValueError('Unknow boxtype %r' % name)
 
 
+def getFuncForBoxType(name):
+    return getBoxType(name).draw
+
+
 def getBoxTypes():
-    return list(sorted(BOX_TYPES.keys()))
+    '''Names of all box types (including plugins not loaded yet)'''
+    global _names
+    if _names is None:
+        _names = list(sorted(set(BOX_TYPES) | set(getPlugins())))
+    return _names
+
+
+def formatRE():
+    '''Regular expression matching one box type'''
+    names = sorted(getBoxTypes(), key=len, reverse=True)
+    return '|'.join(map(re.escape, names))
+
+
+def splitFormat(fmt):
+    '''Split e.g. mde into ('m', 'd', 'e')'''
+    return tuple(filter(None, re.split('(%s)' % formatRE(), fmt)))
+
+
+def addOptions(parser, names):
+    '''Add command line options for the box types in names to parser'''
+    for name in names:
+        bt = getBoxType(name)
+        if bt.options:
+            bt.options(parser.add_argument_group(
+                '%s (%s)' % (bt.title, name), bt.help))
+
+
+def drawBox(args, f, canvas, box, static=True):
+    '''Draw a box of type f (including the static content if static)'''
+    bt = getBoxType(f)
+    t0 = time.time()
+    if static and bt.static:
+        bt.static(args, f, canvas, box)
+    bt.draw(args, f, canvas, box)
+    t = time.time() - t0
+    addTimings({f: (1, t)})
+
+
+def addTimings(timings):
+    '''Add timings (name -> (count, seconds), e.g., from takeTimings in a
+    worker process) to TIMINGS'''
+    with _timingsLock:
+        for name, (count, t) in timings.items():
+            timing = TIMINGS.setdefault(name, [0, 0.])
+            timing[0] += count
+            timing[1] += t
+
+
+def takeTimings():
+    '''Return TIMINGS and start again from no timings'''
+    with _timingsLock:
+        timings = dict(TIMINGS)
+        TIMINGS.clear()
+    return timings
+
+
+def logTimings(level=2):
+    for name, (count, t) in sorted(TIMINGS.items()):
+        log.log(level, 'boxes', 'Box %s: %d boxes in %.3fs (%.1fms/box)'
+                % (name, count, t, 1000*t/count))
 
 
 @boxType('_')
@@ -34,7 +174,40 @@ def noop(args, f, image, box):
     pass
 
 
-@boxType('d')
+def dateboxOptions(pgrp):
+    mmarg = argp.mmarg
+    mmarg(pgrp.add_argument('--datebox-top', dest='dateboxTop',
+                            default='%A uge %V',
+                            help='datetext to show above '
+                            '(default %(default)s)',
+                            metavar='CONTENT'))
+    mmarg(pgrp.add_argument('--datebox-middle', dest='dateboxMiddle',
+                            default='%e',
+                            help='datetext to show in the middle '
+                            '(default %(default)s)',
+                            metavar='CONTENT'))
+    mmarg(pgrp.add_argument('--datebox-bottom', dest='dateboxBottom',
+                            default='%B %Y',
+                            help='datetext to show below '
+                            '(default %(default)s)',
+                            metavar='CONTENT'))
+    mmarg(pgrp.add_argument('--datebox-color', dest='dateboxColor',
+                            default='#000000',
+                            help='color of the datebox text '
+                            '(default %(default)s)',
+                            metavar='COLOR',
+                            type=PIL.ImageColor.getrgb))
+    mmarg(pgrp.add_argument('--datebox-top-size', dest='dateboxTopSize',
+                            default=20,
+                            help='height of datebox in %% to use for each of'
+                            'date-top and date-bottom (default %(default)s)',
+                            metavar='SIZE',
+                            type=argp.rangeCheck(float, 1, 49)))
+
+
+@boxType('d', options=dateboxOptions, title='datebox',
+         help='''Simple box with three lines. By default Weekday / Day of month
+/ Month Year.''')
 def datebox(args, f, image, box):
     x0, y0, x1, y1 = box
     w, h = x1 - x0, y1 - y0
@@ -42,8 +215,8 @@ def datebox(args, f, image, box):
     cbox = (x0, y0+sz+2, x1, y1-sz-2)
 
     # determine text to write
-    texts = [args.dateboxTop, args.dateboxMiddle, args.dateboxBottom]
-    texts = tuple(map(args.date.strftime, texts))
+    texts = tuple(layout.dateText(args, dest)
+                  for dest in layout.DATE_TEXTS['d'])
     log.debug('datebox', 'texts to insert', texts)
 
     # find font sizes
@@ -60,17 +233,42 @@ def datebox(args, f, image, box):
                   (pics.CENTER, 0))
 
 
-@boxType('s')
+def simpleboxOptions(pgrp):
+    mmarg = argp.mmarg
+    mmarg(pgrp.add_argument('--simplebox-left', dest='simpleboxLeft',
+                            default='%A',
+                            help='datetext to show to the left '
+                            '(default %(default)s)',
+                            metavar='CONTENT'))
+    mmarg(pgrp.add_argument('--simplebox-middle', dest='simpleboxMiddle',
+                            default='%e',
+                            help='datetext to show in the middle '
+                            '(default %(default)s)',
+                            metavar='CONTENT'))
+    mmarg(pgrp.add_argument('--simplebox-right', dest='simpleboxRight',
+                            default='%B',
+                            help='datetext to show to the right '
+                            '(default %(default)s)',
+                            metavar='CONTENT'))
+    mmarg(pgrp.add_argument('--simplebox-color', dest='simpleboxColor',
+                            default='#000000',
+                            help='color of the simplebox text '
+                            '(default %(default)s)',
+                            metavar='COLOR',
+                            type=PIL.ImageColor.getrgb))
+
+
+@boxType('s', options=simpleboxOptions, title='simple date box',
+         help='''Simple (wide or tall) layout with date in the middle, and
+month and weekday to the left/right''')
 def simplebox(args, f, image, box):
     ''' left MIDDLE right, e.g, Thursday 28 October'''
     x0, y0, x1, y1 = box
     w, h = x1 - x0, y1 - y0
 
     # determine text to write
-    texts = [args.simpleboxLeft,
-             args.simpleboxMiddle,
-             args.simpleboxRight]
-    texts = tuple(map(args.date.strftime, texts))
+    texts = tuple(layout.dateText(args, dest)
+                  for dest in layout.DATE_TEXTS['s'])
     log.debug('datebox', 'texts to insert', texts)
 
     # draw middle text
@@ -122,101 +320,249 @@ def simplebox(args, f, image, box):
                       (pics.CENTER, 0))
 
 
-@boxType('e')
-def events(args, f, image, box):
+def eventsOptions(pgrp):
+    mmarg = argp.mmarg
+    mmarg(pgrp.add_argument('--eventbox-range', dest='eventboxRange',
+                            default=14,
+                            help='maximum number of days in the future for '
+                            'shown events '
+                            '(default %(default)s)',
+                            metavar='DAYS',
+                            type=argp.rangeCheck(int, 0, 365)))
+    mmarg(pgrp.add_argument('--eventbox-title', dest='eventboxTitle',
+                            default='%B:',
+                            help='datetext to show above the events '
+                            '(default %(default)s)',
+                            metavar='CONTENT'))
+    mmarg(pgrp.add_argument('--eventbox-title-size', dest='eventboxTitleSize',
+                            default=15,
+                            help='height of eventbox in %% to use for '
+                            'the title (default %(default)s)',
+                            metavar='SIZE',
+                            type=argp.rangeCheck(float, 1, 49)))
+    mmarg(pgrp.add_argument('--eventbox-title-color',
+                            dest='eventboxTitleColor',
+                            default='#000000',
+                            help='color of the eventbox title '
+                            '(default %(default)s)',
+                            metavar='COLOR',
+                            type=PIL.ImageColor.getrgb))
+    pgrp.add_argument('--eventbox-fit', dest='eventboxFit',
+                      default='shrink', choices=textlayout.MODES,
+                      help='how to fit events too long for the box: '
+                      'shrink the text of the event (and then cut it), '
+                      'cut it (ellipsis), wrap it onto more lines, or use '
+                      'the same (smaller) font for all events as before '
+                      'this option (all) (default %(default)s)')
+
+
+def eventSpans(evs, table, collapse=False):
+    '''Return (first date, last date, text) for the sorted events evs. If
+    collapse is true, the same event on consecutive days (e.g. a holiday
+    lasting a week) is only included once'''
+    res, last = [], {}  # (type, text) -> index in res
+    for ev in evs:
+        text = ev.getText(table)
+        key = ev.tp, text
+        i = last.get(key)
+        if collapse and i is not None and \
+           (ev.date - res[i][1]).days == 1:
+            res[i] = res[i][0], ev.date, text
+            continue
+        last[key] = len(res)
+        res.append((ev.date, ev.date, text))
+    return res
+
+
+def eventsTitle(args, f, image, box):
     x0, y0, x1, y1 = box
-    w, h = x1 - x0, y1 - y0
-    sz = int(args.eventboxTitleSize / 100 * h)
+    sz = int(args.eventboxTitleSize / 100 * (y1 - y0))
 
-    # Title
-    title = args.date.strftime(args.eventboxTitle)
+    title = layout.dateText(args, 'eventboxTitle')
     tbox = (x0, y0, x1, y0+sz)
     pics.textDraw(image, tbox, title, args.eventboxTitleColor,
                   args.fontBold,
                   (0, pics.CENTER), False, True)
 
+
+@boxType('e', options=eventsOptions, title='events',
+         help='''Show events in the near future.
+Also use --event-file (see above), otherwise this box will be almost empty.''',
+         static=eventsTitle,
+         staticKey=lambda args: layout.dateText(args, 'eventboxTitle'))
+def events(args, f, image, box):
+    x0, y0, x1, y1 = box
+    w, h = x1 - x0, y1 - y0
+    sz = int(args.eventboxTitleSize / 100 * h)
+
     # Find applicable events
     end = args.date + datetime.timedelta(days=args.eventboxRange)
-    evs = list(ev for ev in args.events if ev.between(args.date, end))
+    evs = toStore(args.events).between(args.date, end)
 
-    mx = h//sz
-    evs = evs[:mx]
+    if args.eventboxFit == 'all':
+        # as before --eventbox-fit, i.e., the last row may be drawn below
+        # the box and events are never collapsed
+        rows = h//sz
+        collapse = False
+    else:
+        # the first row is used by the title
+        rows = h//sz - 1
+        collapse = len(evs) > rows
     if not evs:
         log.debug('events', 'NO EVENTS TO SHOW')
+    table = locales.fromArgs(args)
+    spans = eventSpans(evs, table, collapse)
     texts = []
-    for i, ev in enumerate(evs):
-        dt = ev.date.strftime(shortDateFormat())
-        text = '%s: %s' % (dt, ev.text)
-        log.debug('events', '%r ==> %s' % (ev, text))
-        texts.append(text)
-    font = pics.fitFontSize(args.fontRegular, texts, (w, sz))
-    for i, text in enumerate(texts):
+    for first, last, text in spans[:rows]:
+        dt = table.strftime(first, table.shortDateFormat)
+        if last != first:
+            dt += '–' + table.strftime(last, table.shortDateFormat)
+        texts.append('%s: %s' % (dt, text))
+        log.debug('events', '%s ==> %s' % (first, texts[-1]))
+
+    lines = textlayout.layoutLines(args.fontRegular, texts, w, sz, rows,
+                                   args.eventboxFit, '    ')
+    for i, (text, font) in enumerate(lines):
         ebox = (x0, y0+sz*(i+1), x1, y0+sz*(i+2))
         pics.textDraw(image, ebox, text,
                       args.eventboxTitleColor, font,
                       (0, pics.CENTER))
 
     # fixme
-    # image.drw.rectangle(box, (0, 255, 0), (0, 0, 255))
-
-
-def shortDateFormat():
-    '''Return short date format for any locale - this probably breaks for some
-    locales'''
-    fmt = locale.nl_langinfo(locale.D_FMT)
-    fmt = fmt.replace('%Y', '').replace('%y', '')
-    fmt = fmt.strip('/-.')
-    return fmt
-
-
-@boxType('m')
-def month(args, f, image, box):
-    '''Draw a calendar. Always 6 weeks + names of days'''
+    # image.draw.rectangle(box, (0, 255, 0), (0, 0, 255))
+
+
+def monthOptions(pgrp):
+    mmarg = argp.mmarg
+    pgrp.add_argument('--monthbox-firstweekday',
+                      dest='monthboxFirstDay', default=0,
+                      help='first day of week. 0 is Monday, 6 is Sunday '
+                      '(default %(default)s)',
+                      metavar='DAY',
+                      type=argp.rangeCheck(int, 0, 6))
+    pgrp.add_argument('--monthbox-dayoff',
+                      dest='monthboxDayoff', default=[5, 6],
+                      help='days off (marked as "red"). 0 is Monday, '
+                      '6 is Sunday. Use e.g., -5 to unmark Saturday. '
+                      '(default %(default)s)',
+                      metavar='DAY', action='append',
+                      type=argp.rangeCheck(int, -6, 6))
+
+    mmarg(pgrp.add_argument('--monthbox-border-color',
+                            dest='monthboxBorderColor',
+                            default='#000000',
+                            help='default border color around boxes '
+                            '(default %(default)s)',
+                            metavar='COLOR',
+                            type=PIL.ImageColor.getrgb))
+
+    mmarg(pgrp.add_argument('--monthbox-title-border-color',
+                            dest='monthboxTitleBorderColor',
+                            default='#FFFFFF',
+                            help='border color around the title boxes '
+                            '(default %(default)s)',
+                            metavar='COLOR',
+                            type=PIL.ImageColor.getrgb))
+
+    colors = [
+        ('title',      '#666666', '#FFFFFF', 'monthbox title (MON...)'),
+        ('default',    '#666666', '#C2C2C2', 'default date'),
+        ('today',      '#F3F3F3', '#598B94', 'today\'s date'),
+        ('dayoff',     '#969696', '#C2C2C2', 'a day of'),
+        ('othermonth', '#C8C5BE', '#F3F3F3', 'a day from other months'),
+        ]
+
+    for (key, c, bgc, desc) in colors:
+        tkey = key.title()
+        mmarg(pgrp.add_argument('--monthbox-%s-color' % key,
+                                dest='monthbox%sColor' % tkey,
+                                default=c,
+                                help='text color of the %s '
+                                '(default %%(default)s)' % desc,
+                                metavar='COLOR',
+                                type=PIL.ImageColor.getrgb))
+        mmarg(pgrp.add_argument('--monthbox-%s-bgcolor' % key,
+                                dest='monthbox%sBgColor' % tkey,
+                                default=bgc,
+                                help='background color of the %s '
+                                '(default %%(default)s)' % desc,
+                                metavar='COLOR',
+                                type=PIL.ImageColor.getrgb))
+
+
+def monthGeometry(box):
+    '''Return (w0, h0, ht): size of a day and height of the title'''
     x0, y0, x1, y1 = box
     w, h = x1 - x0, y1 - y0
 
     w0 = int(w//7)
     h0 = int(h//6.7)
     ht = h - 6*h0
+    return w0, h0, ht
+
+
+def dayNames(args):
+    '''Abbreviated names of the days in the order shown'''
+    abdays = locales.fromArgs(args).abdays
+    return list(abdays[(args.monthboxFirstDay + i) % 7] for i in range(7))
 
-    # Which month are we looking at?
-    day0 = args.date.replace(day=1)
-    while day0.weekday() != args.monthboxFirstDay:
-        day0 -= datetime.timedelta(1)
 
-    # "Title"
-    days = list((day0 + datetime.timedelta(i)).strftime('%a')
-                for i in range(7))
-    font = pics.fitFontSize(args.fontBold, days, (w0-4, ht-4), True)
+def monthFonts(args, box):
+    '''Return the fonts used for the names of days and the dates in a month
+    box. Month boxes of the same size can share them'''
+    w0, h0, ht = monthGeometry(box)
+    return (pics.fitFontSize(args.fontBold, dayNames(args), (w0-4, ht-4),
+                             True),
+            pics.fitFontSize(args.fontBold, '88', (w0-8, h0-8), True))
+
+
+def drawDayNames(args, image, box, font=None):
+    x0, y0, x1, y1 = box
+    w0, h0, ht = monthGeometry(box)
+
+    days = dayNames(args)
+    font = font or monthFonts(args, box)[0]
     for i in range(7):
         bx = (x0 + w0*i, y0, x0 + w0*(i+1), y0+ht)
-        image.drw.rectangle(bx,
-                            args.monthboxTitleBgColor,
-                            args.monthboxTitleBorderColor)
+        image.draw.rectangle(bx,
+                             args.monthboxTitleBgColor,
+                             args.monthboxTitleBorderColor)
         pics.textDraw(image, bx, days[i],
                       args.monthboxTitleColor, font)
 
-    font = pics.fitFontSize(args.fontBold, '88', (w0-8, h0-8), True)
-    evs = args.events[:]
+
+def firstDayShown(args, first):
+    '''First day shown in a month box for the month starting on first'''
+    while first.weekday() != args.monthboxFirstDay:
+        first -= datetime.timedelta(1)
+    return first
+
+
+def drawMonth(args, image, box, first, today=None, daysOff=None, font=None):
+    '''Draw the dates (6 weeks) of the month starting on first. today (if
+    any) is marked, and daysOff is the set of days marked as days off from
+    the events (default: from args.events)'''
+    x0, y0, x1, y1 = box
+    w0, h0, ht = monthGeometry(box)
+
+    day0 = firstDayShown(args, first)
+    font = font or monthFonts(args, box)[1]
+    if daysOff is None:
+        daysOff = toStore(args.events).daysOff(
+            day0, day0 + datetime.timedelta(6*7-1))
     for week in range(6):
         for i in range(7):
             day = day0+datetime.timedelta(week*7+i)
 
             # determine whether today should be marked
-            markAsDayOff = False
-            while evs[0].date < day:
-                del evs[0]
-            while evs[0].date == day:
-                if evs[0].markAsDayOff():
-                    markAsDayOff = True
-                del evs[0]
+            markAsDayOff = day in daysOff
 
             bx = (x0 + w0*i,     y0+ht+h0*week,
                   x0 + w0*(i+1), y0+ht+h0*(week+1))
-            if day.month != args.date.month:
+            if day.month != first.month:
                 color = args.monthboxOthermonthColor
                 bgcolor = args.monthboxOthermonthBgColor
-            elif day == args.date:
+            elif day == today:
                 color = args.monthboxTodayColor
                 bgcolor = args.monthboxTodayBgColor
             elif day.weekday() in args.monthboxDayoff or markAsDayOff:
@@ -226,7 +572,21 @@ def month(args, f, image, box):
                 color = args.monthboxDefaultColor
                 bgcolor = args.monthboxDefaultBgColor
 
-            image.drw.rectangle(bx,
-                                bgcolor,
-                                None and args.monthboxBorderColor)
+            image.draw.rectangle(bx,
+                                 bgcolor,
+                                 None and args.monthboxBorderColor)
             pics.textDraw(image, bx, str(day.day), color, font)
+
+
+def monthTitle(args, f, image, box):
+    '''Draw names of days'''
+    drawDayNames(args, image, box)
+
+
+@boxType('m', options=monthOptions, title='monthly calendar',
+         help='''Show a calendar with all days in the current month.
+If --event-file is used, some dates can be colormarked as days off.''',
+         static=monthTitle)
+def month(args, f, image, box):
+    '''Draw a calendar. Always 6 weeks + names of days'''
+    drawMonth(args, image, box, args.date.replace(day=1), args.date)
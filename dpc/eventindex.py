@@ -0,0 +1,371 @@
+#
+# -*- encoding: utf-8 -*-
+#
+# Shared event index: all events of a list of event files (.txt and .ics)
+# merged into one file, which is memory mapped by every process using it,
+# e.g., a farm of dpc-single processes using the same --event-index. The
+# first process finds that the index is missing or older than one of the
+# event files, builds it (while holding a lock, so the others wait instead
+# of also building it) and replaces it atomically. Processes check the
+# event files and the index at most every RELOAD_INTERVAL seconds, and map
+# the new index when it has been replaced, i.e., all see the same events.
+#
+# Index file: a header, the stamp (mtime, size) of each event file, one
+# array per field of the events (date as ordinal, type, text, age) and of
+# the rules (spec, type, text), a byte per day telling whether it is a day
+# off (from MINDAY to MAXDAY in the header), and the strings (utf-8, with
+# an array of offsets, so a string is only decoded when used)
+#
+
+import array
+import bisect
+import contextlib
+import datetime
+import mmap
+import os
+import struct
+import threading
+import time
+
+from . import events
+from . import files
+from . import ics
+from . import log
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+INDEX_MAGIC = b'DPCI'
+INDEX_VERSION = 2 << 8 | events.PARSER_VERSION  # format and parser version
+RELOAD_INTERVAL = 1.
+_HEADER = struct.Struct('<4sHHHxxIIIIIii')
+_SOURCE = struct.Struct('<qq')
+
+
+def _stamps(names):
+    '''(mtime, size) of each file in names'''
+    res = []
+    for fn in names:
+        st = os.stat(fn)
+        res.append((st.st_mtime_ns, st.st_size))
+    return res
+
+
+def readSources(names):
+    '''Read and merge all events in the files names, i.e., the same as
+    dpc-single does without an index (but for all years)'''
+    start = datetime.date(events.MINYEAR, 1, 1)
+    end = datetime.date(events.MAXYEAR, 12, 31)
+    lists, rules = [], []
+    for fn in names:
+        with open(fn, encoding='utf-8') as fd:
+            if fn.lower().endswith('.ics'):
+                lists.append(ics.readIcsFile(fd, start, end))
+            else:
+                lists.append(events.readEventFile(fd, rules))
+    return events.mergeEvents(lists), events.mergeRules(rules)
+
+
+def writeIndex(path, names):
+    '''Build the index of the event files names in path'''
+    stamps = _stamps(names)
+    evs, rules = readSources(names)
+
+    strings, index = [], {}
+
+    def intern(s):
+        if s not in index:
+            index[s] = len(strings)
+            strings.append(s)
+        return index[s]
+
+    # days off (also from rules) as a byte per day
+    minday = datetime.date(events.MINYEAR, 1, 1).toordinal()
+    maxday = datetime.date(events.MAXYEAR, 12, 31).toordinal()
+    if evs:
+        minday = min(minday, evs[0].date.toordinal())
+        maxday = max(maxday, evs[-1].date.toordinal())
+    daysOff = bytearray(maxday - minday + 1)
+    for ev in evs:
+        if ev.markAsDayOff():
+            daysOff[ev.date.toordinal() - minday] = 1
+    for rule in rules:
+        if 'm' in rule.tp:
+            for ev in rule.between(datetime.date.fromordinal(minday),
+                                   datetime.date.fromordinal(maxday)):
+                daysOff[ev.date.toordinal() - minday] = 1
+
+    arrays = [
+        array.array('I', (intern(fn) for fn in names)),
+        array.array('i', (ev.date.toordinal() for ev in evs)),
+        array.array('I', (intern(ev.tp) for ev in evs)),
+        array.array('I', (intern(ev.text) for ev in evs)),
+        array.array('i', (-1 if ev.age is None else ev.age for ev in evs)),
+        array.array('I', (intern(rule.spec) for rule in rules)),
+        array.array('I', (intern(rule.tp) for rule in rules)),
+        array.array('I', (intern(rule.text) for rule in rules)),
+    ]
+    blobs = list(s.encode('utf-8') for s in strings)
+    offsets = array.array('I', [0])
+    for blob in blobs:
+        offsets.append(offsets[-1] + len(blob))
+    arrays.append(offsets)
+
+    with files.atomicFile(path) as fd:
+        fd.write(_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, events.MINYEAR,
+                              events.MAXYEAR, len(names), len(evs),
+                              len(rules), len(strings), len(daysOff),
+                              minday, maxday))
+        for stamp in stamps:
+            fd.write(_SOURCE.pack(*stamp))
+        for arr in arrays:
+            fd.write(arr.tobytes())
+        fd.write(daysOff)
+        fd.write(b''.join(blobs))
+    log.debug('eventindex', 'Wrote', path, 'with', len(evs), 'events and',
+              len(rules), 'rules from', len(names), 'files')
+
+
+class _IndexView:
+    '''One mapping of the index file. It is not changed once it is valid,
+    i.e., EventIndex replaces the whole view when the index is reloaded'''
+
+    def __init__(self, mm, stamp):
+        self.mm = mm
+        self.stamp = stamp
+        self.users = 0
+        self.retired = False
+        self._views = []
+        self._strings = {}
+
+    def load(self, names):
+        '''Read the header and arrays. Returns False if the index is not
+        valid for the event files names'''
+        mm = self.mm
+        if len(mm) < _HEADER.size:
+            return False
+        (magic, version, minyear, maxyear, nsources, n, nrules, nstrings,
+         ndays, minday, maxday) = _HEADER.unpack_from(mm)
+        if (magic, version, minyear, maxyear, nsources) != \
+           (INDEX_MAGIC, INDEX_VERSION, events.MINYEAR, events.MAXYEAR,
+                len(names)):
+            return False
+        size = _HEADER.size + nsources * _SOURCE.size + ndays + \
+            4 * (nsources + 4 * n + 3 * nrules + nstrings + 1)
+        if len(mm) < size:
+            return False
+
+        mv = memoryview(mm)
+        pos = _HEADER.size
+        self.sources = list(_SOURCE.unpack_from(mm, pos + i * _SOURCE.size)
+                            for i in range(nsources))
+        pos += nsources * _SOURCE.size
+        fields = []
+        for tc, count in zip('IiIIiIIII', (nsources, n, n, n, n, nrules,
+                                           nrules, nrules, nstrings + 1)):
+            end = pos + 4 * count
+            fields.append(mv[pos:end].cast(tc))
+            pos = end
+        self.daysOffPos = pos
+        pos += ndays
+        self.blob = mv[pos:]
+        self.offsets = fields[-1]
+        # released (before the mmap is closed) by close
+        self._views = [mv, self.blob] + fields
+        if len(self.blob) != self.offsets[-1] or \
+           tuple(map(self.string, fields[0])) != names:
+            return False
+
+        self.ords, self.tps, self.texts, self.ages = fields[1:5]
+        self.minday, self.maxday = minday, maxday
+        self.rules = list(events.EventRule(*map(self.string, spec))
+                          for spec in zip(*fields[5:8]))
+        return True
+
+    def string(self, i):
+        if i not in self._strings:
+            blob = self.blob[self.offsets[i]:self.offsets[i+1]]
+            self._strings[i] = str(blob, 'utf-8')
+        return self._strings[i]
+
+    def stale(self, names):
+        try:
+            return _stamps(names) != self.sources
+        except OSError:
+            return False
+
+    def close(self):
+        for mv in reversed(self._views):
+            mv.release()
+        self._views = []
+        self.mm.close()
+
+
+def _mapIndex(path, names):
+    '''Map the index file path. Returns an _IndexView, or None if it is
+    missing or not valid for the event files names'''
+    try:
+        with open(path, 'rb') as fd:
+            st = os.fstat(fd.fileno())
+            mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    view = _IndexView(mm, (st.st_ino, st.st_mtime_ns, st.st_size))
+    if not view.load(names):
+        view.close()
+        return None
+    log.debug('eventindex', 'Mapped', path, len(view.ords), 'events')
+    return view
+
+
+class EventIndex(events.EventStore):
+    '''Same as an EventStore, but using the (memory mapped) index in path of
+    the event files names. Only the path and names are pickled, i.e.,
+    worker processes map the same index. The index may be used (and
+    reloaded) by several threads'''
+
+    def __init__(self, path, names):
+        self.path = path
+        self.names = tuple(names)
+        self._init()
+        self._open(True)
+
+    def __getstate__(self):
+        return {'path': self.path, 'names': self.names}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init()
+        self._open(False)
+
+    def _init(self):
+        self._view = None
+        # protects self._view and the users of each view
+        self._lock = threading.Lock()
+        # held by the thread checking/reloading the index
+        self._reloading = threading.Lock()
+
+    def _open(self, build):
+        '''Map the index (and use it instead of the current mapping). If
+        build is true, the index is (re)built first if it is missing or out
+        of date'''
+        if build:
+            lockfd = None
+            if fcntl is not None:
+                dn = os.path.dirname(self.path)
+                if dn:
+                    os.makedirs(dn, exist_ok=True)
+                lockfd = open(self.path + '.lock', 'a')
+                fcntl.flock(lockfd, fcntl.LOCK_EX)
+            try:
+                view = _mapIndex(self.path, self.names)
+                if view is None or view.stale(self.names):
+                    if view is not None:
+                        view.close()
+                    writeIndex(self.path, self.names)
+                    view = _mapIndex(self.path, self.names)
+            finally:
+                if lockfd is not None:
+                    lockfd.close()
+        else:
+            view = _mapIndex(self.path, self.names)
+        if view is None:
+            raise ValueError('%s is not a valid event index' % self.path)
+
+        with self._lock:
+            old, self._view = self._view, view
+            if old is not None:
+                old.retired = True
+                unused = not old.users
+        if old is not None and unused:
+            old.close()
+        self._checked = time.monotonic()
+
+    @contextlib.contextmanager
+    def _using(self):
+        '''The current view of the index, which is not closed until it is no
+        longer used (even if the index is reloaded meanwhile)'''
+        with self._lock:
+            view = self._view
+            view.users += 1
+        try:
+            yield view
+        finally:
+            with self._lock:
+                view.users -= 1
+                unused = view.retired and not view.users
+            if unused:
+                view.close()
+
+    def refresh(self):
+        '''Map the index again if it (or an event file) has changed. Done
+        at most every RELOAD_INTERVAL seconds (and by one thread at a time,
+        the others use the current mapping meanwhile)'''
+        if time.monotonic() - self._checked < RELOAD_INTERVAL or \
+           not self._reloading.acquire(False):
+            return
+        try:
+            now = time.monotonic()
+            if now - self._checked < RELOAD_INTERVAL:
+                return
+            self._checked = now
+            view = self._view
+            try:
+                st = os.stat(self.path)
+                replaced = (st.st_ino, st.st_mtime_ns, st.st_size) != \
+                    view.stamp
+            except OSError:
+                replaced = True
+            if replaced or view.stale(self.names):
+                log.info('eventindex', 'Reloading', self.path)
+                self._open(True)
+        finally:
+            self._reloading.release()
+
+    @property
+    def rules(self):
+        return self._view.rules
+
+    def between(self, start, end):
+        '''Sorted list of all events from start to end (both included)'''
+        self.refresh()
+        with self._using() as view:
+            i = bisect.bisect_left(view.ords, start.toordinal())
+            j = bisect.bisect_right(view.ords, end.toordinal())
+            fromordinal = datetime.date.fromordinal
+            res = list(events.Event(fromordinal(view.ords[k]),
+                                    view.string(view.tps[k]),
+                                    view.string(view.texts[k]),
+                                    None if view.ages[k] < 0 else
+                                    view.ages[k])
+                       for k in range(i, j))
+            rules = view.rules
+        if rules:
+            for rule in rules:
+                res += rule.between(start, end)
+            res.sort()
+        return res
+
+    def daysOff(self, start, end):
+        '''Set of dates from start to end marked as days off'''
+        self.refresh()
+        with self._using() as view:
+            # the byte of day d is at pos + d
+            pos = view.daysOffPos - view.minday
+            a = pos + max(start.toordinal(), view.minday)
+            b = pos + min(end.toordinal(), view.maxday) + 1
+            res = set()
+            i = view.mm.find(b'\x01', a, b)
+            while i >= 0:
+                res.add(datetime.date.fromordinal(i - pos))
+                i = view.mm.find(b'\x01', i + 1, b)
+        return res
+
+    def __len__(self):
+        with self._using() as view:
+            return len(view.ords) + len(view.rules)
+
+    def __repr__(self):
+        return 'EventIndex(%r)' % self.path
@@ -13,6 +13,8 @@ DATE
 Dates must be in the format YYYY-MM-DD.
 OR in the format EASTER+DD or EASTER-DD
 where DD is a number of days after/before easter.
+WHITSUN (Whit Sunday) and ADVENT (the first Sunday of Advent) can be used
+in the same way as EASTER.
 
 Use the year 8888, if the year should not be used/shown, e.g.,
 Christmas day, 8888-12-25
@@ -24,7 +26,10 @@ TYPE
  'm'  # general holiday/event day off (marked as Sunday)
  '='  # do not repeat this event yearly
 
-Dates with 8888 or EASTER implies =
+Dates with 8888, EASTER, WHITSUN or ADVENT implies =
+
+OR a rule for recurring dates, e.g., second Tuesday of every month:
+2024-01-01/FREQ=MONTHLY/BYDAY=2TU (see rules.py for the details)
 
 TEXT
 ----
@@ -32,32 +37,39 @@ Any non empty string. If type contains d, (1 year) or (xx years) is added
 
 '''
 
+import array
 import datetime
-import locale
+import hashlib
+import os
 import re
+import bisect
+import heapq
+import operator
+import struct
 
+from . import locales
 from . import log
+from . import rules as rrules
 
 # MIN/MAX year for which we generate events
 MINYEAR = 1980
 MAXYEAR = 2100
 
+# Bump whenever the events read from an event file change (readEventFile,
+# rules.py or ics.py), so that snapshots and event indexes made by an older
+# parser are not used
+PARSER_VERSION = 3
 
-def yearText(n):
-    loc = locale.getlocale()
-    if isinstance(loc, tuple):
-        loc = loc[0]
-    if loc and loc.startswith('da'):
-        yt = '%d år', '%d år'
-    elif loc and loc.startswith('de'):
-        yt = '%d Jahre', '%d Jahren'
-    else:
-        yt = '%d year', '%d years'
-    yt = yt[1] if n != 1 else yt[0]
-    return yt % n
 
+def yearText(n, table=None):
+    '''Text for an age of n years, e.g., "3 years", using table or the
+    locale of the process (see locales.defaultTable)'''
+    if table is None:
+        table = locales.defaultTable()
+    return table.yearText(n)
 
-def easter(year):
+
+def _easter(year):
     '''Returns date of Easter as a date object using magic
 From http://code.activestate.com/recipes/576517/'''
     a = year % 19
@@ -71,11 +83,67 @@ From http://code.activestate.com/recipes/576517/'''
     return datetime.date(year, month, day)
 
 
+def _advent(year):
+    '''First Sunday of Advent, i.e., four Sundays before Christmas Day'''
+    dec24 = datetime.date(year, 12, 24)
+    return dec24 - datetime.timedelta((dec24.weekday() + 1) % 7 + 21)
+
+
+# anchor -> year -> date
+ANCHORS = {
+    'easter': _easter,
+    'whitsun': lambda year: _easter(year) + datetime.timedelta(49),
+    'advent': _advent,
+}
+_anchors = {}
+# (anchor, days after) or (month, day) -> dates for MINYEAR..MAXYEAR
+_yearly = {}
+
+
+def anchor(name, year):
+    '''Date of the anchor name (see ANCHORS) in year'''
+    key = name, year
+    if key not in _anchors:
+        _anchors[key] = ANCHORS[name](year)
+    return _anchors[key]
+
+
+def easter(year):
+    return anchor('easter', year)
+
+
+def anchorDates(name, delta=0):
+    '''Tuple of the dates delta days after the anchor name for each year
+    from MINYEAR to MAXYEAR (shared by all event files)'''
+    key = name, delta
+    if key not in _yearly:
+        td = datetime.timedelta(delta)
+        _yearly[key] = tuple(anchor(name, year) + td
+                             for year in range(MINYEAR, MAXYEAR+1))
+    return _yearly[key]
+
+
+def yearlyDates(month, day):
+    '''Tuple of month/day for each year from MINYEAR to MAXYEAR'''
+    key = month, day
+    if key not in _yearly:
+        _yearly[key] = tuple(datetime.date(year, month, day)
+                             for year in range(MINYEAR, MAXYEAR+1))
+    return _yearly[key]
+
+
 class Event:
-    def __init__(self, date, tp, text):
+    def __init__(self, date, tp, text, age=None):
         self.date = date
         self.tp = tp
         self.text = text
+        self.age = age
+
+    def getText(self, table=None):
+        '''Text to show, i.e., including (xx years) for birthdays'''
+        if self.age is None:
+            return self.text
+        return '%s (%s)' % (self.text, yearText(self.age, table))
 
     def between(self, start, end):
         return start <= self.date <= end
@@ -87,9 +155,128 @@ class Event:
         return self.date < other.date
 
     def __repr__(self):
+        if self.age is not None:
+            return 'Event(%r, %r, %r, %r)' % (self.date, self.tp, self.text,
+                                              self.age)
         return 'Event(%r, %r, %r)' % (self.date, self.tp, self.text)
 
-def readEventFile(fd):
+
+class EventRule:
+    '''Recurring event, i.e., a rules.Rule + type and text'''
+    def __init__(self, spec, tp, text):
+        self.spec = spec
+        self.rule = rrules.Rule.parse(spec)
+        self.tp = tp
+        self.text = text
+
+    def between(self, start, end):
+        start = max(start, datetime.date(MINYEAR, 1, 1))
+        end = min(end, datetime.date(MAXYEAR, 12, 31))
+        res = []
+        for date in self.rule.between(start, end):
+            age = date.year - self.rule.start.year if 'd' in self.tp else None
+            res.append(Event(date, self.tp, self.text, age))
+        return res
+
+    def __repr__(self):
+        return 'EventRule(%r, %r, %r)' % (self.spec, self.tp, self.text)
+
+
+class EventStore:
+    '''All events (sorted) and all recurring events, i.e., rules'''
+    def __init__(self, events=(), rules=()):
+        self.events = sorted(events)
+        self.dates = list(ev.date for ev in self.events)
+        self.rules = list(rules)
+
+    def between(self, start, end):
+        '''Sorted list of all events from start to end (both included)'''
+        i = bisect.bisect_left(self.dates, start)
+        j = bisect.bisect_right(self.dates, end)
+        res = self.events[i:j]
+        if self.rules:
+            for rule in self.rules:
+                res += rule.between(start, end)
+            res.sort()
+        return res
+
+    def daysOff(self, start, end):
+        '''Set of dates from start to end marked as days off'''
+        return set(ev.date for ev in self.between(start, end)
+                   if ev.markAsDayOff())
+
+    def __len__(self):
+        return len(self.events) + len(self.rules)
+
+
+def normaliseText(text):
+    '''Text used when comparing events, i.e., ignoring case, punctuation
+    and whitespace'''
+    return ' '.join(re.findall(r'\w+', text.lower()))
+
+
+def mergeEvents(lists):
+    '''Merge sorted lists of events (e.g., one per event file) into one
+    sorted list. Events with the same date and (normalised) text are only
+    included once with all types combined, i.e., if any of them is a day
+    off, so is the merged event. Conflicts are reported'''
+    res, conflicts = [], 0
+    seen = {}  # normalised text -> index in res of event on the same date
+    for ev in heapq.merge(*lists):
+        if res and res[-1].date != ev.date:
+            seen = {}
+        key = normaliseText(ev.text)
+        if key not in seen:
+            seen[key] = len(res)
+            res.append(ev)
+            continue
+
+        first = res[seen[key]]
+        if first.tp != ev.tp or first.age != ev.age:
+            conflicts += 1
+            log.debug('events', 'Conflict: %r and %r' % (first, ev))
+        tp = set(first.tp + ev.tp)
+        if 'd' in tp:
+            tp.discard('g')
+        tp = ''.join(sorted(tp))
+        if tp != first.tp:
+            # never change an event which may be used elsewhere
+            res[seen[key]] = Event(first.date, tp, first.text, first.age)
+
+    if len(res) != sum(map(len, lists)):
+        log.debug('events', 'Merged %d events into %d'
+                  % (sum(map(len, lists)), len(res)))
+    if conflicts:
+        log.info('events', '%d duplicate events with different types or '
+                 'ages (use -v to see them)' % conflicts)
+    return res
+
+
+def mergeRules(rules):
+    '''Remove duplicate rules (same rule and normalised text)'''
+    res, seen = [], set()
+    for rule in rules:
+        key = rule.spec, normaliseText(rule.text)
+        if key not in seen:
+            seen.add(key)
+            res.append(rule)
+    return res
+
+
+def toStore(evs):
+    '''Return evs as an EventStore (evs can also be a list of events)'''
+    if isinstance(evs, EventStore):
+        return evs
+    return EventStore(evs or ())
+
+
+_ANCHOR_RE = re.compile(r'(?i)^(%s)([-+]\d+)?$' % '|'.join(ANCHORS))
+_DATE = operator.attrgetter('date')
+
+
+def readEventFile(fd, rules=None):
+    '''Return a sorted list of all events in fd. Recurring events are
+    appended to the list rules if given, otherwise they are expanded'''
     events = []
     for i, line in enumerate(fd):
         premsg = 'events-%s:%d' % (fd.name, i)
@@ -128,20 +315,31 @@ def readEventFile(fd):
             tp = tp.remove('g')
 
         # check the date
-        m = re.match(r'(?i)^easter([-+]\d+)?$', dt)
+        if '/' in dt:
+            try:
+                rule = EventRule(dt, tp.replace('=', ''), text)
+            except ValueError as e:
+                log.error(premsg, 'Invalid rule %r: %s' % (dt, e))
+                continue
+            if rules is not None:
+                rules.append(rule)
+            else:
+                events += rule.between(datetime.date(MINYEAR, 1, 1),
+                                       datetime.date(MAXYEAR, 12, 31))
+            continue
+
+        m = _ANCHOR_RE.match(dt)
         if m:
-            delta = m.group(1)
+            name, delta = m.groups()
             delta = 0 if delta is None else int(delta)
-            delta = datetime.timedelta(delta)
 
             if '=' not in tp:
                 tp += '='
             if 'd' in tp:
                 tp = tp.remove('d')
 
-            for year in range(MINYEAR, MAXYEAR+1):
-                date = easter(year) + delta
-                events.append(Event(date, tp, text))
+            events += (Event(date, tp, text)
+                       for date in anchorDates(name.lower(), delta))
             continue
 
         # normal date
@@ -155,9 +353,8 @@ def readEventFile(fd):
         if dt.year == 8888:
             if '=' not in tp:
                 tp += '='
-            for year in range(MINYEAR, MAXYEAR+1):
-                date = dt.replace(year=year)
-                events.append(Event(date, tp, text))
+            events += (Event(date, tp, text)
+                       for date in yearlyDates(dt.month, dt.day))
             continue
 
         # regular date, e.g., birthday
@@ -165,13 +362,155 @@ def readEventFile(fd):
             events.append(Event(dt, tp, text))
             continue
 
-        for year in range(max(dt.year, MINYEAR), MAXYEAR+1):
-            date = dt.replace(year=year)
-            txt = text
-            if 'd' in tp:
-                txt += ' (%s)' % yearText(year-dt.year)
-            events.append(Event(date, tp, txt))
+        dates = yearlyDates(dt.month, dt.day)
+        first = max(dt.year, MINYEAR) - MINYEAR
+        if 'd' in tp:
+            events += (Event(date, tp, text, date.year - dt.year)
+                       for date in dates[first:])
+        else:
+            events += (Event(date, tp, text) for date in dates[first:])
         continue
 
-    events.sort()
+    # same order as sorting the events, but compares dates directly
+    events.sort(key=_DATE)
+    return events
+
+
+#
+# Compiled snapshots of event files
+#
+# A snapshot contains a header followed by four arrays with one entry per
+# event (date as ordinal, index of type, index of text, age or -1), three
+# arrays with one entry per rule (index of rule, type and text) and the
+# string table (utf-8, separated by \0). The snapshot is used if the event
+# file has the same mtime and size, or else the same sha1 as when the
+# snapshot was made.
+#
+
+CACHE_DN = os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                        os.path.expanduser(os.path.join('~', '.cache')),
+                        'dpc', 'events')
+
+SNAPSHOT_MAGIC = b'DPCE'
+SNAPSHOT_VERSION = 3 << 8 | PARSER_VERSION  # format and parser version
+_HEADER = struct.Struct('<4sHHHqq20sIII')
+
+
+def snapshotPath(fn, cacheDir=CACHE_DN):
+    key = hashlib.sha1(os.path.abspath(fn).encode('utf-8')).hexdigest()
+    return os.path.join(cacheDir, key + '.evc')
+
+
+def writeSnapshot(path, st, digest, events, rules=()):
+    strings, index = [], {}
+
+    def intern(s):
+        if s not in index:
+            index[s] = len(strings)
+            strings.append(s)
+        return index[s]
+
+    arrays = [
+        array.array('i', (ev.date.toordinal() for ev in events)),
+        array.array('I', (intern(ev.tp) for ev in events)),
+        array.array('I', (intern(ev.text) for ev in events)),
+        array.array('i', (-1 if ev.age is None else ev.age
+                          for ev in events)),
+        array.array('I', (intern(rule.spec) for rule in rules)),
+        array.array('I', (intern(rule.tp) for rule in rules)),
+        array.array('I', (intern(rule.text) for rule in rules)),
+    ]
+    blob = '\0'.join(strings).encode('utf-8')
+
+    header = _HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, MINYEAR, MAXYEAR,
+                          st.st_mtime_ns, st.st_size, digest,
+                          len(events), len(rules), len(blob))
+
+    # write to a temporary file, so a snapshot is never half written
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as fd:
+        fd.write(header)
+        for arr in arrays:
+            fd.write(arr.tobytes())
+        fd.write(blob)
+    os.replace(tmp, path)
+
+
+def readSnapshot(path, st, digest=None):
+    '''Return (events, rules) from the snapshot in path. If digest is None,
+    the snapshot must match the mtime and size in st, otherwise the digest.
+    Returns None if there is no (valid) snapshot'''
+    try:
+        with open(path, 'rb') as fd:
+            data = fd.read()
+    except OSError:
+        return None
+    if len(data) < _HEADER.size:
+        return None
+
+    (magic, version, minyear, maxyear, mtime, size, sdigest,
+     n, nrules, blobsize) = _HEADER.unpack_from(data)
+    if (magic, version, minyear, maxyear) != \
+            (SNAPSHOT_MAGIC, SNAPSHOT_VERSION, MINYEAR, MAXYEAR):
+        return None
+    if digest is None:
+        if (mtime, size) != (st.st_mtime_ns, st.st_size):
+            return None
+    elif digest != sdigest:
+        return None
+
+    arrays, pos = [], _HEADER.size
+    for tc, count in zip('iIIiIII', (n, n, n, n, nrules, nrules, nrules)):
+        arr = array.array(tc)
+        end = pos + arr.itemsize * count
+        arr.frombytes(data[pos:end])
+        arrays.append(arr)
+        pos = end
+    if len(data) != pos + blobsize:
+        return None
+    strings = data[pos:].decode('utf-8').split('\0')
+
+    fromordinal = datetime.date.fromordinal
+    events = list(Event(fromordinal(o), strings[tp], strings[text],
+                        None if age < 0 else age)
+                  for o, tp, text, age in zip(*arrays[:4]))
+    rules = list(EventRule(strings[spec], strings[tp], strings[text])
+                 for spec, tp, text in zip(*arrays[4:]))
+    return events, rules
+
+
+def readEventFileCached(fd, cacheDir=CACHE_DN, rules=None):
+    '''Same as readEventFile(fd, rules), but use/update a compiled snapshot
+    in cacheDir'''
+    try:
+        st = os.stat(fd.name)
+    except (OSError, TypeError):
+        return readEventFile(fd, rules)  # e.g., stdin
+    path = snapshotPath(fd.name, cacheDir)
+
+    snapshot = readSnapshot(path, st)
+    if snapshot is None:
+        with open(fd.name, 'rb') as bfd:
+            digest = hashlib.sha1(bfd.read()).digest()
+        snapshot = readSnapshot(path, st, digest)
+        if snapshot is None:
+            frules = []
+            snapshot = readEventFile(fd, frules), frules
+        try:
+            writeSnapshot(path, st, digest, *snapshot)
+            log.debug('events', 'Wrote snapshot', path, 'for', fd.name)
+        except OSError as e:
+            log.debug('events', 'Cannot write snapshot', path, e)
+    else:
+        log.debug('events', 'Using snapshot', path, 'for', fd.name)
+
+    events, frules = snapshot
+    if rules is not None:
+        rules += frules
+    elif frules:
+        for rule in frules:
+            events += rule.between(datetime.date(MINYEAR, 1, 1),
+                                   datetime.date(MAXYEAR, 12, 31))
+        events.sort()
     return events
@@ -0,0 +1,128 @@
+#
+# -*- encoding: utf-8 -*-
+#
+# Background file I/O: pictures are read ahead in other threads (e.g. from
+# slow network shares) while pages are drawn, and output files are written
+# atomically, i.e., a half-written file is never left behind
+#
+
+import collections
+import concurrent.futures
+import contextlib
+import io
+import os
+import tempfile
+import threading
+
+from . import log
+
+# mkstemp only gives access to the owner
+_UMASK = os.umask(0o22)
+os.umask(_UMASK)
+
+
+class Prefetcher:
+    '''Read the contents of files in up to threads background threads. At
+    most ahead files are read (or being read) before they are used, i.e.,
+    the reading stays a few files ahead of the files being used'''
+
+    def __init__(self, threads=2, ahead=2):
+        self._pool = concurrent.futures.ThreadPoolExecutor(max(1, threads))
+        self.ahead = max(1, ahead)
+        self._waiting = collections.deque()
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def prefetch(self, fds):
+        '''Read all (already opened) files in fds in this order'''
+        with self._lock:
+            names = set(self._futures)
+            names.update(fd.name for fd in self._waiting)
+            for fd in fds:
+                if fd.name not in names:
+                    names.add(fd.name)
+                    self._waiting.append(fd)
+            self._start()
+
+    def _start(self):
+        while self._waiting and len(self._futures) < self.ahead:
+            fd = self._waiting.popleft()
+            log.debug('files', 'Prefetching', fd.name)
+            self._futures[fd.name] = fd, self._pool.submit(fd.read)
+
+    def get(self, fd):
+        '''Return a file object with the contents of fd. Waits for the
+        file to be read'''
+        with self._lock:
+            if fd.name not in self._futures:
+                # not read yet, so read it now
+                for other in list(self._waiting):
+                    if other.name == fd.name:
+                        self._waiting.remove(other)
+                        if other is not fd:
+                            other.close()
+                self._futures[fd.name] = fd, self._pool.submit(fd.read)
+            read, future = self._futures[fd.name]
+        try:
+            data = future.result()
+        finally:
+            with self._lock:
+                del self._futures[fd.name]
+                self._start()
+            read.close()
+            fd.close()
+        return io.BytesIO(data)
+
+    def close(self):
+        with self._lock:
+            for fd in self._waiting:
+                fd.close()
+            self._waiting.clear()
+        self._pool.shutdown()
+
+
+def syncDir(dn):
+    '''Make the files renamed into the directory dn durable (where the
+    system supports syncing a directory)'''
+    try:
+        fd = os.open(dn or '.', os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+@contextlib.contextmanager
+def atomicFile(fn):
+    '''Context manager returning a file object for writing to fn. The data
+    is written to a temporary file in the same directory, which is synced
+    to disk and renamed to fn when done (and removed in case of errors).
+    The directory is synced after the rename, i.e., fn is on the disk when
+    the context ends'''
+    dn = os.path.dirname(fn)
+    if dn and not os.path.isdir(dn):
+        log.debug('files', 'mkdir', dn)
+        os.makedirs(dn, exist_ok=True)
+    fd, tmpfn = tempfile.mkstemp(dir=dn or '.', suffix='.tmp',
+                                 prefix='.%s.' % os.path.basename(fn))
+    try:
+        with os.fdopen(fd, 'wb') as fd:
+            yield fd
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.chmod(tmpfn, 0o666 & ~_UMASK)
+        os.replace(tmpfn, fn)
+    except BaseException:
+        os.unlink(tmpfn)
+        raise
+    syncDir(dn)
+
+
+def writeAtomic(fn, data):
+    '''Write data to the file fn (see atomicFile)'''
+    with atomicFile(fn) as fd:
+        fd.write(data)
@@ -0,0 +1,218 @@
+#! /usr/bin/env python3
+# -*- encoding: utf-8 -*-
+#
+# Golden image regression check: render a fixed matrix of pages and compare
+# them with stored (golden) images, e.g., before/after optimising the
+# renderer
+#
+#   python3 -m dpc.golden --update     # store the current pages
+#   python3 -m dpc.golden              # compare with the stored pages
+#
+
+import argparse
+import concurrent.futures
+import itertools
+import locale
+import os
+import sys
+import tempfile
+
+import PIL.Image
+import PIL.ImageChops
+import PIL.ImageDraw
+import PIL.ImageFilter
+
+from . import locales
+from . import log
+from . import single
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DATES = ('2024-01-01', '2024-03-28', '2024-12-24')
+FORMATS = ('tmde', 'bdse', 'tsme~bems')
+PICTURES = ('landscape', 'portrait')
+# C is always available, the other locales only where installed
+LOCALES = ('C', 'en_US', 'da_DK')
+SIZE = '600x525'
+
+RESOURCES_DN = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                            'resources')
+EVENTS_DN = os.path.join(RESOURCES_DN, 'events')
+GOLDEN_DN = os.path.join(RESOURCES_DN, 'golden')
+EVENT_FILES = ('danish.txt', 'danish-extended.txt')
+
+
+def makePicture(fn, size):
+    '''Write a fixed picture with gradients, edges and some small details'''
+    w, h = size
+    image = PIL.Image.linear_gradient('L').resize(size)
+    image = PIL.Image.merge('RGB', (image, image.transpose(
+        PIL.Image.ROTATE_90).resize(size), PIL.Image.new('L', size, 96)))
+    draw = PIL.ImageDraw.Draw(image)
+    for i in range(8):
+        x, y = w * i // 8, h * (7 - i) // 8
+        draw.ellipse((x, y, x + w // 10, y + h // 10),
+                     (255, 255 - 30*i, 30*i))
+        draw.line((0, y, w, h - y), (0, 0, 0), 3)
+    image.save(fn)
+
+
+def cases():
+    '''All (name, picture, locale, options) in the matrix'''
+    res = []
+    for date, fmt, pic, loc in itertools.product(DATES, FORMATS, PICTURES,
+                                                 LOCALES):
+        name = '%s-%s-%s-%s' % (date, fmt.replace('~', '_'), pic, loc)
+        res.append((name, pic, loc, ['-d', date, '-f', fmt, '--size', SIZE,
+                                     '--locale', loc, '--text', name]))
+    return res
+
+
+def render(case):
+    '''Render a single case into outdir (in a worker process)'''
+    name, picture, argv, outdir = case
+    argv = argv + ['-p', picture, '--event-cache', '']
+    for fn in EVENT_FILES:
+        argv += ['-e', os.path.join(EVENTS_DN, fn)]
+    fn = os.path.join(outdir, name + '.png')
+    single.main(argv + ['-o', fn])
+    return fn
+
+
+def _luminance(image):
+    '''Luminance (as float array) slightly blurred, so that single pixel
+    anti-aliasing shifts are less important'''
+    a = numpy.asarray(image.convert('L'), dtype=numpy.float32)
+    p = numpy.pad(a, 1, mode='edge')
+    return sum(p[dy:dy + a.shape[0], dx:dx + a.shape[1]]
+               for dy in range(3) for dx in range(3)) / 9
+
+
+def diff(a, b, tolerance=8, grid=8):
+    '''Compare the images a and b. Returns (fraction of pixels with a
+    difference in luminance above tolerance, list of (box, count) for the
+    changed cells when the page is split in grid x grid cells)'''
+    if a.size != b.size:
+        return 1., [((0, 0) + a.size, a.size[0] * a.size[1])]
+    w, h = a.size
+
+    if numpy is not None:
+        changed = numpy.abs(_luminance(a) - _luminance(b)) > tolerance
+        total = int(changed.sum())
+        cells = []
+        if total:
+            for gy, gx in itertools.product(range(grid), range(grid)):
+                box = (w * gx // grid, h * gy // grid,
+                       w * (gx+1) // grid, h * (gy+1) // grid)
+                n = int(changed[box[1]:box[3], box[0]:box[2]].sum())
+                if n:
+                    cells.append((box, n))
+        return total / (w * h), cells
+
+    # without numpy: the same using Pillow
+    def lum(image):
+        return image.convert('L').filter(PIL.ImageFilter.BoxBlur(1))
+    changed = PIL.ImageChops.difference(lum(a), lum(b)).point(
+        lambda v: 255 if v > tolerance else 0)
+    total = changed.histogram()[255]
+    cells = []
+    if total:
+        for gy, gx in itertools.product(range(grid), range(grid)):
+            box = (w * gx // grid, h * gy // grid,
+                   w * (gx+1) // grid, h * (gy+1) // grid)
+            n = changed.crop(box).histogram()[255]
+            if n:
+                cells.append((box, n))
+    return total / (w * h), cells
+
+
+def main(argv=None):
+    desc = 'Compare rendered pages with stored golden images.'
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('-v', '--verbose', dest='verbose', default=False,
+                        help='Be more verbose',
+                        action='store_true')
+    parser.add_argument('--dir', dest='dir', default=GOLDEN_DN,
+                        help='directory with the golden images '
+                        '(default %(default)s)',
+                        metavar='DIR')
+    parser.add_argument('--update', dest='update', action='store_true',
+                        help='store the rendered pages as the new golden '
+                        'images')
+    parser.add_argument('-j', '--jobs', dest='jobs', default=os.cpu_count(),
+                        help='number of pages rendered at the same time '
+                        '(default %(default)s)',
+                        metavar='N', type=int)
+    parser.add_argument('--tolerance', dest='tolerance', default=8,
+                        help='ignore differences in luminance up to this '
+                        '(0-255, default %(default)s)',
+                        metavar='LEVELS', type=int)
+    parser.add_argument('--max-changed', dest='maxChanged', default=0.05,
+                        help='maximum %% of changed pixels per page '
+                        '(default %(default)s)',
+                        metavar='PERCENT', type=float)
+    args = parser.parse_args(argv)
+    log.VERBOSE = 2 if args.verbose else 1
+
+    # locales not installed here can not be checked
+    todo, missing = [], set()
+    for name, pic, loc, options in cases():
+        try:
+            locales.getTable(loc)
+        except locale.Error:
+            if loc not in missing:
+                log.info('golden', 'Skipping', loc, '- locale not installed')
+            missing.add(loc)
+            continue
+        todo.append((name, pic, options))
+
+    with tempfile.TemporaryDirectory() as tmpdn:
+        pictures = {
+            'landscape': os.path.join(tmpdn, 'landscape.png'),
+            'portrait': os.path.join(tmpdn, 'portrait.png'),
+        }
+        makePicture(pictures['landscape'], (900, 600))
+        makePicture(pictures['portrait'], (600, 900))
+        outdir = args.dir if args.update else tmpdn
+        os.makedirs(outdir, exist_ok=True)
+
+        jobs = list((name, pictures[pic], options, outdir)
+                    for name, pic, options in todo)
+        with concurrent.futures.ProcessPoolExecutor(args.jobs) as pool:
+            fns = list(pool.map(render, jobs))
+        if args.update:
+            log.info('golden', 'Stored', len(fns), 'golden images in',
+                     args.dir)
+            return
+
+        failed = compared = 0
+        for (name, _, _), fn in zip(todo, fns):
+            gfn = os.path.join(args.dir, name + '.png')
+            if not os.path.exists(gfn):
+                # e.g. a locale not installed where the goldens were stored
+                log.info('golden', 'No golden image', gfn, '- store it '
+                         'with --update')
+                continue
+            compared += 1
+            with PIL.Image.open(gfn) as a, PIL.Image.open(fn) as b:
+                changed, cells = diff(a, b, args.tolerance)
+            ok = 100 * changed <= args.maxChanged
+            log.log(1 if not ok else 2, 'golden', '%-4s %s: %.3f%% changed' %
+                    ('OK' if ok else 'FAIL', name, 100 * changed))
+            for box, n in cells if not ok else []:
+                log.log(1, 'golden', '       %d pixels in %r' % (n, box))
+            failed += not ok
+
+    log.info('golden', '%d of %d pages differ' % (failed, compared))
+    if not compared:
+        log.log(0, 'golden', 'No pages compared with golden images in',
+                args.dir)
+    if failed or not compared:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+# -*- encoding: utf-8 -*-
+# iCalendar
+# read events from .ics files
+'''
+Only VEVENTs are used. From each VEVENT the following is used:
+
+ DTSTART     the date of the event (the time is ignored)
+ SUMMARY     the text
+ CATEGORIES  mapped to a TYPE (see events.py) using CATEGORY_TYPES,
+             default g
+ RRULE       recurring events (see rules.py for the supported parts).
+             Events with other rule parts (e.g. BYSETPOS) are skipped
+ EXDATE      dates to skip for recurring events
+ UID, RECURRENCE-ID
+             a VEVENT with a RECURRENCE-ID replaces the occurrence on that
+             date of the recurring VEVENT with the same UID (e.g. when a
+             single meeting is moved to another day)
+
+Components inside a VEVENT (e.g. VALARM) are ignored.
+
+The file is read one line at a time and only events in the requested
+window are kept, i.e., recurring events are only expanded in the window.
+'''
+
+import datetime
+import re
+
+from . import events
+from . import log
+from . import rules
+
+# lower case category -> type
+CATEGORY_TYPES = {
+    'holiday': 'm',
+    'holidays': 'm',
+    'public holiday': 'm',
+    'day off': 'm',
+    'birthday': 'd',
+    'birthdays': 'd',
+    'anniversary': 'd',
+}
+
+
+def unfold(fd):
+    '''Yield all unfolded content lines in fd'''
+    line = None
+    for raw in fd:
+        raw = raw.rstrip('\r\n')
+        if raw[:1] in (' ', '\t') and line is not None:
+            line += raw[1:]
+            continue
+        if line is not None:
+            yield line
+        line = raw
+    if line is not None:
+        yield line
+
+
+def splitLine(line):
+    '''Return (name, params, value) for a content line'''
+    m = re.match(r'([^:;]+)((?:;[^:;]+)*):(.*)$', line)
+    if not m:
+        return None, {}, line
+    params = {}
+    for p in m.group(2).split(';')[1:]:
+        k, _, v = p.partition('=')
+        params[k.upper()] = v
+    return m.group(1).upper(), params, m.group(3)
+
+
+def unescape(text):
+    return re.sub(r'\\(.)',
+                  lambda m: '\n' if m.group(1) in 'nN' else m.group(1),
+                  text)
+
+
+def parseDate(value):
+    '''Date of an ics DATE or DATE-TIME value'''
+    return datetime.datetime.strptime(value[:8], '%Y%m%d').date()
+
+
+def toRule(dtstart, value):
+    '''Convert an ics RRULE value to a rules.Rule starting at dtstart.
+    Raises ValueError if the rule uses parts not supported by rules.py'''
+    parts = [dtstart.isoformat()]
+    wkst = 'MO'
+    for part in value.split(';'):
+        key, _, v = part.partition('=')
+        key = key.upper()
+        if key == 'UNTIL':
+            v = parseDate(v).isoformat()
+        elif key == 'WKST':
+            wkst = v.upper()
+            continue
+        parts.append('%s=%s' % (key, v))
+    rule = rules.Rule.parse('/'.join(parts))
+    # weeks always start on Mondays in rules.py
+    if wkst != 'MO' and rule.freq == 'WEEKLY' and rule.interval > 1:
+        raise ValueError('Unsupported rule part WKST=%s' % wkst)
+    return rule
+
+
+def eventType(categories, categoryTypes=CATEGORY_TYPES):
+    tp = set()
+    for category in categories:
+        tp.update(categoryTypes.get(category.strip().lower(), ''))
+    if 'd' in tp:
+        tp.discard('g')
+    return ''.join(sorted(tp)) or 'g'
+
+
+def readIcsFile(fd, start, end, categoryTypes=CATEGORY_TYPES):
+    '''Return a sorted list of all events in the .ics file fd from start to
+    end (both included)'''
+    fn = getattr(fd, 'name', 'ics')
+    res = []
+    recurring = []  # (UID, events) of each recurring event
+    replaced = {}  # UID -> dates of occurrences replaced by other VEVENTs
+    vevent = None
+    nested = 0
+    for line in unfold(fd):
+        name, params, value = splitLine(line)
+        if vevent is None:
+            if name == 'BEGIN' and value.upper() == 'VEVENT':
+                vevent = {'CATEGORIES': [], 'EXDATE': []}
+                nested = 0
+        elif name == 'BEGIN':
+            # e.g. a VALARM with its own SUMMARY
+            nested += 1
+        elif nested:
+            if name == 'END':
+                nested -= 1
+        elif name == 'END' and value.upper() == 'VEVENT':
+            evs = vEventEvents(vevent, start, end, categoryTypes, fn)
+            uid = vevent.get('UID')
+            if uid and 'RECURRENCE-ID' in vevent:
+                try:
+                    date = parseDate(vevent['RECURRENCE-ID'])
+                    replaced.setdefault(uid, set()).add(date)
+                except ValueError:
+                    log.debug('ics-%s' % fn, 'Unrecognised RECURRENCE-ID',
+                              vevent['RECURRENCE-ID'])
+            if 'RRULE' in vevent:
+                recurring.append((uid, evs))
+            else:
+                res += evs
+            vevent = None
+        elif name == 'CATEGORIES':
+            vevent['CATEGORIES'] += re.split(r'(?<!\\),', value)
+        elif name == 'EXDATE':
+            vevent['EXDATE'] += value.split(',')
+        elif name in ('DTSTART', 'SUMMARY', 'RRULE', 'UID', 'RECURRENCE-ID'):
+            vevent[name] = value
+
+    # the replaced occurrences may come before or after the recurring event
+    for uid, evs in recurring:
+        dates = replaced.get(uid, ())
+        res += (ev for ev in evs if ev.date not in dates)
+    res.sort()
+    log.debug('ics', 'Found', len(res), 'events from', start, 'to', end)
+    return res
+
+
+def vEventEvents(vevent, start, end, categoryTypes, fn):
+    if 'DTSTART' not in vevent or not vevent.get('SUMMARY'):
+        log.debug('ics-%s' % fn, 'Skipping VEVENT without date/text')
+        return []
+    try:
+        dtstart = parseDate(vevent['DTSTART'])
+    except ValueError:
+        log.debug('ics-%s' % fn, 'Unrecognised date', vevent['DTSTART'])
+        return []
+    text = unescape(vevent['SUMMARY'])
+    tp = eventType(vevent['CATEGORIES'], categoryTypes)
+
+    if 'RRULE' not in vevent:
+        if not (start <= dtstart <= end):
+            return []
+        return [events.Event(dtstart, tp, text)]
+
+    try:
+        rule = toRule(dtstart, vevent['RRULE'])
+    except ValueError as e:
+        log.info('ics-%s' % fn, 'Skipping', repr(text), 'with unsupported',
+                 'RRULE', vevent['RRULE'], '-', e)
+        return []
+    exdates = set()
+    for value in vevent['EXDATE']:
+        try:
+            exdates.add(parseDate(value))
+        except ValueError:
+            log.debug('ics-%s' % fn, 'Unrecognised EXDATE', value)
+    res = []
+    for date in rule.between(start, end):
+        if date in exdates:
+            continue
+        age = date.year - dtstart.year if 'd' in tp else None
+        res.append(events.Event(date, tp, text, age))
+    return res
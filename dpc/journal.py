@@ -0,0 +1,72 @@
+#
+# -*- encoding: utf-8 -*-
+#
+# Journal of completed pages, so that an interrupted run can continue
+# where it stopped. Each line is a JSON list [output filename, key], where
+# key is a hash of everything used to draw the page. Lines are only
+# appended (and synced to disk) after the page itself has been synced to
+# disk (see atomicFile); the journal is compacted when opened
+#
+
+import hashlib
+import json
+import os
+import threading
+
+from . import log
+from .files import atomicFile
+
+
+def inputKey(*parts, files=()):
+    '''Hash of parts (strings, dates, numbers, ...) and the size and
+    modification time of all files in files'''
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(repr(part).encode('utf-8'))
+    for fn in files:
+        st = os.stat(fn)
+        h.update(repr((fn, st.st_size, st.st_mtime_ns)).encode('utf-8'))
+    return h.hexdigest()
+
+
+class Journal:
+    def __init__(self, fn):
+        self.fn = fn
+        self.done = {}  # output filename -> key
+        self._lock = threading.Lock()
+
+        try:
+            with open(fn, encoding='utf-8') as fd:
+                for line in fd:
+                    # the last line may be incomplete after a crash
+                    if not line.endswith('\n'):
+                        break
+                    try:
+                        outfn, key = json.loads(line)
+                    except ValueError:
+                        log.info('journal', 'Ignoring bad line in', fn)
+                        continue
+                    self.done[outfn] = key
+        except FileNotFoundError:
+            pass
+        log.debug('journal', len(self.done), 'pages done according to', fn)
+
+        # rewrite the journal without any duplicates or bad lines
+        with atomicFile(fn) as fd:
+            for outfn, key in sorted(self.done.items()):
+                fd.write((json.dumps([outfn, key]) + '\n').encode('utf-8'))
+        self._fd = open(fn, 'a', encoding='utf-8')
+
+    def isDone(self, outfn, key):
+        return self.done.get(outfn) == key
+
+    def add(self, outfn, key):
+        '''Record that outfn has been written'''
+        with self._lock:
+            self._fd.write(json.dumps([outfn, key]) + '\n')
+            self._fd.flush()
+            os.fsync(self._fd.fileno())
+            self.done[outfn] = key
+
+    def close(self):
+        self._fd.close()
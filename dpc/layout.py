@@ -0,0 +1,119 @@
+#
+# -*- encoding: utf-8 -*-
+#
+# Geometry of pages and per date texts. Both are computed once and reused
+# for all pages with the same size, format, orientation, ratio and margins
+#
+
+from . import locales
+from . import log
+from . import pics
+
+# options containing strftime formats used by each box type
+DATE_TEXTS = {
+    'd': ('dateboxTop', 'dateboxMiddle', 'dateboxBottom'),
+    's': ('simpleboxLeft', 'simpleboxMiddle', 'simpleboxRight'),
+    'e': ('eventboxTitle',),
+}
+
+
+class PicturePlan:
+    '''Geometry of a page of size size with the picture at the top (or
+    bottom). All boxes are (x0, y0, x1, y1) in pixels'''
+
+    def __init__(self, size, top, ratio, marginOuter, marginInner):
+        w, h = size[0], int(size[0] / ratio)
+        y = 0 if top else size[1] - h
+        self.picture = (0, y, w, y + h)
+
+        # the text is always slightly above or below the picture
+        x0, x1 = marginOuter, w - marginOuter
+        if top:
+            self.textBox = pics.intBox((x0, h, x1, h + marginInner))
+        else:
+            self.textBox = pics.intBox((x0, y - marginInner, x1, y))
+
+        # the remaining space
+        a, b = marginOuter, marginOuter
+        c, d = size[0] - marginOuter, size[1] - marginOuter
+        if top:
+            b = h + marginInner
+        else:
+            d = y - marginInner
+        self.box = pics.intBox((a, b, c, d))
+
+    def __repr__(self):
+        return 'PicturePlan(%r, %r, %r)' % (self.picture, self.textBox,
+                                            self.box)
+
+
+_picturePlans = {}
+
+
+def picturePlan(size, top, ratio, marginOuter, marginInner):
+    key = tuple(size), top, ratio, marginOuter, marginInner
+    if key not in _picturePlans:
+        _picturePlans[key] = PicturePlan(*key)
+        log.debug('layout', 'New plan', key, _picturePlans[key])
+    return _picturePlans[key]
+
+
+_contentBoxes = {}
+
+
+def contentBoxes(box, fmts, marginInner):
+    '''Split box into one box per format in fmts. Returns a list of
+    (format, box)'''
+    key = tuple(box), tuple(fmts), marginInner
+    if key in _contentBoxes:
+        return _contentBoxes[key]
+
+    boxes, boxCount = [], len(fmts)
+    w, h = box[2]-box[0], box[3]-box[1]
+    for i in range(boxCount):
+        a, b, c, d = box
+        if w > h:
+            # landscape
+            boxw = (w - marginInner*(boxCount-1)) / boxCount
+            a += (boxw + marginInner) * i
+            c = a + boxw
+        else:
+            boxh = (h - marginInner*(boxCount-1)) / boxCount
+            b += (boxh + marginInner) * i
+            d = b + boxh
+        boxes.append((fmts[i], pics.intBox((a, b, c, d))))
+
+    _contentBoxes[key] = boxes
+    return boxes
+
+
+def dateTexts(args, dates):
+    '''Compute all date texts needed by the box types in args.format for
+    all dates in one go. Returns a dict (date, option) -> text'''
+    dests = set()
+    for f in args.format[1]:
+        dests.update(DATE_TEXTS.get(f, ()))
+
+    # several options often share the same format, e.g., %e
+    fmts = {}
+    for dest in dests:
+        fmts.setdefault(getattr(args, dest), []).append(dest)
+
+    table = locales.fromArgs(args)
+    texts = {}
+    for fmt, fdests in fmts.items():
+        for date in dates:
+            text = table.strftime(date, fmt)
+            for dest in fdests:
+                texts[date, dest] = text
+    log.debug('layout', 'Computed', len(texts), 'date texts')
+    return texts
+
+
+def dateText(args, dest):
+    '''Return the text for the option dest on args.date'''
+    texts = getattr(args, 'texts', None) or {}
+    key = args.date, dest
+    if key in texts:
+        return texts[key]
+    return locales.fromArgs(args).strftime(args.date, getattr(args, dest))
@@ -0,0 +1,167 @@
+#
+# -*- encoding: utf-8 -*-
+#
+# Locale dependent strings (names of months/days, date formats, etc)
+# collected once per locale, so that formatting does not depend on the
+# process wide locale.setlocale()
+#
+
+import locale
+import re
+import threading
+
+from . import log
+
+# (singular, plural) texts used for ages, e.g., birthdays
+YEAR_TEXTS = {
+    'da': ('%d år', '%d år'),
+    'de': ('%d Jahre', '%d Jahren'),
+    None: ('%d year', '%d years'),
+}
+# ages for which the year texts are made when the table is created
+MAX_AGE = 150
+
+_DAYS = (locale.DAY_2, locale.DAY_3, locale.DAY_4, locale.DAY_5,
+         locale.DAY_6, locale.DAY_7, locale.DAY_1)
+_ABDAYS = (locale.ABDAY_2, locale.ABDAY_3, locale.ABDAY_4, locale.ABDAY_5,
+           locale.ABDAY_6, locale.ABDAY_7, locale.ABDAY_1)
+_MONTHS = tuple(getattr(locale, 'MON_%d' % i) for i in range(1, 13))
+_ABMONTHS = tuple(getattr(locale, 'ABMON_%d' % i) for i in range(1, 13))
+
+_FORMAT = re.compile(r'%([-_0^#]*)([a-zA-Z%])')
+
+
+class LocaleTable:
+    '''All locale dependent strings for the locale name, e.g., da_DK.
+    Days are indexed as date.weekday(), i.e., 0 is Monday and months as
+    date.month - 1'''
+
+    def __init__(self, name, days, abdays, months, abmonths,
+                 dateFormat, timeFormat, dateTimeFormat, ampm):
+        self.name = name
+        self.days = days
+        self.abdays = abdays
+        self.months = months
+        self.abmonths = abmonths
+        self.dateFormat = dateFormat
+        self.timeFormat = timeFormat
+        self.dateTimeFormat = dateTimeFormat
+        self.ampm = ampm
+
+        lang = name.split('_')[0] if name else None
+        self.yearTexts = YEAR_TEXTS.get(lang, YEAR_TEXTS[None])
+        self._ages = tuple(self._yearText(n) for n in range(MAX_AGE + 1))
+
+        # short date format - this probably breaks for some locales
+        fmt = dateFormat.replace('%Y', '').replace('%y', '')
+        self.shortDateFormat = fmt.strip('/-.')
+
+    def _yearText(self, n):
+        yt = self.yearTexts[1] if n != 1 else self.yearTexts[0]
+        return yt % n
+
+    def yearText(self, n):
+        if 0 <= n <= MAX_AGE:
+            return self._ages[n]
+        return self._yearText(n)
+
+    def strftime(self, date, fmt):
+        '''Same as date.strftime(fmt) in this locale'''
+        return date.strftime(self.compile(fmt, date))
+
+    def compile(self, fmt, date):
+        '''Replace all locale dependent parts of fmt with the actual
+        texts, i.e., the result can be used with date.strftime in any
+        locale'''
+        def sub(m):
+            flags, c = m.groups()
+            if c == 'x':
+                return self.compile(self.dateFormat, date)
+            if c == 'X':
+                return self.compile(self.timeFormat, date)
+            if c == 'c':
+                return self.compile(self.dateTimeFormat, date)
+
+            if c == 'A':
+                text = self.days[date.weekday()]
+            elif c == 'a':
+                text = self.abdays[date.weekday()]
+            elif c == 'B':
+                text = self.months[date.month-1]
+            elif c in 'bh':
+                text = self.abmonths[date.month-1]
+            elif c == 'p' and hasattr(date, 'hour'):
+                text = self.ampm[date.hour >= 12]
+            else:
+                return m.group(0)
+
+            if '^' in flags:
+                text = text.upper()
+            return text.replace('%', '%%')
+        return _FORMAT.sub(sub, fmt)
+
+    def __repr__(self):
+        return 'LocaleTable(%r)' % self.name
+
+
+_lock = threading.Lock()
+_tables = {}
+# the LocaleTable of the locale of the process (see defaultTable)
+_default = []
+
+
+def getTable(name=None):
+    '''Return the LocaleTable for the locale name (e.g. da_DK). None (or C)
+    is the C locale. Raises locale.Error for unsupported locales'''
+    with _lock:
+        if name in _tables:
+            return _tables[name]
+
+        # temporarily switch locale to read all the strings
+        old = locale.setlocale(locale.LC_ALL)
+        try:
+            if name in (None, 'C', 'POSIX'):
+                locale.setlocale(locale.LC_ALL, 'C')
+            else:
+                locale.setlocale(locale.LC_ALL, (name, 'UTF-8'))
+            li = locale.nl_langinfo
+            table = LocaleTable(name,
+                                tuple(map(li, _DAYS)),
+                                tuple(map(li, _ABDAYS)),
+                                tuple(map(li, _MONTHS)),
+                                tuple(map(li, _ABMONTHS)),
+                                li(locale.D_FMT),
+                                li(locale.T_FMT),
+                                li(locale.D_T_FMT),
+                                (li(locale.AM_STR), li(locale.PM_STR)))
+        finally:
+            locale.setlocale(locale.LC_ALL, old)
+
+        log.debug('locales', 'Loaded', table)
+        _tables[name] = table
+        return table
+
+
+def defaultTable():
+    '''Return the LocaleTable of the locale (LC_TIME) of the process, e.g.,
+    as set by locale.setlocale before the first call. Only looked up once.
+    The C locale is used if the locale is not supported'''
+    if not _default:
+        with _lock:
+            # (not while getTable has switched the locale)
+            name = locale.getlocale(locale.LC_TIME)[0]
+        try:
+            table = getTable(name)
+        except locale.Error:
+            table = getTable()
+        _default[:] = [table]
+    return _default[0]
+
+
+def fromArgs(args):
+    '''Return the LocaleTable used by args (args.locale can also be a name
+    of a locale or missing)'''
+    table = getattr(args, 'locale', None)
+    if isinstance(table, LocaleTable):
+        return table
+    return getTable(table)
@@ -0,0 +1,128 @@
+#
+# -*- encoding: utf-8 -*-
+#
+# Overview pages: a year overview with all 12 months, and a month page
+# (the picture + the month). Both use the month box of boxes.py. For the
+# year overview the fonts, the locale table and the days off are found
+# once and shared by all 12 months
+#
+
+import datetime
+
+from . import argp
+from . import boxes
+from . import layout
+from . import locales
+from . import log
+from . import pics
+from .events import toStore
+
+KINDS = ('year', 'month')
+
+
+def options(pgrp):
+    mmarg = argp.mmarg
+    pgrp.add_argument('--overview', dest='overview', default=None,
+                      choices=KINDS,
+                      help='instead of a page per day, create a year '
+                      'overview per year or a page per month (using the '
+                      'options of the monthly calendar)')
+    mmarg(pgrp.add_argument('--overview-year-title', dest='overviewYearTitle',
+                            default='%Y',
+                            help='datetext to show above the year overview '
+                            '(default %(default)s)',
+                            metavar='CONTENT'))
+    mmarg(pgrp.add_argument('--overview-month-title',
+                            dest='overviewMonthTitle',
+                            default='%B %Y',
+                            help='datetext to show above each month '
+                            '(default %(default)s)',
+                            metavar='CONTENT'))
+    mmarg(pgrp.add_argument('--overview-title-size',
+                            dest='overviewTitleSize',
+                            default=12,
+                            help='height in %% to use for titles '
+                            '(default %(default)s)',
+                            metavar='SIZE',
+                            type=argp.rangeCheck(float, 1, 49)))
+
+
+def pageDates(kind, start, end=None):
+    '''Return the first date of each year/month from start to end'''
+    end = end or start
+    if kind == 'year':
+        return list(datetime.date(y, 1, 1)
+                    for y in range(start.year, end.year+1))
+    dates = [start.replace(day=1)]
+    while True:
+        d = dates[-1]
+        d = d.replace(year=d.year+1, month=1) if d.month == 12 else \
+            d.replace(month=d.month+1)
+        if d > end:
+            return dates
+        dates.append(d)
+
+
+def eventWindow(kind, start, end=None):
+    '''Dates needed from the event files for the pages from start to end'''
+    dates = pageDates(kind, start, end)
+    last = dates[-1]
+    if kind == 'year':
+        last = last.replace(month=12)
+    return (dates[0] - datetime.timedelta(7),
+            last + datetime.timedelta(7*7))
+
+
+def drawTitle(args, image, box, text):
+    pics.textDraw(image, box, text, args.textColor, args.fontBold,
+                  (pics.CENTER, pics.CENTER), False, True)
+
+
+def yearPage(args, image, box):
+    '''Draw the year overview of args.date.year in box'''
+    x0, y0, x1, y1 = box
+    table = locales.fromArgs(args)
+    year = args.date.year
+
+    sz = int(args.overviewTitleSize / 100 * (y1 - y0))
+    drawTitle(args, image, (x0, y0, x1, y0 + sz),
+              table.strftime(args.date, args.overviewYearTitle))
+    y0 += sz + args.marginInner
+
+    # 4x3 months on landscape pages and 3x4 on portrait pages
+    cols, rows = (4, 3) if x1 - x0 > y1 - y0 else (3, 4)
+    mi = args.marginInner
+    cw = (x1 - x0 - (cols-1)*mi) // cols
+    ch = (y1 - y0 - (rows-1)*mi) // rows
+    th = ch // 8
+
+    # shared by all months
+    firsts = list(datetime.date(year, m, 1) for m in range(1, 13))
+    titles = list(table.strftime(d, args.overviewMonthTitle) for d in firsts)
+    titleFont = pics.fitFontSize(args.fontBold, titles, (cw, th - 2), True)
+    mbox = (0, 0, cw, ch - th)
+    fonts = boxes.monthFonts(args, mbox)
+    start = boxes.firstDayShown(args, firsts[0])
+    daysOff = toStore(args.events).daysOff(
+        start, datetime.date(year, 12, 31) + datetime.timedelta(6*7))
+    log.debug('overview', 'Year', year, 'with', len(daysOff), 'days off')
+
+    for i, first in enumerate(firsts):
+        col, row = i % cols, i // cols
+        mx, my = x0 + col*(cw + mi), y0 + row*(ch + mi)
+        pics.textDraw(image, (mx, my, mx + cw, my + th), titles[i],
+                      args.textColor, titleFont)
+        mbox = (mx, my + th, mx + cw, my + ch)
+        boxes.drawDayNames(args, image, mbox, fonts[0])
+        boxes.drawMonth(args, image, mbox, first, None, daysOff, fonts[1])
+
+
+def monthPage(args, image, box):
+    '''Draw the month of args.date (with a title) in box'''
+    x0, y0, x1, y1 = box
+    sz = int(args.overviewTitleSize / 100 * (y1 - y0))
+    drawTitle(args, image, (x0, y0, x1, y0 + sz),
+              layout.dateText(args, 'overviewMonthTitle'))
+    mbox = (x0, y0 + sz, x1, y1)
+    boxes.drawDayNames(args, image, mbox)
+    boxes.drawMonth(args, image, mbox, args.date.replace(day=1))
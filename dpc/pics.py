@@ -2,112 +2,368 @@
 # Misc functions related to Pillow/pictures
 #
 
+import collections
+import io
+import math
+import threading
+import PIL.Image
 import PIL.ImageDraw
+import PIL.ImageFilter
+import PIL.ImageFont
 from . import log
 
 CENTER = object()
 
 
-def resizeImageToFitInside(image, size):
-    '''Resize a PIL image object to fit inside a box of size size'''
-    f = list(float(size[i]) / image.size[i] for i in range(2))
+class Profile:
+    '''Render profile, i.e., how much work to put into a page.
+
+    scale is multiplied onto the page size (and hence everything else, as
+    all other sizes are relative to the page size), downscale/upscale are
+    the resampling filters used for the picture, draft enables reduced
+    decoding of (JPEG) pictures, and sharpen is the percent used for an
+    unsharp mask on the cropped picture (0 to disable).
+    '''
+    def __init__(self, name, scale=1, downscale=PIL.Image.LANCZOS,
+                 upscale=PIL.Image.BICUBIC, draft=False, sharpen=0):
+        self.name = name
+        self.scale = scale
+        self.downscale = downscale
+        self.upscale = upscale
+        self.draft = draft
+        self.sharpen = sharpen
+
+    def pageSize(self, size):
+        return tuple(max(1, int(s * self.scale)) for s in size)
+
+    def __repr__(self):
+        return 'Profile(%r)' % self.name
+
+
+PROFILES = {
+    # the filters used before profiles were added (i.e., the same pages)
+    'normal': Profile('normal'),
+    'preview': Profile('preview', .25, PIL.Image.NEAREST,
+                       PIL.Image.BILINEAR, draft=True),
+    'print': Profile('print', 1, PIL.Image.LANCZOS, PIL.Image.LANCZOS),
+}
+DEFAULT_PROFILE = PROFILES['normal']
+
+
+def getProfile(name, sharpen=0):
+    profile = PROFILES[name]
+    if sharpen:
+        profile = Profile(profile.name, profile.scale, profile.downscale,
+                          profile.upscale, profile.draft, sharpen)
+    return profile
+
+
+def draftImage(image, size, profile=DEFAULT_PROFILE):
+    '''If the profile allows it, configure the (not yet loaded) picture to
+    only decode enough to cover size in any orientation'''
+    if profile.draft:
+        side = max(size)
+        image.draft('RGB', (side, side))
+    return image
+
+
+def thumbnailSize(imageSize, size):
+    '''Size of a picture of size imageSize shrunk to fit inside size (the
+    same size as Image.thumbnail gives)'''
+    w, h = imageSize
+    x, y = map(math.floor, size)
+    aspect = w / h
+    if x / y >= aspect:
+        return max(1, min(math.floor(y * aspect), math.ceil(y * aspect),
+                          key=lambda n: abs(aspect - n / y))), y
+    return x, max(1, min(math.floor(x / aspect), math.ceil(x / aspect),
+                         key=lambda n: 0 if n == 0 else abs(aspect - x / n)))
+
+
+def resizePlan(imageSize, size, profile=DEFAULT_PROFILE):
+    '''Return (new size, resampling filter, reducing_gap) used by
+    resizeImageToFitInside for a picture of size imageSize, or None if the
+    picture is not resized'''
+    f = list(float(size[i]) / imageSize[i] for i in range(2))
     if max(f) < 1:
         # too large
-        image.thumbnail(size, PIL.Image.ANTIALIAS)
+        return thumbnailSize(imageSize, size), profile.downscale, 2.0
 
     elif max(f) > 1:
         if f[0] > f[1]:
-            newsize = (int(image.size[0] * f[1]), size[1])
+            newsize = (int(imageSize[0] * f[1]), size[1])
         else:
-            newsize = (size[0], int(image.size[1] * f[0]))
-        image = image.resize(newsize)
-    return image
+            newsize = (size[0], int(imageSize[1] * f[0]))
+        return newsize, profile.upscale, None
+    return None
 
 
-def cropImage(image, size, rotationAllowed=False):
-    '''Resize+crop a PIL Image object to exactly be of size size'''
+def resizeImageToFitInside(image, size, profile=DEFAULT_PROFILE):
+    '''Return a PIL image object resized to fit inside a box of size size.
+    image itself is never changed (it may be shared by several crops)'''
+    plan = resizePlan(image.size, size, profile)
+    if plan is None:
+        return image
+    newsize, resample, reducingGap = plan
+    return image.resize(newsize, resample, reducing_gap=reducingGap)
 
-    if rotationAllowed:
-        if (size[0] > size[1]) != (image.size[0] > image.size[1]):
-            size = size[::-1]
 
-    w, h = image.size
+def sharpenImage(image, profile=DEFAULT_PROFILE):
+    if not profile.sharpen:
+        return image
+    return image.filter(PIL.ImageFilter.UnsharpMask(2, profile.sharpen, 3))
+
+
+def cropPlan(imageSize, size, profile=DEFAULT_PROFILE, focus=(.5, .5)):
+    '''Return (resize plan (see resizePlan), (x, y) of the crop of size in
+    the resized picture) used by cropImage for a picture of size
+    imageSize'''
+    w, h = imageSize
     ws, hs = w*size[1], h*size[0]
 
     if ws <= hs:
         # too high
         # first make the width right
-        nw, nh = size[0], 2*size[0]/image.size[0]*image.size[1]
-        image = resizeImageToFitInside(image, (nw, nh))
+        plan = resizePlan(imageSize, (size[0], 2*size[0]/w*h), profile)
         # delete at top and bottom
-        nhs = (image.size[1]-size[1])//2
-        nsize = (0, nhs, size[0], nhs+size[1])
-        image = image.crop(nsize)
-    elif ws > hs:
-        # too wide
-        # first make the height right
-        nw, nh = 2*size[1]/image.size[1]*image.size[0], size[1]
-        image = resizeImageToFitInside(image, (nw, nh))
-        # delete at left and right
-        nws = (image.size[0]-size[0])//2
-        nsize = (nws, 0, nws+size[0], size[1])
-        image = image.crop(nsize)
+        rh = plan[0][1] if plan else h
+        return plan, (0, int((rh-size[1]) * focus[1]))
 
-    return image
+    # too wide
+    # first make the height right
+    plan = resizePlan(imageSize, (2*size[1]/h*w, size[1]), profile)
+    # delete at left and right
+    rw = plan[0][0] if plan else w
+    return plan, (int((rw-size[0]) * focus[0]), 0)
 
 
-def decorateImage(image):
-    if 'drw' not in dir(image):
-        image.drw = PIL.ImageDraw.Draw(image)
+def cropImage(image, size, rotationAllowed=False, profile=DEFAULT_PROFILE,
+              focus=(.5, .5)):
+    '''Resize+crop a PIL Image object to exactly be of size size. focus is
+    where to crop (0 is left/top, 1 is right/bottom, see smartcrop.py)'''
 
-        image.isLandscape = isLandscape.__get__(image, image.__class__)
-        image.rotateCW = rotateCW.__get__(image, image.__class__)
-        image.rotateCCW = rotateCCW.__get__(image, image.__class__)
+    if rotationAllowed:
+        if (size[0] > size[1]) != (image.size[0] > image.size[1]):
+            size = size[::-1]
 
+    plan, (x, y) = cropPlan(image.size, size, profile, focus)
+    if plan is None:
+        return image.crop((x, y, x+size[0], y+size[1]))
+    newsize, resample, reducingGap = plan
+    resized = image.resize(newsize, resample, reducing_gap=reducingGap)
+    image = resized.crop((x, y, x+size[0], y+size[1]))
+    resized.close()
     return image
 
 
+def _transposeBox(box, size, rotation):
+    '''The box (x0, y0, x1, y1) in a picture of size size transposed by
+    rotation (None, ROTATE_90 or ROTATE_270) converted to a box in the
+    picture itself'''
+    x0, y0, x1, y1 = box
+    if rotation == PIL.Image.ROTATE_90:
+        return size[0]-y1, x0, size[0]-y0, x1
+    if rotation == PIL.Image.ROTATE_270:
+        return y0, size[1]-x1, y1, size[1]-x0
+    return box
+
+
+def _nearestIndexes(n, size):
+    '''Index of the pixel used for each of the size pixels when n pixels are
+    resized with NEAREST'''
+    idx = PIL.Image.new('I', (n, 1))
+    idx.putdata(range(n))
+    res = list(idx.resize((size, 1), PIL.Image.NEAREST).getdata())
+    idx.close()
+    return res
+
+
+def _pickLines(image, axis, ids):
+    '''Return an image of the columns (axis 0) or rows (axis 1) ids of
+    image'''
+    size = list(image.size)
+    size[axis] = len(ids)
+    res = PIL.Image.new(image.mode, size)
+    for k, j in enumerate(ids):
+        if axis == 0:
+            res.paste(image.crop((j, 0, j+1, size[1])), (k, 0))
+        else:
+            res.paste(image.crop((0, j, size[0], j+1)), (0, k))
+    return res
+
+
+def cropImagePart(image, size, part, profile=DEFAULT_PROFILE,
+                  focus=(.5, .5), rotation=None):
+    '''Return the part (x0, y0, x1, y1) of cropImage(image transposed by
+    rotation, size, False, profile, focus), where only the part of image
+    needed is resized. The pixels are the same as those of cropImage, i.e.,
+    the part is resized with the same filter and scale (and reduced the
+    same way first) as the whole picture'''
+    isize = image.size if rotation is None else image.size[::-1]
+    plan, (x, y) = cropPlan(isize, size, profile, focus)
+    box = (part[0]+x, part[1]+y, part[2]+x, part[3]+y)
+    if plan is None:
+        res = image.crop(_transposeBox(box, image.size, rotation))
+        return res if rotation is None else res.transpose(rotation)
+
+    # as Image.resize: the picture is first reduced by factor (in blocks
+    # starting at 0, 0) and then resized with scale
+    newsize, resample, reducingGap = plan
+    factor = (1, 1)
+    if reducingGap and resample != PIL.Image.NEAREST:
+        factor = tuple(int(isize[i] / newsize[i] / reducingGap) or 1
+                       for i in range(2))
+    src, sbox, out, picks = [0, 0, 0, 0], [0, 0, 0, 0], [0, 0], [None, None]
+    cut = [0, 0, box[2]-box[0], box[3]-box[1]]
+    for i in range(2):
+        n, f = isize[i], factor[i]
+        if part[i] == 0 and part[i+2] == size[i]:
+            # the whole picture in this direction, i.e., resized using the
+            # same box as for the whole picture
+            src[i], src[i+2] = 0, n
+            sbox[i], sbox[i+2] = 0, n / f
+            out[i] = newsize[i]
+            cut[i], cut[i+2] = box[i], box[i+2]
+            continue
+        if resample == PIL.Image.NEAREST:
+            # use the same pixels as when resizing the whole picture, i.e.,
+            # pick them here and use a box not scaling them
+            ids = _nearestIndexes(n, newsize[i])[box[i]:box[i+2]]
+            src[i], src[i+2] = min(ids), max(ids) + 1
+            sbox[i], sbox[i+2] = 0, len(ids)
+            out[i] = len(ids)
+            picks[i] = list(j - src[i] for j in ids)
+            continue
+        # Pillow uses 32 bit floats for the box, so this part is resized
+        # with a scale differing very slightly from that of the whole
+        # picture (i.e., the pixels may differ by a level or two)
+        scale = n / f / newsize[i]
+        # the rows/columns used by any of the filters (in reduced pixels)
+        support = 3 * max(scale, 1) + 2
+        lo = max(0, int(box[i] * scale - support))
+        hi = min(-(-n // f), int(box[i+2] * scale + support) + 1)
+        src[i], src[i+2] = lo * f, min(n, hi * f)
+        sbox[i], sbox[i+2] = box[i] * scale - lo, box[i+2] * scale - lo
+        out[i] = box[i+2] - box[i]
+
+    region = image.crop(_transposeBox(src, image.size, rotation))
+    if rotation is not None:
+        tmp, region = region, region.transpose(rotation)
+        tmp.close()
+    mode = region.mode
+    if mode in ('LA', 'RGBA') and resample != PIL.Image.NEAREST:
+        # premultiplied alpha (as Image.resize)
+        tmp, region = region, region.convert(mode[:-1] + 'a')
+        tmp.close()
+    if factor != (1, 1):
+        tmp, region = region, region.reduce(factor)
+        tmp.close()
+    for i, ids in enumerate(picks):
+        if ids is not None:
+            tmp, region = region, _pickLines(region, i, ids)
+            tmp.close()
+    res = region.resize(out, resample, sbox)
+    region.close()
+    if tuple(out) != tuple(cut[2:]):
+        tmp, res = res, res.crop(cut)
+        tmp.close()
+    if res.mode != mode:
+        tmp, res = res, res.convert(mode)
+        tmp.close()
+    return res
+
+
+class Canvas:
+    '''A page being drawn, i.e., the PIL image, an ImageDraw for it and the
+    content box (x0, y0, x1, y1), i.e., where the boxes are placed. A canvas
+    is only used by one thread at a time, but several canvases can be
+    drawn at the same time'''
+    __slots__ = ('image', 'draw', 'box')
+
+    def __init__(self, image, box=None):
+        self.image = image
+        self.draw = PIL.ImageDraw.Draw(image)
+        self.box = box
+
+    @classmethod
+    def new(cls, size, color):
+        return cls(PIL.Image.new('RGB', size, color))
+
+    @property
+    def size(self):
+        return self.image.size
+
+    def isLandscape(self):
+        return isLandscape(self.image)
+
+    def paste(self, *args):
+        self.image.paste(*args)
+
+    def rotateCW(self):
+        box = self.box
+        if box is not None:
+            w = self.image.size[1]
+            box = (w - box[3], box[0], w - box[1], box[2])
+        return Canvas(self.image.transpose(PIL.Image.ROTATE_270), box)
+
+    def rotateCCW(self):
+        box = self.box
+        if box is not None:
+            h = self.image.size[0]
+            box = (box[1], h - box[2], box[3], h - box[0])
+        return Canvas(self.image.transpose(PIL.Image.ROTATE_90), box)
+
+
 def isLandscape(image):
     return image.size[0] >= image.size[1]
 
 
-def rotateCW(image):
-    res = image.transpose(PIL.Image.ROTATE_270)
-    res = decorateImage(res)
-
-    if 'box' in dir(image):
-        # also rotate the box
-        box = image.box
-        res.box = (image.size[1] - box[3], box[0],
-                   image.size[1] - box[1], box[2])
+# Rasterised texts, i.e., (font, size, text) -> (mask, offset).
+# The least recently used masks are dropped when the masks in total
+# contain more than GLYPH_CACHE_PIXELS pixels
+GLYPH_CACHE_PIXELS = 16 * 1024 * 1024
+_glyphs = collections.OrderedDict()
+_glyphPixels = 0
+_glyphLock = threading.Lock()
 
-    return decorateImage(res)
 
+def getTextMask(font, text):
+    '''Return (mask, offset) for text, where mask is an L image to be pasted
+    at offset relative to where the text is drawn'''
+    global _glyphPixels
 
-def rotateCCW(image):
-    res = image.transpose(PIL.Image.ROTATE_90)
-    res = decorateImage(res)
+    key = font.path, font.index, font.size, text
+    with _glyphLock:
+        if key in _glyphs:
+            _glyphs.move_to_end(key)
+            return _glyphs[key]
 
-    if 'box' in dir(image):
-        # also rotate the box
-        box = image.box
-        res.box = (box[1], image.size[0] - box[2],
-                   box[3], image.size[0] - box[0])
+    size, offset = font.getmask2(text, 'L')
+    size = size.size
+    mask = PIL.Image.new('L', size)
+    PIL.ImageDraw.Draw(mask).text((-offset[0], -offset[1]), text,
+                                  font=font, fill=255)
 
-    return decorateImage(res)
+    with _glyphLock:
+        if key not in _glyphs:
+            _glyphs[key] = mask, offset
+            _glyphPixels += size[0] * size[1]
+        while _glyphPixels > GLYPH_CACHE_PIXELS and len(_glyphs) > 1:
+            _, (old, _) = _glyphs.popitem(False)
+            _glyphPixels -= old.size[0] * old.size[1]
+    return mask, offset
 
 
 def textDraw(image, box, text, color, font, position=CENTER, squeezed=False,
              fitFont=False):
     global CENTER
-    decorateImage(image)
 
     if fitFont:
         font = fitFontSize(font, text, box, squeezed)
 
     boxsize = (box[2] - box[0], box[3] - box[1])
+    mask, offset = getTextMask(font, text)
     if squeezed:
-        mask, offset = font.getmask2(text)
         textsize = mask.size
     else:
         textsize = getSize(font, text, False)
@@ -129,12 +385,40 @@ def textDraw(image, box, text, color, font, position=CENTER, squeezed=False,
         pos[0] -= offset[0]
         pos[1] -= offset[1]
 
-    image.drw.text(pos, text, font=font, fill=color)
+    # same rounding as ImageDraw.text
+    pos = int(pos[0]) + offset[0], int(pos[1]) + offset[1]
+    image.paste(color, pos, mask)
+
+
+_fonts = {}
+# path -> another file name or the contents of font files loaded elsewhere
+_fontFiles = {}
+
+
+def addFontFile(path, data):
+    '''Use data (a file name or the contents) instead of the font file
+    path'''
+    _fontFiles[path] = data
+
+
+def getFontFile(path):
+    '''Return the file name or a file object to use for the font file
+    path. Fonts opened from file names are mapped by FreeType, while fonts
+    opened from file objects are copied'''
+    data = _fontFiles.get(path, path)
+    if isinstance(data, str):
+        return data
+    return io.BytesIO(data)
 
 
 def scaleFont(font, newSize):
-    font = PIL.ImageFont.truetype(font.path, newSize, font.index)
-    return font
+    key = font.path, newSize, font.index
+    if key not in _fonts:
+        font = PIL.ImageFont.truetype(getFontFile(font.path), newSize,
+                                      font.index)
+        font.path = key[0]
+        _fonts.setdefault(key, font)
+    return _fonts[key]
 
 
 def intBox(box):
@@ -177,6 +461,14 @@ def fitFontSize(font, text, box, squeezed=False):
     return font
 
 
+def textSize(font, text):
+    '''Size of text from the origin (or the left of the text if it starts
+    left of the origin) to the right/bottom of the text, i.e., the same as
+    the deprecated font.getsize'''
+    box = font.getbbox(text)
+    return box[2] - min(0, box[0]), box[3]
+
+
 def getSize(font, text, squeezed=False):
     '''Get size of text including potential space under the baseline, e.g.,
     gjpq'''
@@ -184,8 +476,8 @@ def getSize(font, text, squeezed=False):
     if squeezed:
         return font.getmask(text).size
 
-    tsize1 = font.getsize(text)
-    tsize2 = font.getsize('ABCDEFGHIJKLMNOPQRSTUVWXYZ'
-                          'abcdefghijklmnopqrstuvwxyz')
+    tsize1 = textSize(font, text)
+    tsize2 = textSize(font, 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+                      'abcdefghijklmnopqrstuvwxyz')
 
     return (tsize1[0], max(tsize1[1], tsize2[1]))
@@ -0,0 +1,159 @@
+#
+# -*- encoding: utf-8 -*-
+#
+# A pipeline of stages (e.g. compose -> encode -> write) connected with
+# bounded queues. Each stage has its own worker threads, so encoding and
+# writing one page overlaps with composing the next pages. The memory held
+# by items between stages is limited by a budget
+#
+
+import queue
+import threading
+
+from . import log
+
+_STOP = object()
+
+
+class Budget:
+    '''Bytes held by items in flight, in total and per stage. A limit of 0
+    means no limit. A single item larger than the limit is allowed when
+    nothing else is in flight'''
+
+    def __init__(self, limit=0):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self.stages = {}  # name -> [used, peak]
+        self._cond = threading.Condition()
+
+    def acquire(self, stage, n):
+        with self._cond:
+            while (n and self.limit and self.used and
+                   self.used + n > self.limit):
+                self._cond.wait()
+            self._add(stage, n)
+
+    def resize(self, stage, old, new):
+        '''Change the size of an item without waiting'''
+        with self._cond:
+            self._add(stage, new - old)
+            self._cond.notify_all()
+
+    def release(self, stage, n):
+        self.resize(stage, n, 0)
+
+    def _add(self, stage, n):
+        self.used += n
+        self.peak = max(self.peak, self.used)
+        st = self.stages.setdefault(stage, [0, 0])
+        st[0] += n
+        st[1] = max(st[1], st[0])
+
+
+class Stage:
+    '''A stage running func(item) in workers threads. The result is passed
+    on to the next stage unless it is None. estimate(item) is the number of
+    bytes the result will use (reserved from the budget before func is
+    called) and size(result) the actual number of bytes'''
+
+    def __init__(self, name, func, workers=1, estimate=None, size=None):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.estimate = estimate
+        self.size = size
+
+
+class Pipeline:
+    def __init__(self, stages, budget=0, queueSize=2):
+        self.stages = stages
+        self.budget = Budget(budget)
+        self.queueSize = queueSize
+        self.errors = []
+        self.cancelled = False
+
+    def run(self, items):
+        '''Push all items through all stages. Raises the first exception
+        raised by any stage (after all threads have stopped). If items
+        raises an exception, the items already queued are dropped, and the
+        exception is raised after all threads have stopped'''
+        queues = [queue.Queue(max(self.queueSize, st.workers))
+                  for st in self.stages]
+        queues.append(None)
+        threads = []
+        for i, st in enumerate(self.stages):
+            ts = list(threading.Thread(target=self._worker,
+                                       args=(st, queues[i], queues[i+1]),
+                                       name='%s-%d' % (st.name, j))
+                      for j in range(st.workers))
+            threads.append(ts)
+            for t in ts:
+                t.start()
+
+        try:
+            for item in items:
+                queues[0].put((item, None))
+        except BaseException:
+            self.cancelled = True
+            raise
+        finally:
+            for i, ts in enumerate(threads):
+                for t in ts:
+                    queues[i].put(_STOP)
+                for t in ts:
+                    t.join()
+
+        if self.errors:
+            raise self.errors[0]
+
+    def _worker(self, st, inq, outq):
+        while True:
+            item = inq.get()
+            if item is _STOP:
+                break
+            item, held = item
+            try:
+                # after an error, the remaining items are only drained
+                if self.errors or self.cancelled:
+                    continue
+                n = st.estimate(item) if st.estimate else 0
+                self.budget.acquire(st.name, n)
+                try:
+                    res = st.func(item)
+                except BaseException:
+                    self.budget.release(st.name, n)
+                    raise
+                if res is None:
+                    self.budget.release(st.name, n)
+                    continue
+                size = st.size(res) if st.size else n
+                self.budget.resize(st.name, n, size)
+                if outq is None:
+                    self.budget.release(st.name, size)
+                else:
+                    outq.put((res, (st.name, size)))
+            except BaseException as e:
+                log.debug('pipeline', st.name, 'failed:', repr(e))
+                self.errors.append(e)
+            finally:
+                if held:
+                    self.budget.release(*held)
+
+    def logPeaks(self, level=2):
+        MB = 1024 * 1024
+        for st in self.stages:
+            if st.name in self.budget.stages:
+                log.log(level, 'pipeline', 'Stage %s: peak %.1f MB in flight'
+                        % (st.name, self.budget.stages[st.name][1] / MB))
+        log.log(level, 'pipeline', 'Peak %.1f MB in flight in total%s'
+                % (self.budget.peak / MB,
+                   ' (budget %.1f MB)' % (self.budget.limit / MB)
+                   if self.budget.limit else ''))
+        try:
+            import resource
+        except ImportError:
+            return
+        # kB on Linux
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        log.log(level, 'pipeline', 'Peak RSS %.1f MB' % (rss / 1024))
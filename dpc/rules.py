@@ -0,0 +1,212 @@
+# -*- encoding: utf-8 -*-
+# Rules
+# recurring dates evaluated on demand
+'''
+A rule is a start date followed by /KEY=VALUE parts (a subset of the
+iCalendar RRULE), e.g.,
+
+  2024-01-01/FREQ=MONTHLY/BYDAY=2TU       second Tuesday of every month
+  2024-01-01/FREQ=MONTHLY/BYDAY=-1FR      last Friday of every month
+  2024-01-05/FREQ=WEEKLY/INTERVAL=2       every second week from 5 January
+  1980-01-01/FREQ=YEARLY/BYMONTH=11/BYDAY=4TH   fourth Thursday of November
+
+KEY
+---
+ FREQ        YEARLY, MONTHLY, WEEKLY or DAILY (required)
+ INTERVAL    only every INTERVAL years/months/weeks/days (default 1)
+ BYMONTH     months, e.g., 1,7
+ BYDAY       weekdays MO, TU, WE, TH, FR, SA, SU. For YEARLY/MONTHLY
+             rules they can be prefixed with N or -N for the Nth (last)
+             such day of the year/month
+ BYMONTHDAY  days of the month, negative days count from the end
+ COUNT       stop after COUNT dates
+ UNTIL       stop after this date (YYYY-MM-DD)
+
+No dates before the start date are used.
+'''
+
+import calendar
+import datetime
+import re
+
+WEEKDAYS = ('MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU')
+FREQS = ('YEARLY', 'MONTHLY', 'WEEKLY', 'DAILY')
+
+
+def _ints(value, mn, mx, negative=False):
+    res = []
+    for v in value.split(','):
+        v = int(v)
+        if not (mn <= (abs(v) if negative else v) <= mx):
+            raise ValueError('%r is not in the range %s to %s' % (v, mn, mx))
+        res.append(v)
+    return tuple(res)
+
+
+def _byday(value):
+    res = []
+    for v in value.split(','):
+        m = re.match(r'^([-+]?\d+)?(%s)$' % '|'.join(WEEKDAYS), v.upper())
+        if not m:
+            raise ValueError('Unknown weekday %r' % v)
+        n = int(m.group(1)) if m.group(1) else None
+        if n == 0:
+            raise ValueError('Unknown weekday %r' % v)
+        res.append((n, WEEKDAYS.index(m.group(2))))
+    return tuple(res)
+
+
+def _nthWeekdays(first, last, byday):
+    '''All dates from first to last (both included) matching byday'''
+    res = []
+    for n, wd in byday:
+        d0 = first + datetime.timedelta((wd - first.weekday()) % 7)
+        days = list(d0 + datetime.timedelta(7*i)
+                    for i in range((last - d0).days // 7 + 1))
+        if n is None:
+            res += days
+        elif 0 < n <= len(days):
+            res.append(days[n-1])
+        elif 0 < -n <= len(days):
+            res.append(days[n])
+    return res
+
+
+class Rule:
+    '''A recurring date. Dates are computed per year and memoised'''
+
+    def __init__(self, start, freq, interval=1, bymonth=(), byday=(),
+                 bymonthday=(), count=None, until=None):
+        self.start = start
+        self.freq = freq
+        self.interval = interval
+        self.bymonth = bymonth
+        self.byday = byday
+        self.bymonthday = bymonthday
+        self.count = count
+        self.until = until
+        self._years = {}
+
+    @classmethod
+    def parse(cls, spec):
+        '''Parse START/KEY=VALUE/... Raises ValueError for invalid rules'''
+        sp = spec.split('/')
+        start = datetime.datetime.strptime(sp[0], '%Y-%m-%d').date()
+        kw = {}
+        for part in sp[1:]:
+            key, _, value = part.partition('=')
+            key = key.upper()
+            if key == 'FREQ':
+                if value.upper() not in FREQS:
+                    raise ValueError('Unknown FREQ %r' % value)
+                kw['freq'] = value.upper()
+            elif key == 'INTERVAL':
+                kw['interval'] = _ints(value, 1, 10000)[0]
+            elif key == 'BYMONTH':
+                kw['bymonth'] = _ints(value, 1, 12)
+            elif key == 'BYDAY':
+                kw['byday'] = _byday(value)
+            elif key == 'BYMONTHDAY':
+                kw['bymonthday'] = _ints(value, 1, 31, True)
+            elif key == 'COUNT':
+                kw['count'] = _ints(value, 1, 1000000)[0]
+            elif key == 'UNTIL':
+                kw['until'] = datetime.datetime.strptime(value,
+                                                         '%Y-%m-%d').date()
+            else:
+                raise ValueError('Unknown rule part %r' % part)
+        if 'freq' not in kw:
+            raise ValueError('FREQ is missing in %r' % spec)
+        return cls(start, **kw)
+
+    def _candidates(self, year):
+        '''All dates in year matching the rule, ignoring start/count/until'''
+        start = self.start
+        months = self.bymonth or range(1, 13)
+        if self.freq == 'YEARLY':
+            if (year - start.year) % self.interval:
+                return []
+            if not (self.bymonth or self.byday or self.bymonthday):
+                months = (start.month,)
+        elif self.freq == 'MONTHLY':
+            months = list(m for m in months
+                          if not ((year - start.year)*12 + m - start.month)
+                          % self.interval)
+
+        days = []
+        if self.freq == 'YEARLY' and self.byday and not self.bymonth:
+            # Nth weekday of the year
+            days = _nthWeekdays(datetime.date(year, 1, 1),
+                                datetime.date(year, 12, 31), self.byday)
+            if self.bymonthday:
+                days = list(d for d in days if self._monthday(d))
+        elif self.freq in ('YEARLY', 'MONTHLY'):
+            for month in months:
+                first = datetime.date(year, month, 1)
+                ndays = calendar.monthrange(year, month)[1]
+                last = first.replace(day=ndays)
+                if self.byday:
+                    mdays = _nthWeekdays(first, last, self.byday)
+                    if self.bymonthday:
+                        mdays = list(d for d in mdays if self._monthday(d))
+                elif self.bymonthday:
+                    mdays = list(first.replace(day=d if d > 0 else ndays+d+1)
+                                 for d in self.bymonthday
+                                 if abs(d) <= ndays)
+                elif start.day <= ndays:
+                    mdays = [first.replace(day=start.day)]
+                else:
+                    mdays = []
+                days += mdays
+        else:
+            # WEEKLY / DAILY: check every day of the year
+            weekdays = set(wd for _, wd in self.byday)
+            if self.freq == 'WEEKLY' and not weekdays:
+                weekdays = {start.weekday()}
+            week0 = start - datetime.timedelta(start.weekday())
+            day = datetime.date(year, 1, 1)
+            while day.year == year:
+                if self.freq == 'WEEKLY':
+                    ok = not (((day - week0).days // 7) % self.interval)
+                else:
+                    ok = not ((day - start).days % self.interval)
+                ok = ok and (not weekdays or day.weekday() in weekdays)
+                ok = ok and (not self.bymonth or day.month in self.bymonth)
+                ok = ok and (not self.bymonthday or self._monthday(day))
+                if ok:
+                    days.append(day)
+                day += datetime.timedelta(1)
+
+        return sorted(set(d for d in days if d >= start))
+
+    def _monthday(self, day):
+        ndays = calendar.monthrange(day.year, day.month)[1]
+        return any(day.day == (d if d > 0 else ndays+d+1)
+                   for d in self.bymonthday)
+
+    def datesInYear(self, year):
+        '''Sorted list of all dates in year. Memoised'''
+        if year in self._years:
+            return self._years[year]
+
+        if year < self.start.year or (self.until and year > self.until.year):
+            days = []
+        else:
+            days = self._candidates(year)
+            if self.until:
+                days = list(d for d in days if d <= self.until)
+            if self.count is not None:
+                # number of dates used in the previous years
+                used = sum(len(self.datesInYear(y))
+                           for y in range(self.start.year, year))
+                days = days[:max(0, self.count - used)]
+        self._years[year] = days
+        return days
+
+    def between(self, start, end):
+        '''All dates from start to end (both included)'''
+        res = []
+        for year in range(start.year, end.year+1):
+            res += list(d for d in self.datesInYear(year)
+                        if start <= d <= end)
+        return res
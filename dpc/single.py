@@ -4,8 +4,14 @@
 #
 
 import argparse
-import re
+import collections
+import concurrent.futures
+import copy
+import datetime
+import io
+import shlex
 import sys
+import threading
 import PIL.ImageColor
 import locale
 import os
@@ -14,123 +20,306 @@ from . import log
 from . import pics
 from . import argp
 from . import boxes
+from . import effects
+from . import eventindex
 from . import events
+from . import files
+from . import ics
+from . import journal
+from . import layout
+from . import locales
+from . import overview
+from . import pipeline
+from . import smartcrop
+from . import tiles
+from . import workers
 
 FONT_BOLD = 'roboto-black'
 FONT_REGULAR = 'roboto-medium'
 
-
-def addPicture(image, args, goTOP=None):
+# page templates kept per variant, i.e., at most this many full pages are
+# held as templates (the least recently used are dropped)
+TEMPLATES_KEPT = 4
+
+
+def pictureFocus(args, size, rotation=None):
+    '''Return where to crop the picture (not rotated) for a crop of size
+    (after rotating the picture by rotation), see --crop'''
+    if args.crop != 'smart':
+        return .5, .5
+    ratio = size[0] / size[1] if rotation is None else size[1] / size[0]
+    return smartcrop.getFocus(args.image, args.pictureName, ratio,
+                              args.cropCache)
+
+
+def cropPicture(args, size, rotation=None, focus=(.5, .5)):
+    '''Return the picture (rotated by rotation, i.e., PIL.Image.ROTATE_90
+    or ROTATE_270) resized+cropped at focus (see pictureFocus) to size.
+    Crops are shared between all pages and variants using the same
+    picture'''
+    crops = args.crops if 'crops' in args else {}
+    fx = args.effects if 'effects' in args else None
+    key = rotation, tuple(size), args.profile.name, args.profile.sharpen, \
+        fx.key if fx else None, tuple(focus)
+    if key not in crops:
+        image = args.image
+        if rotation is not None:
+            image = image.transpose(rotation)
+        pimg = pics.cropImage(image, size, False, args.profile,
+                              smartcrop.rotateFocus(focus, rotation))
+        if image is not args.image and image is not pimg:
+            image.close()
+        crops[key] = pics.sharpenImage(pimg, args.profile)
+        if crops[key] is not pimg:
+            pimg.close()
+        if fx:
+            pimg = crops[key]
+            crops[key] = fx.apply(pimg)
+            pimg.close()
+        log.debug('cropPicture', 'New crop', key)
+    return crops[key]
+
+
+def addPicture(image, args, goTOP=None, rotation=None):
     TOP = args.format[0] == 't' if goTOP is None else goTOP
     log.debug('addPicture', 'At top?', TOP)
 
     # handle portrait images
-    if not args.image.isLandscape():
+    if rotation is None and not pics.isLandscape(args.image):
         if TOP:
             log.debug('addPicture', 'portrait image: rotating CW')
-            args.image = args.image.rotateCW()
-            image = addPicture(image.rotateCW(), args).rotateCCW()
-            args.image = args.image.rotateCCW()
+            image = addPicture(image.rotateCW(), args, None,
+                               PIL.Image.ROTATE_270).rotateCCW()
         else:
             log.debug('addPicture', 'portrait image: rotating CCW')
-            args.image = args.image.rotateCCW()
-            image = addPicture(image.rotateCCW(), args, True).rotateCW()
-            args.image = args.image.rotateCW()
+            image = addPicture(image.rotateCCW(), args, True,
+                               PIL.Image.ROTATE_90).rotateCW()
         return image
 
-    x, y, w, h = 0, 0, image.size[0], image.size[1]
-    h = int(image.size[0] / args.ratio)
-    if not TOP:
-        y = image.size[1] - h
-
-    pimg = pics.cropImage(args.image, (w, h), False)
-    image.paste(pimg, (x, y))
+    plan = layout.picturePlan(image.size, TOP, args.ratio,
+                              args.marginOuter, args.marginInner)
+    x, y, x1, y1 = plan.picture
+    w, h = x1 - x, y1 - y
+
+    focus = pictureFocus(args, (w, h), rotation)
+    if getattr(image, 'tiled', False):
+        # resized one band at a time (see tiles.py)
+        image.pastePicture(args.image, (x, y, w, h), args.profile,
+                           args.effects if 'effects' in args else None,
+                           focus, rotation)
+    else:
+        pimg = cropPicture(args, (w, h), rotation, focus)
+        image.paste(pimg, (x, y))
     log.debug('handle', (x, y, w, h), 'Input image pasted')
 
     if args.text:
         # we are always slightly above or below the image
-        th = args.marginInner
-        x0, x1 = args.marginOuter, w-args.marginOuter
-        if TOP:
-            # text below image
-            box = pics.intBox((x0, h, x1, h + th))
-        else:
-            box = pics.intBox((x0, y - th, x1, y))
-        font = pics.scaleFont(args.fontRegular, 2*th//3)
+        box = plan.textBox
+        font = pics.scaleFont(args.fontRegular, 2*args.marginInner//3)
+        color = args.textColor
+        if args.textContrast:
+            color = effects.contrastColor(args.bgcolor)
 
         pics.textDraw(image, box,
-                      args.text, args.textColor,
+                      args.text, color,
                       font, position=(-1, pics.CENTER))
         log.debug('handle', box, 'Text', repr(args.text))
 
-    # determine location of remaining space
-    a, b = args.marginOuter, args.marginOuter
-    c, d = image.size[0] - args.marginOuter, image.size[1] - args.marginOuter
-    if TOP:
-        # at the bottom
-        b = h + args.marginInner
-    else:
-        d = y - args.marginInner
-
-    image.box = pics.intBox((a, b, c, d))
+    # location of remaining space
+    image.box = plan.box
     return image
 
 
 def findContentBoxes(image, args):
     log.debug('handle', image.box, 'Content-area')
-    fmts = args.format[1]
-
-    boxes, boxCount = [], len(fmts)
-    w, h = image.box[2]-image.box[0], image.box[3]-image.box[1]
-    for i in range(boxCount):
-        a, b, c, d = image.box
-        if w > h:
-            # landscape
-            boxw = (w - args.marginInner*(boxCount-1)) / boxCount
-            a += (boxw + args.marginInner) * i
-            c = a + boxw
-        else:
-            boxh = (h - args.marginInner*(boxCount-1)) / boxCount
-            b += (boxh + args.marginInner) * i
-            d = b + boxh
-        boxes.append((fmts[i], pics.intBox((a, b, c, d))))
-    return boxes
+    return layout.contentBoxes(image.box, args.format[1], args.marginInner)
+
+
+class Templates:
+    '''The page templates of a variant (static key -> canvas). Only the
+    TEMPLATES_KEPT most recently used templates are kept. Templates are
+    not pickled, i.e., a worker process makes its own'''
+
+    def __init__(self, kept=TEMPLATES_KEPT):
+        self.kept = kept
+        self._canvases = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {'kept': self.kept}
+
+    def __setstate__(self, state):
+        self.__init__(state['kept'])
+
+    def __len__(self):
+        return len(self._canvases)
+
+    def get(self, key, make):
+        '''Return the template for key, made by make() if not kept'''
+        with self._lock:
+            if key in self._canvases:
+                self._canvases.move_to_end(key)
+                return self._canvases[key]
+        canvas = make()
+        with self._lock:
+            self._canvases[key] = canvas
+            self._canvases.move_to_end(key)
+            # dropped templates may still be copied by other threads, so
+            # they are not closed
+            while len(self._canvases) > self.kept:
+                self._canvases.popitem(last=False)
+        log.debug('handle', 'New template', key)
+        return canvas
+
+
+def pageTemplate(args):
+    '''Return the canvas with everything not depending on the date, i.e.,
+    the background, the picture, the text and the static parts of the
+    boxes. Templates are shared between all pages of a variant with the
+    same static content (e.g. the same event title)'''
+    key = tuple(boxes.getBoxType(f).staticKey(args)
+                if boxes.getBoxType(f).staticKey else None
+                for f in args.format[1])
+
+    def make():
+        canvas = pics.Canvas.new(args.size, args.bgcolor)
+        canvas = addPicture(canvas, args)
+        for f, cbox in findContentBoxes(canvas, args):
+            static = boxes.getBoxType(f).static
+            if static:
+                static(args, f, canvas, cbox)
+        return canvas
+
+    if 'templates' not in args:
+        return make()
+    return args.templates.get(key, make)
+
+
+def drawOverview(canvas, args):
+    '''Draw a year overview or month page (see --overview) on the empty
+    canvas. Returns the canvas'''
+    if args.overview == 'year':
+        mo = args.marginOuter
+        box = (mo, mo, canvas.size[0] - mo, canvas.size[1] - mo)
+        overview.yearPage(args, canvas, box)
+    else:
+        canvas = addPicture(canvas, args)
+        overview.monthPage(args, canvas, canvas.box)
+    return canvas
 
 
 def handle(args):
-    global image
-
+    '''Draw the page for args. Returns the canvas'''
     log.debug('handle', 'Format used', args.format)
+    if args.overview:
+        return drawOverview(pics.Canvas.new(args.size, args.bgcolor), args)
 
-    image = pics.decorateImage(PIL.Image.new('RGB', args.size, args.bgcolor))
-    image = addPicture(image, args)
+    template = pageTemplate(args)
+    canvas = pics.Canvas(template.image.copy(), template.box)
 
-    cboxes = findContentBoxes(image, args)
+    cboxes = findContentBoxes(canvas, args)
     for i, (f, cbox) in enumerate(cboxes):
-        fn = boxes.getFuncForBoxType(f)
         log.debug('handle', cbox, 'Subbox', i, 'format', f)
-        fn(args, f, image, cbox)
+        boxes.drawBox(args, f, canvas, cbox, False)
+    return canvas
 
-    if args.outfn:
-        dn = os.path.dirname(args.outfn)
-        if not os.path.isdir(dn):
-            log.debug('handle', 'mkdir', dn)
-            os.makedirs(dn)
-        log.debug('handle', 'saving result in', args.outfn)
-        image.save(args.outfn)
-    if args.show:
-        image.show()
 
+def handleTiled(args):
+    '''Record the page for args and write it one band at a time'''
+    canvas = tiles.RecordingCanvas(args.size, args.bgcolor)
+    if args.overview:
+        canvas = drawOverview(canvas, args)
+    else:
+        canvas = addPicture(canvas, args)
+        for f, cbox in findContentBoxes(canvas, args):
+            boxes.drawBox(args, f, canvas, cbox)
 
-def mmarg(arg, **args):
-    if not arg.type:
-        arg.type = str
-    arg.type = argp.maybeMore(arg.type, **args)
-    arg.mm = True
-    return arg
+    log.debug('handle', 'saving result in', args.outfn, 'in bands')
+    ext = os.path.splitext(args.outfn)[1].lower()
+    with files.atomicFile(args.outfn) as fd:
+        tiles.writeBands(canvas, fd, ext, args.bandHeight)
 
 
-def main():
+def composePage(args):
+    '''First stage: returns (args, canvas) or None if the page exists. The
+    canvas is None if the page has been drawn (and written) in bands'''
+    if args.outfn and args.skipIfExists:
+        # check whether the file is already there
+        try:
+            with PIL.Image.open(args.outfn) as img:
+                img.load()
+                log.debug('main', args.outfn,
+                          'found - not generating new version')
+                if args.show:
+                    img.show()
+            return None
+        except OSError:
+            pass
+
+    if args.bandHeight:
+        # already written
+        handleTiled(args)
+        return args, None
+    return args, handle(args)
+
+
+def encodePage(page):
+    '''Second stage: returns (args, encoded image) or None. The canvas is
+    closed'''
+    args, canvas = page
+    if canvas is None:
+        return args, b''
+    try:
+        if args.show:
+            canvas.image.show()
+        if not args.outfn:
+            return None
+        ext = os.path.splitext(args.outfn)[1].lower()
+        fmt = PIL.Image.registered_extensions().get(ext)
+        if fmt is None:
+            raise ValueError('unknown file extension: %r' % ext)
+        fd = io.BytesIO()
+        canvas.image.save(fd, fmt)
+        return args, fd.getvalue()
+    finally:
+        canvas.image.close()
+
+
+def writePage(page):
+    '''Last stage: write the encoded image'''
+    args, data = page
+    if data:
+        log.debug('handle', 'saving result in', args.outfn)
+        files.writeAtomic(args.outfn, data)
+
+
+mmarg = argp.mmarg
+
+
+def usedBoxTypes(argv):
+    '''Return the names of the builtin box types and all box types used in
+    the --format options in argv (also in --variant)'''
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-f', '--format', dest='formats', action='append',
+                        default=[])
+    parser.add_argument('--variant', dest='variants', action='append',
+                        default=[])
+    args = parser.parse_known_args(argv)[0]
+    formats = list(args.formats)
+    for spec in args.variants:
+        formats += parser.parse_known_args(shlex.split(spec))[0].formats
+    names = sorted(boxes.BOX_TYPES)
+    for fmt in formats:
+        for part in fmt.split('~'):
+            for name in boxes.splitFormat(part.lstrip('tb')):
+                if name not in names and name in boxes.getBoxTypes():
+                    names.append(name)
+    return names
+
+
+def getParser(argv):
+    '''Return the parser for the options in argv (box type plugins are only
+    loaded if used in argv)'''
     desc = '''Create a single calendar page.
 
 For most options, you can give two suboptions for landscape
@@ -142,30 +331,99 @@ for portrait pictures).'''
     parser.add_argument('-v', '--verbose', dest='verbose', default=False,
                         help='Be more verbose',
                         action='store_true')
+    parser.add_argument('-j', '--jobs', dest='jobs', default=1,
+                        help='number of pages to create at the same time '
+                        '(default %(default)s)',
+                        metavar='N',
+                        type=argp.rangeCheck(int, 1, 256))
+    parser.add_argument('--processes', dest='processes', default=1,
+                        help='draw pages in N worker processes sharing the '
+                        'fonts, pictures and events through shared memory '
+                        '(default %(default)s, i.e., no worker processes)',
+                        metavar='N',
+                        type=argp.rangeCheck(int, 1, 256))
+    parser.add_argument('--io-threads', dest='ioThreads', default=2,
+                        help='number of threads reading pictures and '
+                        'writing pages (default %(default)s)',
+                        metavar='N',
+                        type=argp.rangeCheck(int, 1, 64))
+    parser.add_argument('--prefetch', dest='prefetch', default=2,
+                        help='number of pictures read ahead of the pages '
+                        'being drawn (default %(default)s)',
+                        metavar='N',
+                        type=argp.rangeCheck(int, 1, 64))
+    parser.add_argument('--band-height', dest='bandHeight', default=0,
+                        help='draw each page (e.g. a large poster) in bands '
+                        'of this many rows, which are written one at a '
+                        'time to --output (.png or .tif). 0 means draw the '
+                        'whole page at once (default %(default)s)',
+                        metavar='ROWS',
+                        type=argp.rangeCheck(int, 0, 1000000))
+    parser.add_argument('--memory-budget', dest='memoryBudget', default=0,
+                        help='maximum number of MB used by pages being '
+                        'drawn, encoded or written. 0 means no limit. The '
+                        'page templates (at most %d pages per variant) come '
+                        'on top (default %%(default)s)' % TEMPLATES_KEPT,
+                        metavar='MB',
+                        type=argp.rangeCheck(int, 0, 1024*1024))
 
     pgrp = parser.add_argument_group('(semi)required options')
     pgrp.add_argument('-d', '--date', dest='date', required=True,
                       help='Date to show', metavar='DATE',
                       type=argp.dateCheck)
+    pgrp.add_argument('--until', dest='until', default=None,
+                      help='create a page for every date from --date up to '
+                      'and including this date. Use e.g. %%Y-%%m-%%d in '
+                      '--output to get a file per date (and %%%% for a %%)',
+                      metavar='DATE',
+                      type=argp.dateCheck)
     pgrp.add_argument('-o', '--output', dest='outfn', default=None,
                       help='filename of output file',
                       metavar='FILENAME')
+    pgrp.add_argument('--variant', dest='variants',
+                      default=None, action='append',
+                      help='also create a variant of each page using '
+                      'these extra options, e.g., '
+                      '"--locale de_DE --size 2400x2100 -o de/%%F.png". '
+                      'The picture, its crops and the events are shared '
+                      'between all variants. Use several times for '
+                      'multiple variants',
+                      metavar='OPTIONS')
     pgrp.add_argument('--skip-if-output-exists', dest='skipIfExists',
                       help='do nothing if the output file already exists '
                       'and is a valid image file',
                       action='store_true')
+    pgrp.add_argument('--journal', dest='journal', default=None,
+                      help='record the pages written in this file. When '
+                      'the same command is used again, pages already '
+                      'written (with the same options, picture and event '
+                      'files) are skipped',
+                      metavar='FILENAME')
     pgrp.add_argument('--show', dest='show', action='store_true',
                       help='Show result, i.e., open a GUI window')
     pgrp.add_argument('-e', '--event-file', dest='events',
                       default=None, action='append',
                       help='eventfile to use - use several times '
-                      'to use multiple files '
+                      'to use multiple files. Files ending in .ics are '
+                      'read as iCalendar files '
                       '(default %(default)s)',
                       type=argparse.FileType('r'),
                       metavar='FILE')
+    pgrp.add_argument('--event-cache', dest='eventCache',
+                      default=events.CACHE_DN,
+                      help='directory for compiled versions of the event '
+                      'files. Use an empty string to disable '
+                      '(default %(default)s)',
+                      metavar='DIR')
+    pgrp.add_argument('--event-index', dest='eventIndex', default=None,
+                      help='use (and build or update if needed) a single '
+                      'index of all event files in FILE, which can be '
+                      'shared by many dpc-single processes started at the '
+                      'same time (default none)',
+                      metavar='FILE')
 
     pgrp = parser.add_argument_group('general appearance')
-    reformat = r'([tb])((?:%s)+)' % '|'.join(boxes.getBoxTypes())
+    reformat = r'([tb])((?:%s)+)' % boxes.formatRE()
     mmarg(pgrp.add_argument('-f', '--format', dest='format',
                             default='tmde~tdme',
                             help='format of each page (default %(default)s)',
@@ -194,7 +452,7 @@ for portrait pictures).'''
                       default=locale.getdefaultlocale()[0],
                       help='Locale to use for dates etc (default %(default)s)',
                       metavar='LOCALE',
-                      type=argp.localeCheckSet)
+                      type=argp.localeCheck)
     pgrp.add_argument('--font-dir', dest='fontDirs',
                       default=argp.FONT_DNS,
                       help='add directory to search for fonts. Note you '
@@ -214,10 +472,29 @@ for portrait pictures).'''
                       metavar='FONT',
                       type=argp.fontCheck)
 
+    pgrp = parser.add_argument_group('render profile')
+    pgrp.add_argument('--preview', dest='profile', const='preview',
+                      default='normal', action='store_const',
+                      help='fast low resolution preview of the page')
+    pgrp.add_argument('--print', dest='profile', const='print',
+                      default='normal', action='store_const',
+                      help='best quality resampling for printing')
+    pgrp.add_argument('--sharpen', dest='sharpen', default=0,
+                      help='sharpen the picture after resizing, in %% '
+                      '(default %(default)s, i.e., no sharpening)',
+                      metavar='PERCENT',
+                      type=argp.rangeCheck(int, 0, 500))
+
+    overview.options(parser.add_argument_group(
+        'overview pages', '''Year overviews (all months, no picture) and
+month pages (the picture and the month) instead of daily pages. Use e.g.
+%Y or %m in --output to get a file per year/month.'''))
+
     pgrp = parser.add_argument_group('picture')
     pgrp.add_argument('-p', '--picture', dest='imagefd', default=None,
                       help='filename of picture to use',
                       metavar='FILENAME', required=True,
+                      action=argp.ReplaceFile,
                       type=argparse.FileType('rb'))
     mmarg(pgrp.add_argument('-r', '--ratio', dest='ratio',
                             default='1.5~1.3333333',
@@ -225,6 +502,18 @@ for portrait pictures).'''
                             '(default %(default)s)',
                             metavar='RATIO',
                             type=argp.rangeCheck(float, 0, 10)))
+    pgrp.add_argument('--crop', dest='crop', default='center',
+                      choices=('center', 'smart'),
+                      help='which part of the picture to keep when '
+                      'cropping: the center, or the part with the most '
+                      'details (smart, requires numpy) '
+                      '(default %(default)s)')
+    pgrp.add_argument('--crop-cache', dest='cropCache',
+                      default=smartcrop.CACHE_DN,
+                      help='directory for the crops found by --crop smart. '
+                      'Use an empty string to disable '
+                      '(default %(default)s)',
+                      metavar='DIR')
     pgrp.add_argument('--text', dest='text', default='',
                       help='text to show below image (default none)',
                       metavar='TEXT',
@@ -235,201 +524,384 @@ for portrait pictures).'''
                             '(default %(default)s)',
                             metavar='COLOR',
                             type=PIL.ImageColor.getrgb))
-
-    hlp = '''Simple box with three lines. By default Weekday / Day of month
-/ Month Year.'''
-    pgrp = parser.add_argument_group('datebox (d)', hlp)
-    mmarg(pgrp.add_argument('--datebox-top', dest='dateboxTop',
-                            default='%A uge %V',
-                            help='datetext to show above '
-                            '(default %(default)s)',
-                            metavar='CONTENT'))
-    mmarg(pgrp.add_argument('--datebox-middle', dest='dateboxMiddle',
-                            default='%e',
-                            help='datetext to show in the middle '
-                            '(default %(default)s)',
-                            metavar='CONTENT'))
-    mmarg(pgrp.add_argument('--datebox-bottom', dest='dateboxBottom',
-                            default='%B %Y',
-                            help='datetext to show below '
-                            '(default %(default)s)',
-                            metavar='CONTENT'))
-    mmarg(pgrp.add_argument('--datebox-color', dest='dateboxColor',
-                            default='#000000',
-                            help='color of the datebox text '
-                            '(default %(default)s)',
-                            metavar='COLOR',
-                            type=PIL.ImageColor.getrgb))
-    mmarg(pgrp.add_argument('--datebox-top-size', dest='dateboxTopSize',
-                            default=20,
-                            help='height of datebox in %% to use for each of'
-                            'date-top and date-bottom (default %(default)s)',
-                            metavar='SIZE',
-                            type=argp.rangeCheck(float, 1, 49)))
-
-    hlp = '''Show events in the near future.
-Also use --event-file (see above), otherwise this box will be almost empty.'''
-    pgrp = parser.add_argument_group('events (e)', hlp)
-    mmarg(pgrp.add_argument('--eventbox-range', dest='eventboxRange',
-                            default=14,
-                            help='maximum number of days in the future for '
-                            'shown events '
-                            '(default %(default)s)',
-                            metavar='DAYS',
-                            type=argp.rangeCheck(int, 0, 365)))
-    mmarg(pgrp.add_argument('--eventbox-title', dest='eventboxTitle',
-                            default='%B:',
-                            help='datetext to show above the events '
-                            '(default %(default)s)',
-                            metavar='CONTENT'))
-    mmarg(pgrp.add_argument('--eventbox-title-size', dest='eventboxTitleSize',
-                            default=15,
-                            help='height of eventbox in %% to use for '
-                            'the title (default %(default)s)',
-                            metavar='SIZE',
-                            type=argp.rangeCheck(float, 1, 49)))
-    mmarg(pgrp.add_argument('--eventbox-title-color',
-                            dest='eventboxTitleColor',
-                            default='#000000',
-                            help='color of the eventbox title '
-                            '(default %(default)s)',
-                            metavar='COLOR',
-                            type=PIL.ImageColor.getrgb))
-
-    hlp = '''Show a calendar with all days in the current month.
-If --event-file is used, some dates can be colormarked as days off.'''
-
-    pgrp = parser.add_argument_group('monthly calendar (m)', hlp)
-    pgrp.add_argument('--monthbox-firstweekday',
-                      dest='monthboxFirstDay', default=0,
-                      help='first day of week. 0 is Monday, 6 is Sunday '
-                      '(default %(default)s)',
-                      metavar='DAY',
-                      type=argp.rangeCheck(int, 0, 6))
-    pgrp.add_argument('--monthbox-dayoff',
-                      dest='monthboxDayoff', default=[5, 6],
-                      help='days off (marked as "red"). 0 is Monday, '
-                      '6 is Sunday. Use e.g., -5 to unmark Saturday. '
-                      '(default %(default)s)',
-                      metavar='DAY', action='append',
-                      type=argp.rangeCheck(int, -6, 6))
-
-    mmarg(pgrp.add_argument('--monthbox-border-color',
-                            dest='monthboxBorderColor',
-                            default='#000000',
-                            help='default border color around boxes '
-                            '(default %(default)s)',
-                            metavar='COLOR',
-                            type=PIL.ImageColor.getrgb))
-
-    mmarg(pgrp.add_argument('--monthbox-title-border-color',
-                            dest='monthboxTitleBorderColor',
-                            default='#FFFFFF',
-                            help='border color around the title boxes '
-                            '(default %(default)s)',
-                            metavar='COLOR',
-                            type=PIL.ImageColor.getrgb))
-
-    colors = [
-        ('title',      '#666666', '#FFFFFF', 'monthbox title (MON...)'),
-        ('default',    '#666666', '#C2C2C2', 'default date'),
-        ('today',      '#F3F3F3', '#598B94', 'today\'s date'),
-        ('dayoff',     '#969696', '#C2C2C2', 'a day of'),
-        ('othermonth', '#C8C5BE', '#F3F3F3', 'a day from other months'),
-        ]
-
-    for (key, c, bgc, desc) in colors:
-        tkey = key.title()
-        mmarg(pgrp.add_argument('--monthbox-%s-color' % key,
-                                dest='monthbox%sColor' % tkey,
-                                default=c,
-                                help='text color of the %s '
-                                '(default %%(default)s)' % desc,
-                                metavar='COLOR',
-                                type=PIL.ImageColor.getrgb))
-        mmarg(pgrp.add_argument('--monthbox-%s-bgcolor' % key,
-                                dest='monthbox%sBgColor' % tkey,
-                                default=bgc,
-                                help='background color of the %s '
-                                '(default %%(default)s)' % desc,
-                                metavar='COLOR',
-                                type=PIL.ImageColor.getrgb))
-
-    hlp = '''Simple (wide or tall) layout with date in the middle, and
-month and weekday to the left/right'''
-    pgrp = parser.add_argument_group('simple date box (s)', hlp)
-    mmarg(pgrp.add_argument('--simplebox-left', dest='simpleboxLeft',
-                            default='%A',
-                            help='datetext to show to the left '
-                            '(default %(default)s)',
-                            metavar='CONTENT'))
-    mmarg(pgrp.add_argument('--simplebox-middle', dest='simpleboxMiddle',
-                            default='%e',
-                            help='datetext to show in the middle '
-                            '(default %(default)s)',
-                            metavar='CONTENT'))
-    mmarg(pgrp.add_argument('--simplebox-right', dest='simpleboxRight',
-                            default='%B',
-                            help='datetext to show to the right '
-                            '(default %(default)s)',
-                            metavar='CONTENT'))
-    mmarg(pgrp.add_argument('--simplebox-color', dest='simpleboxColor',
-                            default='#000000',
-                            help='color of the simplebox text '
-                            '(default %(default)s)',
-                            metavar='COLOR',
-                            type=PIL.ImageColor.getrgb))
-
-    args = parser.parse_args()
-
+    effects.options(parser.add_argument_group(
+        'picture effects', '''Effects applied to the picture after it has
+been resized and cropped (requires numpy).'''))
+
+    # only load box type plugins used in --format
+    boxes.addOptions(parser, usedBoxTypes(argv))
+    parser.add_argument('--timings', dest='timings', action='store_true',
+                        help='show the time used for drawing each box type '
+                        'and the memory used by each stage')
+    return parser
+
+
+def parseArgs(argv):
+    '''Parse argv and the options of each --variant. Returns (list of the
+    args of each variant, dates of the pages)'''
+    parser = getParser(argv)
+    args = parser.parse_args(argv)
+
+    # each variant is the main options + the variant options
+    variants = [args]
+    for spec in args.variants or []:
+        variants.append(parser.parse_args(argv + shlex.split(spec)))
+
+    for i, vargs in enumerate(variants):
+        vargs.variant = i
+
+    # all pages share the layout, so only the date specific parts differ
+    dates = [args.date]
+    while args.until and dates[-1] < args.until:
+        dates.append(dates[-1] + datetime.timedelta(1))
+    if args.overview:
+        dates = overview.pageDates(args.overview, args.date, args.until)
+
+    return variants, dates
+
+
+def checkArgs(variants, dates):
+    '''Check the options (from parseArgs) not depending on the pictures (see
+    also prepare)'''
+    args = variants[0]
+    if args.until and args.until < args.date:
+        log.error('main', '--until must not be before --date')
+
+    # only a range of pages has the date in the output filenames, and each
+    # page must have its own file
+    ranged = bool(args.until or args.overview)
+    for vargs in variants:
+        if ranged and vargs.outfn and \
+           len(set(date.strftime(vargs.outfn) for date in dates)) < len(dates):
+            log.error('main', 'All pages are written to', repr(vargs.outfn),
+                      '- use e.g. %Y-%m-%d in --output to get a file per '
+                      'date')
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    variants, dates = parseArgs(argv)
+    args = variants[0]
+    log.VERBOSE = 2 if args.verbose else 1
+    checkArgs(variants, dates)
+
+    # everything (but the date) used to draw the pages of each variant
+    if args.journal:
+        for spec, vargs in zip([None] + (args.variants or []), variants):
+            fns = [vargs.imagefd.name]
+            fns += list(efd.name for efd in (vargs.events or []))
+            vargs.inputKey = journal.inputKey(journalArgv(argv), spec,
+                                              files=fns)
+
+    # (variant, date, output filename, journal key) of each page
+    ranged = bool(args.until or args.overview)
+    pages = []
+    for date in dates:
+        for vargs in variants:
+            outfn = vargs.outfn
+            if outfn and ranged:
+                outfn = date.strftime(outfn)
+            key = None
+            if args.journal:
+                key = journal.inputKey(vargs.inputKey, date)
+            pages.append((vargs, date, outfn, key))
+
+    # skip pages already done according to the journal
+    jrnl = None
+    if args.journal:
+        jrnl = journal.Journal(args.journal)
+        todo = list(page for page in pages
+                    if not (page[2] and jrnl.isDone(page[2], page[3])))
+        log.info('main', '%d of %d pages already done according to %s' %
+                 (len(pages) - len(todo), len(pages), args.journal))
+        pages = todo
+
+    # only decode as much of each picture as the largest variant using it
+    # needs (in any orientation, as the variants are not prepared yet)
+    shared = {}
+    for vargs in variants:
+        key = 'draft', vargs.imagefd.name
+        profile = pics.getProfile(vargs.profile)
+        if not profile.draft or (key in shared and shared[key] is None):
+            shared[key] = None
+            continue
+        size = profile.pageSize(max(vargs.size, key=max))
+        shared[key] = max(shared.get(key, size), size, key=max)
+
+    # the variants are prepared (and the options checked) before the
+    # first page is drawn, but the pictures are only read (at most
+    # --prefetch pictures ahead) while the pages of the previous variants
+    # are drawn. Worker processes need all variants before the first page
+    multi = args.processes > 1 and workers.shared_memory is not None
+    used = set(page[0].variant for page in pages)
+    if multi:
+        used = set(range(len(variants)))
+    for vargs in variants:
+        if vargs.variant in used:
+            prepare(vargs, shared)
+            vargs.texts = layout.dateTexts(vargs, dates)
+            vargs.templates = Templates()
+        else:
+            vargs.imagefd.close()
+            for efd in vargs.events or []:
+                efd.close()
+    shared['photos'] = files.Prefetcher(args.ioThreads, args.prefetch)
+    shared['photos'].prefetch(
+        vargs.imagefd for vargs in variants if vargs.variant in used and
+        ('picture', vargs.pictureName) not in shared)
+    loaded = set()
+
+    def loadVariant(vargs):
+        if vargs.variant not in loaded:
+            loaded.add(vargs.variant)
+            loadPicture(vargs, shared)
+
+    def pageArgs():
+        for vargs, date, outfn, key in pages:
+            loadVariant(vargs)
+            pargs = copy.copy(vargs)
+            pargs.date, pargs.outfn, pargs.key = date, outfn, key
+            yield pargs
+
+    def write(page):
+        writePage(page)
+        if jrnl:
+            jrnl.add(page[0].outfn, page[0].key)
+
+    # compose -> encode -> write, i.e., pages are encoded and written
+    # while the next pages are drawn
+    def pageBytes(pargs):
+        return 3 * pargs.size[0] * (pargs.bandHeight or pargs.size[1])
+
+    stages = [
+        pipeline.Stage('compose', composePage, args.jobs,
+                       estimate=pageBytes),
+        pipeline.Stage('encode', encodePage, size=lambda page: len(page[1])),
+    ]
+    pool = exporter = None
+    if args.processes > 1 and not multi:
+        log.info('main', 'No shared memory support; not using --processes')
+    elif multi:
+        # the crops are made here (for the first template) and then shared
+        # with the workers together with the fonts, pictures and events
+        exporter = workers.Exporter()
+        wvariants = []
+        for vargs in variants:
+            loadVariant(vargs)
+            pageTemplate(vargs)
+            wvariants.append(workers.exportArgs(exporter, vargs))
+        pool = concurrent.futures.ProcessPoolExecutor(
+            args.processes, initializer=workers.init,
+            initargs=(wvariants, log.VERBOSE))
+
+        def renderRemote(pargs):
+            task = pargs.variant, pargs.date, pargs.outfn
+            data, timings = pool.submit(renderInWorker, task).result()
+            boxes.addTimings(timings)
+            return None if data is None else (pargs, data)
+
+        stages = [pipeline.Stage('render', renderRemote, args.processes,
+                                 estimate=pageBytes,
+                                 size=lambda page: len(page[1]))]
+    stages.append(pipeline.Stage('write', write, args.ioThreads))
+
+    pipe = pipeline.Pipeline(stages, args.memoryBudget * 1024 * 1024,
+                             max(args.jobs, args.processes))
     try:
-        # The file itself has already been opened
-        args.image = pics.decorateImage(PIL.Image.open(args.imagefd))
-    except IOError:
-        log.error('main', '%r does not contain valid image data' %
-                  args.imagefd.name)
-        sys.exit(1)
+        pipe.run(pageArgs())
+    finally:
+        if pool:
+            pool.shutdown()
+            exporter.close()
+        if jrnl:
+            jrnl.close()
+        shared.pop('photos').close()
+
+    for name, image in shared.items():
+        if name[0] == 'picture':
+            image.close()
+
+    boxes.logTimings(1 if args.timings else 2)
+    pipe.logPeaks(1 if args.timings else 2)
+
+
+def pictureSize(fd):
+    '''Size of the picture in the (already opened) file fd. Only the start of
+    the file is read, i.e., the picture is read later. Returns None if it
+    does not contain valid image data'''
+    try:
+        # closing the image would also close fd
+        size = PIL.Image.open(fd).size
+        fd.seek(0)
+    except (IOError, ValueError):
+        return None
+    return size
+
+
+def prepare(args, shared):
+    '''Finish the parsing of args and check the options (i.e., exit if the
+    pages cannot be made). The picture itself is read later by
+    loadPicture. Events are shared with other variants through the dict
+    shared'''
+    args.pictureName = args.imagefd.name
+    key = 'size', args.pictureName
+    if key not in shared:
+        if args.imagefd.seekable():
+            shared[key] = pictureSize(args.imagefd)
+        else:
+            # e.g. stdin, so it must be read now
+            readPicture(args, shared, pics.getProfile(args.profile))
+            shared[key] = shared['picture', args.pictureName].size
+        if shared[key] is None:
+            log.error('main', '%r does not contain valid image data' %
+                      args.pictureName)
 
     # use options depending on whether it's a landscape or portrait image
-    argp.deMore(args, 0 if args.image.isLandscape() else 1)
-
-    # Read contents of all events files
-    evs = []
+    w, h = shared[key]
+    argp.deMore(args, 0 if w >= h else 1)
+
+    # the profile scales the page, everything else is relative to the size
+    args.profile = pics.getProfile(args.profile, args.sharpen)
+    args.size = args.profile.pageSize(args.size)
+    log.debug('main', 'Profile', args.profile, 'page size', args.size)
+    effects.checkArgs(args)
+    if args.crop == 'smart' and smartcrop.numpy is None:
+        log.error('smartcrop', '--crop smart requires numpy')
+
+    # Read contents of all events files. Only events from .ics files in the
+    # window of dates used by the pages are kept
+    last = args.until or args.date
+    window = (args.date.replace(day=1) - datetime.timedelta(7),
+              max(last + datetime.timedelta(args.eventboxRange),
+                  last.replace(day=1) + datetime.timedelta(7*7)))
+    if args.overview:
+        window = overview.eventWindow(args.overview, args.date, args.until)
+    names = tuple(sorted(set(efd.name for efd in (args.events or []))))
+    key = 'events', names, window
+    if args.eventIndex and args.events:
+        key = 'index', args.eventIndex, names
+        if key not in shared:
+            # in the order given (as it decides which texts are used for
+            # duplicate events)
+            ordered = list(dict.fromkeys(efd.name for efd in args.events))
+            shared[key] = eventindex.EventIndex(args.eventIndex, ordered)
+    elif key not in shared:
+        lists, rules, seen = [], [], set()
+        for efd in (args.events or []):
+            if efd.name in seen:
+                continue
+            seen.add(efd.name)
+            if efd.name.lower().endswith('.ics'):
+                lists.append(ics.readIcsFile(efd, *window))
+            elif args.eventCache:
+                lists.append(events.readEventFileCached(efd, args.eventCache,
+                                                        rules))
+            else:
+                lists.append(events.readEventFile(efd, rules))
+        shared[key] = events.EventStore(events.mergeEvents(lists),
+                                        events.mergeRules(rules))
     for efd in (args.events or []):
-        evs += events.readEventFile(efd)
-    evs.sort()
-    args.events = list(evs)
+        efd.close()
+    args.events = shared[key]
 
     # convert margins to pixels instead of %
     args.marginOuter = int(args.size[1] * args.marginOuter / 100.)
     args.marginInner = int(args.size[1] * args.marginInner / 100.)
     log.debug('main', 'Margins in pixels', args.marginInner, args.marginOuter)
 
+    args.locale = locales.fromArgs(args)
+
     # Now check some of options
-    log.VERBOSE = 2 if args.verbose else 1
+    args.format = args.format[0], boxes.splitFormat(args.format[1])
 
-    formatsp = r'(%s)' % '|'.join(boxes.getBoxTypes())
-    formatsp = tuple(filter(None, re.split(formatsp, args.format[1])))
-    args.format = args.format[0], formatsp
+    if args.bandHeight and not args.outfn:
+        log.error('main', '--band-height requires --output')
+    if args.bandHeight and args.show:
+        log.info('main', '--show is ignored with --band-height')
 
     # either --output or --show is required
     if not (args.outfn or args.show):
         log.info('main', '--output not used; assuming --show')
         args.show = True
 
-    if args.outfn and args.skipIfExists:
-        # check whether the file is already there
-        try:
-            img = PIL.Image.open(args.outfn)
-            img.load()
-            log.debug('main', args.outfn, 'found - not generating new version')
-            if args.show:
-                img.show()
-            return
-        except OSError:
-            pass
 
-    handle(args)
+def readPicture(args, shared, profile):
+    '''Read the picture of args into the dict shared (i.e., it is shared with
+    other variants). Only as much is decoded as the largest variant using
+    it needs (if profile allows it)'''
+    try:
+        # The file itself has already been opened (and maybe read)
+        if 'photos' in shared:
+            image = PIL.Image.open(shared['photos'].get(args.imagefd))
+        else:
+            image = PIL.Image.open(args.imagefd)
+        size = shared.get(('draft', args.pictureName))
+        if size:
+            pics.draftImage(image, size, profile)
+        image.load()
+    except (IOError, ValueError):
+        log.error('main', '%r does not contain valid image data' %
+                  args.pictureName)
+    shared['picture', args.pictureName] = image
+    shared['crops', args.pictureName] = {}
+
+
+def loadPicture(args, shared):
+    '''Read the picture of args (prepared by prepare) unless another variant
+    has read it, and set up the effects'''
+    if ('picture', args.pictureName) not in shared:
+        readPicture(args, shared, args.profile)
+    else:
+        # opened again by argparse for this variant
+        args.imagefd.close()
+    args.image = shared['picture', args.pictureName]
+    args.crops = shared['crops', args.pictureName]
+    args.effects = effects.fromArgs(args, shared)
+
+
+# options not changing the content of a page (the date is part of the key
+# of each page), i.e., ignored when comparing with the journal
+JOURNAL_IGNORE = ('-d', '--date', '--until', '-j', '--jobs', '--processes',
+                  '--io-threads', '--prefetch', '--memory-budget',
+                  '--journal')
+JOURNAL_IGNORE_FLAGS = ('-v', '--verbose', '--timings', '--show',
+                        '--skip-if-output-exists')
+
+
+def journalArgv(argv):
+    '''Return argv without the options in JOURNAL_IGNORE(_FLAGS)'''
+    res, skip = [], False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in JOURNAL_IGNORE:
+            skip = True
+        elif (arg in JOURNAL_IGNORE_FLAGS or
+              arg.split('=')[0] in JOURNAL_IGNORE):
+            pass
+        else:
+            res.append(arg)
+    return res
+
+
+def renderInWorker(task):
+    '''Compose and encode a page in a worker process (see workers.py). task
+    is (index of variant, date, output filename). Returns (the encoded
+    page or None, the timings of the boxes drawn, see boxes.takeTimings)'''
+    i, date, outfn = task
+    args = copy.copy(workers.VARIANTS[i])
+    args.date, args.outfn = date, outfn
+    page = composePage(args)
+    page = page and encodePage(page)
+    return page and page[1], boxes.takeTimings()
+
+
+def render(args):
+    '''Create a single page without using a pipeline'''
+    page = composePage(args)
+    page = page and encodePage(page)
+    if page:
+        writePage(page)
 
 
 if __name__ == '__main__':
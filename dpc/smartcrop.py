@@ -0,0 +1,136 @@
+#
+# -*- encoding: utf-8 -*-
+#
+# Smart cropping: instead of always keeping the center of the picture, keep
+# the part with the most details (edges and colours). The details are
+# found on a preview (about 256 pixels wide), and the chosen crop window is
+# cached (per picture and ratio) in a small JSON file, so later builds do
+# not analyse the picture again
+#
+
+import hashlib
+import json
+import os
+
+import PIL.Image
+
+from . import files
+from . import log
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+CACHE_DN = os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                        os.path.expanduser(os.path.join('~', '.cache')),
+                        'dpc', 'crops')
+PREVIEW_WIDTH = 256
+
+# (filename, mtime, size, ratio) -> focus
+_focus = {}
+
+
+def cachePath(fn, cacheDir=CACHE_DN):
+    key = hashlib.sha1(os.path.abspath(fn).encode('utf-8')).hexdigest()
+    return os.path.join(cacheDir, key + '.json')
+
+
+def energy(image):
+    '''Return the amount of details of each pixel of the (small) image as a
+    2D array: the luminance gradient + some of the colour saturation'''
+    a = numpy.asarray(image.convert('RGB'), dtype=numpy.float32)
+    lum = a @ numpy.array((0.299, 0.587, 0.114), dtype=numpy.float32)
+    res = numpy.zeros_like(lum)
+    dx = numpy.abs(numpy.diff(lum, axis=1))
+    dy = numpy.abs(numpy.diff(lum, axis=0))
+    res[:, 1:] += dx
+    res[:, :-1] += dx
+    res[1:, :] += dy
+    res[:-1, :] += dy
+    res += (a.max(axis=2) - a.min(axis=2)) / 4
+    return res
+
+
+def bestOffset(profile, n):
+    '''Return the offset (0-1 of the free space) of the window of n values
+    in profile with the most energy. Windows near the center are preferred
+    when the energy is about the same'''
+    free = len(profile) - n
+    if free <= 0:
+        return .5
+    cs = numpy.concatenate(([0], numpy.cumsum(profile, dtype=numpy.float64)))
+    sums = cs[n:] - cs[:-n]
+    offsets = numpy.arange(free + 1) / free
+    sums *= 1 - .1 * numpy.abs(offsets - .5)
+    return float(offsets[int(numpy.argmax(sums))])
+
+
+def findFocus(image, ratio):
+    '''Return (fx, fy), i.e., where to place the crop window with ratio
+    (width/height) in image: 0 is left/top, .5 the center and 1 right/bottom
+    of the space not used by the window'''
+    w, h = image.size
+    pw = min(w, PREVIEW_WIDTH)
+    ph = max(1, round(h * pw / w))
+    preview = image.resize((pw, ph), PIL.Image.BOX, reducing_gap=2)
+    e = energy(preview)
+    preview.close()
+
+    if pw / ph > ratio:
+        # too wide - move the window left/right
+        return bestOffset(e.sum(axis=0), max(1, round(ph * ratio))), .5
+    return .5, bestOffset(e.sum(axis=1), max(1, round(pw / ratio)))
+
+
+def getFocus(image, fn, ratio, cacheDir=CACHE_DN):
+    '''Same as findFocus(image, ratio), where image has been read from the
+    file fn. The result is cached in cacheDir (unless it is empty)'''
+    if numpy is None:
+        log.error('smartcrop', '--crop smart requires numpy')
+    try:
+        st = os.stat(fn)
+        stamp = st.st_mtime_ns, st.st_size
+    except (OSError, TypeError):
+        stamp = None  # e.g. stdin
+    rkey = '%.4f' % ratio
+    key = fn, stamp, rkey
+    if key in _focus:
+        return _focus[key]
+
+    path = cachePath(fn, cacheDir) if cacheDir and stamp else None
+    cache = {}
+    if path:
+        try:
+            with open(path, encoding='utf-8') as fd:
+                cache = json.load(fd)
+        except (OSError, ValueError):
+            pass
+        if cache.get('stamp') != list(stamp):
+            cache = {'stamp': list(stamp), 'focus': {}}
+
+    if path and rkey in cache['focus']:
+        focus = tuple(cache['focus'][rkey])
+        log.debug('smartcrop', 'Cached focus', focus, 'for', fn, rkey)
+    else:
+        focus = findFocus(image, ratio)
+        log.debug('smartcrop', 'Focus', focus, 'for', fn, rkey)
+        if path:
+            cache['focus'][rkey] = focus
+            try:
+                files.writeAtomic(path, json.dumps(cache).encode('utf-8'))
+            except OSError as e:
+                log.debug('smartcrop', 'Cannot write', path, e)
+    _focus[key] = focus
+    return focus
+
+
+def rotateFocus(focus, rotation):
+    '''Return focus for the picture transposed by rotation (ROTATE_90 or
+    ROTATE_270)'''
+    fx, fy = focus
+    if rotation == PIL.Image.ROTATE_270:
+        return 1 - fy, fx
+    if rotation == PIL.Image.ROTATE_90:
+        return fy, 1 - fx
+    return focus
@@ -0,0 +1,143 @@
+#
+# -*- encoding: utf-8 -*-
+#
+# Layout of lines of text in rows of the same height (e.g. the events of
+# the event box), where each line is fitted on its own: shrunk, cut with
+# an ellipsis or wrapped onto more rows. Widths are found by adding the
+# advances of the characters (cached per font), so the cost of a layout is
+# linear in the number of characters, and the real width is only measured
+# once per row
+#
+
+import threading
+
+from . import pics
+
+ELLIPSIS = '…'
+MODES = ('all', 'shrink', 'ellipsis', 'wrap')
+# shrink lines to at most this fraction of the row font, then cut them
+MIN_SHRINK = .7
+
+# (font path, index, size) -> {character: advance}
+_advances = {}
+# (font path, index, row height) -> largest font fitting the row height
+_rowFonts = {}
+_lock = threading.Lock()
+
+
+def advances(font):
+    key = font.path, font.index, font.size
+    with _lock:
+        if key not in _advances:
+            _advances[key] = {}
+        return _advances[key]
+
+
+def textWidth(font, text):
+    '''Width of text found from the advances of the characters'''
+    adv = advances(font)
+    w = 0
+    for c in text:
+        if c not in adv:
+            adv[c] = font.getlength(c)
+        w += adv[c]
+    return w
+
+
+def fits(font, text, width):
+    '''Whether text actually fits in width (same width as pics.getSize,
+    i.e., the real width including kerning, unlike textWidth)'''
+    return pics.textSize(font, text)[0] <= width
+
+
+def rowFont(font, height):
+    '''Largest version of font where any text fits in height'''
+    key = font.path, font.index, height
+    if key not in _rowFonts:
+        _rowFonts[key] = pics.fitFontSize(font, 'Ag', (1 << 30, height))
+    return _rowFonts[key]
+
+
+def ellipsize(font, text, width):
+    '''Return text or the longest start of text + ELLIPSIS fitting in
+    width'''
+    if textWidth(font, text) <= width and fits(font, text, width):
+        return text
+    adv = advances(font)
+    avail = width - textWidth(font, ELLIPSIS)
+    w, n = 0, 0
+    for c in text:
+        if w + adv[c] > avail:
+            break
+        w += adv[c]
+        n += 1
+    # the advances do not include kerning etc. - remove characters until
+    # it actually fits
+    while n > 0 and not fits(font, text[:n].rstrip() + ELLIPSIS, width):
+        n -= 1
+    return text[:n].rstrip() + ELLIPSIS
+
+
+def shrink(font, text, width):
+    '''Return (text, font) where font is font or a smaller version of font
+    (at least MIN_SHRINK of it) where text fits in width. If it does not
+    fit, the text is cut'''
+    w = textWidth(font, text)
+    if w <= width and fits(font, text, width):
+        return text, font
+    size = max(int(font.size * MIN_SHRINK),
+               min(font.size - 1, int(font.size * width / max(w, 1))))
+    small = pics.scaleFont(font, size)
+    while small.size > font.size * MIN_SHRINK and \
+            not fits(small, text, width):
+        small = pics.scaleFont(font, small.size - 1)
+    return ellipsize(small, text, width), small
+
+
+def wrap(font, text, width, indent=''):
+    '''Split text into lines fitting in width (at spaces). Words longer
+    than a line are cut. Lines after the first start with indent'''
+    adv = advances(font)
+    textWidth(font, text + indent + ' ')
+    lines, line, w = [], '', 0
+    for word in text.split(' '):
+        ww = sum(adv[c] for c in word)
+        if line and w + adv[' '] + ww <= width:
+            line += ' ' + word
+            w += adv[' '] + ww
+            continue
+        if line:
+            lines.append(line)
+            word = indent + word
+            ww += sum(adv[c] for c in indent)
+        line, w = word, ww
+    lines.append(line)
+    return list(ellipsize(font, line, width) for line in lines)
+
+
+def layoutLines(font, texts, width, height, rows, mode='shrink', indent=''):
+    '''Return a list of at most rows (text, font) for the texts, each row
+    being height high and width wide. The font used is the largest version
+    of font fitting the height. If a text is too wide, it is (depending on
+    mode) shrunk (and then cut), cut with an ellipsis or wrapped onto more
+    rows. The mode all uses the same font for all texts, i.e., the font
+    fitting the widest text'''
+    if rows <= 0 or not texts:
+        return []
+    texts = texts[:rows]
+    if mode == 'all':
+        font = pics.fitFontSize(font, texts, (width, height))
+        return list((text, font) for text in texts)
+
+    font = rowFont(font, height)
+    res = []
+    for text in texts:
+        if mode == 'shrink':
+            res.append(shrink(font, text, width))
+        elif mode == 'ellipsis':
+            res.append((ellipsize(font, text, width), font))
+        else:
+            res += ((line, font) for line in wrap(font, text, width, indent))
+        if len(res) >= rows:
+            break
+    return res[:rows]
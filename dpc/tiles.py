@@ -0,0 +1,316 @@
+#
+# -*- encoding: utf-8 -*-
+#
+# Tiled rendering of very large pages (e.g. posters). The page is first
+# drawn on a RecordingCanvas, which only records what is drawn. The page is
+# then drawn one band (of rows) at a time and the bands are streamed to a
+# PNG or TIFF file, i.e., the memory used depends on the height of the
+# bands and not on the size of the page
+#
+
+import struct
+import zlib
+
+import PIL.Image
+import PIL.ImageChops
+import PIL.ImageDraw
+
+from . import log
+from . import pics
+from . import smartcrop
+
+
+class _Draw:
+    '''The part of ImageDraw supported by a RecordingCanvas'''
+
+    def __init__(self, canvas):
+        self.canvas = canvas
+
+    def rectangle(self, xy, fill=None, outline=None):
+        self.canvas.record(('rectangle', tuple(map(int, xy)), fill, outline))
+
+
+class RecordingCanvas:
+    '''Same interface as pics.Canvas, but everything drawn is recorded as
+    operations in page coordinates (also when drawn on a rotated canvas)'''
+    tiled = True
+
+    def __init__(self, size, color, parent=None, rotation=None, box=None):
+        self.size = tuple(size)
+        self.color = color
+        self.parent = parent
+        self.rotation = rotation
+        self.box = box
+        self.ops = [] if parent is None else parent.ops
+        self.draw = _Draw(self)
+
+    def isLandscape(self):
+        return self.size[0] >= self.size[1]
+
+    def paste(self, src, pos, mask=None):
+        if isinstance(src, PIL.Image.Image):
+            size = src.size
+        else:
+            size = mask.size
+        self.record(('paste', src, tuple(pos) + size, mask))
+
+    def pastePicture(self, image, box, profile, effects=None,
+                     focus=(.5, .5), rotation=None):
+        '''Paste image (transposed by rotation) resized+cropped (at focus,
+        see pics.cropImage) to box (x, y, w, h) with effects (see
+        effects.py). The resizing is done for one band at a time'''
+        self.record(('picture', image, box, profile, effects, focus,
+                     rotation))
+
+    def record(self, op):
+        if self.parent is None:
+            self.ops.append(op)
+        else:
+            self.parent.record(self._toParent(op))
+
+    def _toParent(self, op):
+        '''Convert op from this (rotated) canvas to the parent canvas'''
+        W, H = self.parent.size
+        if op[0] == 'rectangle':
+            a, b, c, d = op[1]
+            if self.rotation == 'CW':
+                xy = (b, H-1-c, d, H-1-a)
+            else:
+                xy = (W-1-d, a, W-1-b, c)
+            return op[0], xy, op[2], op[3]
+
+        x, y, w, h = op[2]
+        if self.rotation == 'CW':
+            box = (y, H-x-w, h, w)
+            transpose = PIL.Image.ROTATE_90
+        else:
+            box = (W-y-h, x, h, w)
+            transpose = PIL.Image.ROTATE_270
+        if op[0] == 'picture':
+            # the picture is transposed (and back) when it is drawn
+            return (op[0], op[1], box) + op[3:]
+        src, mask = op[1], op[3]
+        if isinstance(src, PIL.Image.Image):
+            src = src.transpose(transpose)
+        if mask is not None:
+            mask = mask.transpose(transpose)
+        return op[0], src, box, mask
+
+    def rotateCW(self):
+        if self.rotation == 'CCW':
+            return self._toParentCanvas()
+        box = self.box
+        if box is not None:
+            w = self.size[1]
+            box = (w - box[3], box[0], w - box[1], box[2])
+        return RecordingCanvas(self.size[::-1], self.color, self, 'CW', box)
+
+    def rotateCCW(self):
+        if self.rotation == 'CW':
+            return self._toParentCanvas()
+        box = self.box
+        if box is not None:
+            h = self.size[0]
+            box = (box[1], h - box[2], box[3], h - box[0])
+        return RecordingCanvas(self.size[::-1], self.color, self, 'CCW', box)
+
+    def _toParentCanvas(self):
+        '''Rotate back, i.e., return the parent with the box converted'''
+        box = self.box
+        if box is not None and self.rotation == 'CW':
+            h = self.size[0]
+            box = (box[1], h - box[2], box[3], h - box[0])
+        elif box is not None:
+            w = self.size[1]
+            box = (w - box[3], box[0], w - box[1], box[2])
+        self.parent.box = box
+        return self.parent
+
+
+def _pictureBand(image, box, profile, effects, focus, rotation, y0, y1):
+    '''Return the part of image (resized+cropped to box, with effects) in
+    the rows from y0 to y1 (page coordinates) and the row it starts at.
+    The pixels are the same as those of the picture drawn without bands,
+    i.e., the picture is transposed by rotation, resized+cropped (see
+    pics.cropImagePart), sharpened, given the effects and transposed back
+    to the page'''
+    x, y, w, h = box
+    r0, r1 = max(y0, y), min(y1, y + h)
+    if r0 >= r1:
+        return None, None
+
+    # the rows of the page are columns of a transposed picture
+    a0, a1 = r0 - y, r1 - y
+    size, axis, back = (w, h), 1, None
+    if rotation == PIL.Image.ROTATE_270:
+        size, axis, back = (h, w), 0, PIL.Image.ROTATE_90
+        a0, a1 = h - a1, h - a0
+    elif rotation == PIL.Image.ROTATE_90:
+        size, axis, back = (h, w), 0, PIL.Image.ROTATE_270
+
+    # a few extra rows, so that sharpening works at the edges of the band
+    # (more than the unsharp mask uses)
+    pad = 8 if profile.sharpen else 0
+    p0, p1 = max(0, a0 - pad), min(size[axis], a1 + pad)
+    part, cut, offset = [0, 0] + list(size), [0, 0] + list(size), [0, 0]
+    part[axis], part[axis+2] = p0, p1
+    cut[axis], cut[axis+2] = a0 - p0, a1 - p0
+    offset[axis] = a0
+
+    band = pics.cropImagePart(image, size, part, profile,
+                              smartcrop.rotateFocus(focus, rotation),
+                              rotation)
+    sharp = pics.sharpenImage(band, profile)
+    res = sharp.crop(cut)
+    if sharp is not band:
+        sharp.close()
+    band.close()
+    if effects:
+        tmp, res = res, effects.apply(res, offset, size)
+        tmp.close()
+    if back is not None:
+        tmp, res = res, res.transpose(back)
+        tmp.close()
+    return res, r0
+
+
+def renderBand(canvas, y0, y1):
+    '''Draw rows y0 to y1 of the page recorded on canvas'''
+    band = PIL.Image.new('RGB', (canvas.size[0], y1 - y0), canvas.color)
+    draw = PIL.ImageDraw.Draw(band)
+    for op in canvas.ops:
+        if op[0] == 'rectangle':
+            a, b, c, d = op[1]
+            if b < y1 and d >= y0:
+                draw.rectangle((a, b - y0, c, d - y0), op[2], op[3])
+            continue
+
+        x, y, w, h = op[2]
+        if y >= y1 or y + h <= y0:
+            continue
+        if op[0] == 'picture':
+            pic, r0 = _pictureBand(*op[1:], y0, y1)
+            band.paste(pic, (x, r0 - y0))
+            pic.close()
+        elif op[3] is None:
+            band.paste(op[1], (x, y - y0))
+        else:
+            band.paste(op[1], (x, y - y0), op[3])
+    return band
+
+
+def _chunk(fd, tag, data):
+    fd.write(struct.pack('>I', len(data)) + tag + data)
+    fd.write(struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+
+
+def _subFilter(band):
+    '''Each byte minus the same byte of the pixel to the left (PNG filter
+    Sub, TIFF predictor 2)'''
+    left = PIL.Image.new(band.mode, band.size)
+    left.paste(band.crop((0, 0, band.size[0] - 1, band.size[1])), (1, 0))
+    return PIL.ImageChops.subtract_modulo(band, left).tobytes()
+
+
+class PngWriter:
+    def __init__(self, fd, size):
+        self.fd = fd
+        self.size = size
+        self.z = zlib.compressobj(6)
+        fd.write(b'\x89PNG\r\n\x1a\n')
+        _chunk(fd, b'IHDR', struct.pack('>IIBBBBB', size[0], size[1],
+                                        8, 2, 0, 0, 0))
+
+    def write(self, band):
+        stride = 3 * band.size[0]
+        data = _subFilter(band)
+        rows = b''.join(b'\x01' + data[i:i+stride]
+                        for i in range(0, len(data), stride))
+        data = self.z.compress(rows)
+        if data:
+            _chunk(self.fd, b'IDAT', data)
+
+    def close(self):
+        _chunk(self.fd, b'IDAT', self.z.flush())
+        _chunk(self.fd, b'IEND', b'')
+
+
+class TiffWriter:
+    '''Deflate compressed TIFF with one strip per band (all bands, except
+    the last one, must have the same height)'''
+
+    def __init__(self, fd, size):
+        self.fd = fd
+        self.size = size
+        self.strips = []  # (offset, byte count)
+        self.rowsPerStrip = None
+        fd.write(b'II*\x00\x00\x00\x00\x00')
+
+    def write(self, band):
+        if self.rowsPerStrip is None:
+            self.rowsPerStrip = band.size[1]
+        data = zlib.compress(_subFilter(band), 6)
+        self.strips.append((self.fd.tell(), len(data)))
+        self.fd.write(data)
+
+    def close(self):
+        fd = self.fd
+        n = len(self.strips)
+        # data referenced by the IFD: bits per sample + strip offsets/counts
+        if fd.tell() % 2:
+            fd.write(b'\x00')
+        bps = fd.tell()
+        fd.write(struct.pack('<3H', 8, 8, 8))
+        offsets = fd.tell()
+        fd.write(struct.pack('<%dI' % n, *(o for o, _ in self.strips)))
+        counts = fd.tell()
+        fd.write(struct.pack('<%dI' % n, *(c for _, c in self.strips)))
+
+        SHORT, LONG = 3, 4
+        tags = [
+            (256, LONG, 1, self.size[0]),
+            (257, LONG, 1, self.size[1]),
+            (258, SHORT, 3, bps),
+            (259, SHORT, 1, 8),           # deflate
+            (262, SHORT, 1, 2),           # RGB
+            (273, LONG, n, offsets if n > 1 else self.strips[0][0]),
+            (277, SHORT, 1, 3),
+            (278, LONG, 1, self.rowsPerStrip),
+            (279, LONG, n, counts if n > 1 else self.strips[0][1]),
+            (284, SHORT, 1, 1),           # chunky
+            (317, SHORT, 1, 2),           # horizontal differencing
+        ]
+        ifd = fd.tell()
+        fd.write(struct.pack('<H', len(tags)))
+        for tag, tp, count, value in tags:
+            fmt = '<HHIHH' if tp == SHORT and count == 1 else '<HHII'
+            fd.write(struct.pack(fmt, tag, tp, count, value,
+                                 *((0,) if fmt == '<HHIHH' else ())))
+        fd.write(struct.pack('<I', 0))
+        fd.seek(4)
+        fd.write(struct.pack('<I', ifd))
+        fd.seek(0, 2)
+
+
+WRITERS = {
+    '.png': PngWriter,
+    '.tif': TiffWriter,
+    '.tiff': TiffWriter,
+}
+
+
+def writeBands(canvas, fd, ext, bandHeight):
+    '''Draw the page recorded on canvas band by band, writing the bands to
+    the file fd as a PNG or TIFF (depending on ext)'''
+    if ext not in WRITERS:
+        raise ValueError('tiled rendering only supports %s files, not %r' %
+                         (', '.join(sorted(WRITERS)), ext))
+    writer = WRITERS[ext](fd, canvas.size)
+    h = canvas.size[1]
+    for y0 in range(0, h, bandHeight):
+        band = renderBand(canvas, y0, min(h, y0 + bandHeight))
+        writer.write(band)
+        band.close()
+    writer.close()
+    log.debug('tiles', 'Wrote', canvas.size, 'in bands of', bandHeight,
+              'rows')
@@ -0,0 +1,168 @@
+#
+# -*- encoding: utf-8 -*-
+#
+# Draw pages in worker processes. The parent puts the contents of the font
+# files, the decoded and cropped pictures and the event stores in shared
+# memory once, and the workers attach to them instead of loading, decoding
+# and parsing everything again. Pictures are mapped by Image.frombuffer
+# (without copying, so they are stored as L, RGBA or CMYK), and fonts are
+# opened by FreeType from the file of the shared memory (mapped, where the
+# file exists, e.g., /dev/shm on Linux). Elsewhere each font is copied
+#
+
+import copy
+import io
+import os
+import pickle
+
+import PIL.Image
+import PIL.ImageFont
+
+from . import events
+from . import log
+from . import pics
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # python < 3.8
+    shared_memory = None
+
+# image modes mapped (not copied) by Image.frombuffer. Other images are
+# shared as RGBA, which can be pasted on an RGB image as is
+_MAPPED_MODES = ('L', 'RGBA', 'CMYK')
+# where the blocks of shared memory are found as files (Linux)
+SHM_DN = '/dev/shm'
+
+
+class Ref:
+    '''Reference to an object in the shared memory block name'''
+
+    def __init__(self, kind, name, size, meta=None):
+        self.kind = kind
+        self.name = name
+        self.size = size
+        self.meta = meta
+
+    def __repr__(self):
+        return 'Ref(%r, %r)' % (self.kind, self.name)
+
+
+class Exporter:
+    '''Parent side: put objects in shared memory and return Refs to them.
+    close() frees all the shared memory'''
+
+    def __init__(self):
+        self._blocks = []
+        self._refs = {}  # key -> (object, ref)
+
+    def _block(self, data):
+        shm = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+        shm.buf[:len(data)] = data
+        self._blocks.append(shm)
+        return shm.name
+
+    def export(self, obj):
+        if isinstance(obj, PIL.ImageFont.FreeTypeFont):
+            key = 'font', obj.path
+        else:
+            key = 'object', id(obj)
+        if key in self._refs:
+            ref = self._refs[key][1]
+        elif isinstance(obj, PIL.ImageFont.FreeTypeFont):
+            with open(obj.path, 'rb') as fd:
+                data = fd.read()
+            ref = Ref('font', self._block(data), len(data), obj.path)
+        elif isinstance(obj, PIL.Image.Image):
+            image = obj if obj.mode in _MAPPED_MODES else \
+                obj.convert('RGBA')
+            data = image.tobytes()
+            ref = Ref('image', self._block(data), len(data),
+                      (image.mode, image.size))
+        else:
+            data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+            ref = Ref('pickle', self._block(data), len(data))
+        self._refs[key] = obj, ref
+        log.debug('workers', 'Exported', ref, ref.size, 'bytes')
+
+        if ref.kind == 'font':
+            return ref, obj.index, obj.size
+        return ref
+
+    def close(self):
+        for shm in self._blocks:
+            shm.close()
+            shm.unlink()
+        self._blocks = []
+        self._refs = {}
+
+
+def exportArgs(exporter, args):
+    '''Return a copy of args that can be sent to a worker, i.e., fonts,
+    pictures and events are replaced with Refs, and open files removed'''
+    wargs = copy.copy(args)
+    for k, v in vars(args).items():
+        if isinstance(v, (PIL.ImageFont.FreeTypeFont, PIL.Image.Image,
+                          events.EventStore)):
+            v = exporter.export(v)
+        elif k == 'crops':
+            v = dict((key, exporter.export(img)) for key, img in v.items())
+        elif isinstance(v, io.IOBase):
+            v = None
+        setattr(wargs, k, v)
+    return wargs
+
+
+# worker side: name -> (SharedMemory, object)
+_attached = {}
+VARIANTS = []
+
+
+def attach(ref):
+    '''Return the object ref refers to'''
+    if isinstance(ref, tuple):
+        # a font
+        ref, index, size = ref
+        attach(ref)
+        font = PIL.ImageFont.truetype(pics.getFontFile(ref.meta), size, index)
+        # same keys in the font caches as in the parent
+        font.path = ref.meta
+        return font
+    if ref.name in _attached:
+        return _attached[ref.name][1]
+
+    shm = shared_memory.SharedMemory(name=ref.name)
+    buf = shm.buf[:ref.size]
+    if ref.kind == 'font':
+        # FreeType maps the font if opened as a file
+        fn = os.path.join(SHM_DN, shm.name.lstrip('/'))
+        pics.addFontFile(ref.meta, fn if os.path.isfile(fn) else buf)
+        obj = ref.meta
+    elif ref.kind == 'image':
+        mode, size = ref.meta
+        obj = PIL.Image.frombuffer(mode, size, buf, 'raw', mode, 0, 1)
+    else:
+        obj = pickle.loads(buf)
+    _attached[ref.name] = shm, obj
+    return obj
+
+
+def isRef(v):
+    return isinstance(v, Ref) or (isinstance(v, tuple) and v and
+                                  isinstance(v[0], Ref))
+
+
+def init(variants, verbose=1):
+    '''Initializer of a worker process: attach to all shared objects used
+    by variants'''
+    log.VERBOSE = verbose
+    for wargs in variants:
+        args = copy.copy(wargs)
+        for k, v in vars(wargs).items():
+            if isRef(v):
+                setattr(args, k, attach(v))
+            elif k == 'crops':
+                args.crops = dict((key, attach(ref))
+                                  for key, ref in v.items())
+        VARIANTS.append(args)
+    log.debug('workers', 'Attached', len(_attached), 'shared objects')
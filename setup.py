@@ -28,7 +28,9 @@ setup(name='dpc',
       packages=['dpc'],
       zip_safe=False,
       requires=['Pillow'],
-      scripts=['dpc-single'],
+      # --brightness, --duotone, --vignette and --crop smart
+      extras_require={'numpy': ['numpy']},
+      scripts=['dpc-single', 'dpc-batch'],
       keywords='photos calendar',
       classifiers=[
           'Development Status :: 4 - Beta',
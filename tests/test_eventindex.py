@@ -0,0 +1,82 @@
+#
+# -*- encoding: utf-8 -*-
+#
+
+import datetime
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from dpc import eventindex
+
+DAY = datetime.date(2024, 3, 28)
+
+
+class ReloadTest(unittest.TestCase):
+    '''The index is reloaded while it is used by other threads'''
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.events = os.path.join(self.tmp.name, 'events.txt')
+        self.writeEvents('Old')
+        self.index = eventindex.EventIndex(
+            os.path.join(self.tmp.name, 'events.idx'), [self.events])
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def writeEvents(self, text):
+        with open(self.events, 'w') as fd:
+            fd.write('2024-03-28;g=;%s\n' % text)
+
+    def texts(self):
+        return list(ev.text for ev in self.index.between(DAY, DAY))
+
+    def testOldMappingClosedWhenUnused(self):
+        with mock.patch.object(eventindex, 'RELOAD_INTERVAL', 0):
+            with self.index._using() as old:
+                self.writeEvents('New text')
+                self.assertEqual(self.texts(), ['New text'])
+                # still used here
+                self.assertFalse(old.mm.closed)
+                self.assertEqual(old.string(old.texts[0]), 'Old')
+            self.assertTrue(old.mm.closed)
+            self.assertFalse(self.index._view.mm.closed)
+
+    def testConcurrentReload(self):
+        errors, seen = [], set()
+        stop = threading.Event()
+
+        def use():
+            try:
+                while not stop.is_set():
+                    seen.update(self.texts())
+                    self.index.daysOff(DAY, DAY)
+                    len(self.index)
+            except Exception as e:
+                errors.append(e)
+
+        with mock.patch.object(eventindex, 'RELOAD_INTERVAL', 0):
+            ts = list(threading.Thread(target=use) for i in range(4))
+            for t in ts:
+                t.start()
+            try:
+                # (the sizes differ, as the changes are faster than the
+                # resolution of the mtimes)
+                for i in range(30):
+                    self.writeEvents('Text' + '!' * i)
+                    self.texts()
+            finally:
+                stop.set()
+                for t in ts:
+                    t.join()
+            self.assertEqual(self.texts(), ['Text' + '!' * 29])
+        self.assertEqual(errors, [])
+        self.assertTrue(seen <= {'Old'} | set('Text' + '!' * i
+                                             for i in range(30)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+#
+# -*- encoding: utf-8 -*-
+#
+
+import datetime
+import io
+import unittest
+
+from dpc import ics
+
+START = datetime.date(2024, 1, 1)
+END = datetime.date(2024, 12, 31)
+
+
+def readIcs(*vevents):
+    '''Events from an .ics file with vevents (each a list of lines)'''
+    lines = ['BEGIN:VCALENDAR']
+    for vevent in vevents:
+        lines += ['BEGIN:VEVENT'] + vevent + ['END:VEVENT']
+    lines.append('END:VCALENDAR')
+    fd = io.StringIO('\r\n'.join(lines) + '\r\n')
+    return list((ev.date.isoformat(), ev.text)
+                for ev in ics.readIcsFile(fd, START, END))
+
+
+WEEKLY = ['UID:meeting-1', 'DTSTART:20240102T100000',
+          'RRULE:FREQ=WEEKLY;COUNT=3', 'SUMMARY:Meeting']
+
+
+class IcsTest(unittest.TestCase):
+    def testRecurring(self):
+        self.assertEqual(readIcs(WEEKLY), [
+            ('2024-01-02', 'Meeting'),
+            ('2024-01-09', 'Meeting'),
+            ('2024-01-16', 'Meeting'),
+        ])
+
+    def testRecurrenceId(self):
+        moved = ['UID:meeting-1', 'RECURRENCE-ID:20240109T100000',
+                 'DTSTART:20240111T100000', 'SUMMARY:Meeting (moved)']
+        expected = [
+            ('2024-01-02', 'Meeting'),
+            ('2024-01-11', 'Meeting (moved)'),
+            ('2024-01-16', 'Meeting'),
+        ]
+        # the override may come before or after the recurring event
+        self.assertEqual(readIcs(WEEKLY, moved), expected)
+        self.assertEqual(readIcs(moved, WEEKLY), expected)
+
+    def testRecurrenceIdOtherUid(self):
+        other = ['UID:other', 'RECURRENCE-ID:20240109',
+                 'DTSTART:20240110', 'SUMMARY:Other']
+        self.assertEqual(len(readIcs(WEEKLY, other)), 4)
+
+    def testBadExdate(self):
+        self.assertEqual(
+            readIcs(WEEKLY + ['EXDATE:garbage', 'EXDATE:20240109T100000']),
+            [('2024-01-02', 'Meeting'), ('2024-01-16', 'Meeting')])
+
+    def testBadDtstart(self):
+        self.assertEqual(readIcs(['DTSTART:garbage', 'SUMMARY:Bad']), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
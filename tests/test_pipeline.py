@@ -0,0 +1,66 @@
+#
+# -*- encoding: utf-8 -*-
+#
+
+import threading
+import time
+import unittest
+
+from dpc import pipeline
+
+
+def runInThread(pipe, items, timeout=10):
+    '''Run pipe.run(items) in a thread. Return the exception raised or None.
+    Fails if the pipeline has not stopped after timeout seconds'''
+    res = []
+
+    def run():
+        try:
+            pipe.run(items)
+        except BaseException as e:
+            res.append(e)
+    t = threading.Thread(target=run, daemon=True)
+    t.start()
+    t.join(timeout)
+    if t.is_alive():
+        raise AssertionError('pipeline did not stop')
+    return res[0] if res else None
+
+
+class PipelineTest(unittest.TestCase):
+    def makePipeline(self, done):
+        def slow(item):
+            time.sleep(.01)
+            return item
+
+        return pipeline.Pipeline([
+            pipeline.Stage('compose', slow, workers=2),
+            pipeline.Stage('write', done.append),
+        ])
+
+    def testAllItems(self):
+        done = []
+        self.assertIsNone(runInThread(self.makePipeline(done), range(10)))
+        self.assertEqual(sorted(done), list(range(10)))
+
+    def testItemsRaise(self):
+        for exc in (ValueError, SystemExit, KeyboardInterrupt):
+            def items():
+                yield from range(3)
+                raise exc(1)
+            done = []
+            pipe = self.makePipeline(done)
+            self.assertIsInstance(runInThread(pipe, items()), exc)
+            self.assertFalse(any(t.name.startswith(('compose-', 'write-'))
+                                 for t in threading.enumerate()))
+
+    def testStageRaises(self):
+        def fail(item):
+            raise ValueError(item)
+
+        pipe = pipeline.Pipeline([pipeline.Stage('fail', fail)])
+        self.assertIsInstance(runInThread(pipe, range(5)), ValueError)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+#
+# -*- encoding: utf-8 -*-
+#
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+ROOT_DN = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def runSingle(*argv, timeout=60):
+    '''Run dpc-single with argv. Return (exit code, stderr)'''
+    argv = ['--locale', 'C'] + list(argv)
+    p = subprocess.run([sys.executable, '-m', 'dpc.single'] + argv,
+                       cwd=ROOT_DN, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.PIPE, timeout=timeout,
+                       universal_newlines=True)
+    return p.returncode, p.stderr
+
+
+class FatalErrorTest(unittest.TestCase):
+    '''Fatal errors must stop dpc-single (and not leave it hanging)'''
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.bad = os.path.join(self.tmp.name, 'bad.jpg')
+        with open(self.bad, 'w') as fd:
+            fd.write('not a picture\n')
+        self.out = os.path.join(self.tmp.name, 'out.png')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def testBadPicture(self):
+        rc, err = runSingle('-d', '2024-03-28', '-p', self.bad,
+                            '-o', self.out)
+        self.assertNotEqual(rc, 0)
+        self.assertIn('does not contain valid image data', err)
+        self.assertFalse(os.path.exists(self.out))
+
+    def testBadPictureInVariant(self):
+        from PIL import Image
+        good = os.path.join(self.tmp.name, 'good.png')
+        Image.new('RGB', (40, 30)).save(good)
+        rc, err = runSingle('-d', '2024-03-28', '--until', '2024-03-30',
+                            '-p', good, '-o', self.out + '%d',
+                            '--variant=-p %s' % self.bad)
+        self.assertNotEqual(rc, 0)
+        self.assertIn('does not contain valid image data', err)
+
+    def testBandHeightWithoutOutput(self):
+        from PIL import Image
+        good = os.path.join(self.tmp.name, 'good.png')
+        Image.new('RGB', (40, 30)).save(good)
+        rc, err = runSingle('-d', '2024-03-28', '-p', good,
+                            '--band-height', '100', '--show')
+        self.assertNotEqual(rc, 0)
+        self.assertIn('--band-height requires --output', err)
+
+
+class ProcessesTest(unittest.TestCase):
+    '''Pages rendered in worker processes'''
+
+    def testTimings(self):
+        from PIL import Image
+        with tempfile.TemporaryDirectory() as tmp:
+            pic = os.path.join(tmp, 'pic.png')
+            Image.new('RGB', (40, 30)).save(pic)
+            rc, err = runSingle('-d', '2024-03-28', '--until', '2024-03-30',
+                                '-p', pic, '-o', os.path.join(tmp, '%d.png'),
+                                '--processes', '2', '--timings')
+        self.assertEqual(rc, 0, err)
+        # the timings of the boxes drawn by the workers
+        self.assertRegex(err, r'Box \w+: 3 boxes')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+#
+# -*- encoding: utf-8 -*-
+#
+
+import os
+import tempfile
+import unittest
+
+from PIL import Image, ImageChops
+
+from dpc import pics
+
+from test_single import runSingle
+
+# Pillow resizes with a box of 32 bit floats, so a part of a picture may
+# differ slightly from the same part of the whole resized picture
+TOLERANCE = 3
+
+
+def portrait(size=(600, 800)):
+    '''Return a portrait picture with some detail'''
+    bands = [Image.effect_mandelbrot(size, (-2, -1.5, 1, 1.5), 60),
+             Image.linear_gradient('L').resize(size),
+             Image.effect_noise(size, 40)]
+    return Image.merge('RGB', bands)
+
+
+def maxDifference(a, b):
+    diff = ImageChops.difference(a.convert('RGB'), b.convert('RGB'))
+    return max(e[1] for e in diff.getextrema())
+
+
+class CropImagePartTest(unittest.TestCase):
+    '''A part must look like the same part of the whole cropped picture'''
+
+    def check(self, profile, rotation, tolerance):
+        image = portrait()
+        profile = pics.getProfile(profile)
+        size = profile.pageSize((330, 250) if rotation is None else
+                                (250, 330))
+        full = pics.cropImage(image if rotation is None else
+                              image.transpose(rotation), size, False,
+                              profile)
+        for y in range(0, size[1], 17):
+            part = (0, y, size[0], min(size[1], y+17))
+            res = pics.cropImagePart(image, size, part, profile,
+                                     rotation=rotation)
+            self.assertEqual(res.size, (part[2]-part[0], part[3]-part[1]))
+            self.assertLessEqual(maxDifference(full.crop(part), res),
+                                 tolerance, (profile.name, rotation, part))
+
+    def testNormal(self):
+        self.check('normal', None, TOLERANCE)
+
+    def testRotated(self):
+        self.check('normal', Image.ROTATE_90, TOLERANCE)
+        self.check('print', Image.ROTATE_270, TOLERANCE)
+
+    def testPreview(self):
+        self.check('preview', None, 0)
+        self.check('preview', Image.ROTATE_90, 0)
+
+
+class BandHeightTest(unittest.TestCase):
+    '''--band-height must not change the page'''
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.pic = os.path.join(self.tmp.name, 'portrait.png')
+        portrait().save(self.pic)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def render(self, fn, *argv):
+        out = os.path.join(self.tmp.name, fn)
+        rc, err = runSingle('-d', '2024-03-28', '-p', self.pic,
+                            '-o', out, *argv)
+        self.assertEqual(rc, 0, err)
+        with Image.open(out) as image:
+            image.load()
+            return image
+
+    def compare(self, tolerance, *argv):
+        whole = self.render('whole.png', *argv)
+        tiled = self.render('tiled.png', '--band-height', '97', *argv)
+        self.assertEqual(whole.size, tiled.size)
+        self.assertLessEqual(maxDifference(whole, tiled), tolerance)
+
+    def testPortrait(self):
+        self.compare(TOLERANCE)
+
+    def testPortraitSharpened(self):
+        # the unsharp mask amplifies the differences
+        self.compare(2 * TOLERANCE, '--sharpen', '50')
+
+
+if __name__ == '__main__':
+    unittest.main()